@@ -1,5 +1,18 @@
+import math
+from itertools import product
+
 import numpy as np
-#from numba import njit
+from scipy.spatial import cKDTree
+
+from profiling import NULL_PROFILER
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+BACKENDS = ('numpy', 'numba')
 
 # SODA Functions
 
@@ -29,38 +42,80 @@ def grid_set(data, N):
     grid_angl = np.sqrt(1-np.sum(AvD2*AvD2))/N
     return X1, AvD1, AvD2, grid_trad, grid_angl
 
-def pi_calculator(Uniquesample, mode):
+def _weighted_mean(A, Frequency):
+    '''
+    # Mean along the first axis, weighted by Frequency if given
+    '''
+    if Frequency is None:
+        return A.mean(0)
+    return Frequency.dot(A)/Frequency.sum()
+
+def unique_samples(data, tolerance=None):
+    '''
+    # Unique samples and their multiplicity
+    #
+    # tolerance: float
+    #     Samples are quantized to a grid of this spacing before deduplication,
+    #     each unique sample is the mean of the samples in its grid cell.
+    #     None means only identical samples are merged
+    #
+    # Return:
+    # Uniquesample - unique samples, shape (UN, W)
+    # Frequency - number of samples represented by each unique sample
+    # inverse - index in Uniquesample of each sample of data
+    '''
+    if tolerance is None:
+        Uniquesample, inverse, Frequency = np.unique(data, axis=0, return_inverse=True, return_counts=True)
+        return Uniquesample, Frequency, inverse.ravel()
+
+    keys = np.floor(data/tolerance + 0.5)
+    _, inverse, Frequency = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    Uniquesample = np.zeros((Frequency.shape[0], data.shape[1]))
+    np.add.at(Uniquesample, inverse, data)
+    Uniquesample /= Frequency[:,None]
+    return Uniquesample, Frequency, inverse
+
+def pi_calculator(Uniquesample, mode, dtype=np.float64, Frequency=None):
     '''
     # Cumulative Proximity in recursive version
     # Section 2.2.i of SODA
+    #
+    # mode: 'euclidean', 'cosine' or 'both'
+    #     'both' returns (euclidean, cosine), computed in one pass that
+    #     reuses a single (UN, W) buffer
+    # dtype: float dtype of the computation, np.float32 halves the memory
+    # Frequency: number of samples represented by each unique sample,
+    #     means are weighted by it. None means every sample counts once
     '''
+    Uniquesample = np.asarray(Uniquesample, dtype=dtype)
     UN, W = Uniquesample.shape
-    if mode == 'euclidean':
-        AA1 = Uniquesample.mean(0)
-        X1 = sum(sum(np.power(Uniquesample,2)))/UN
-        DT1 = X1 - sum(np.power(AA1,2))
-        aux = []
-        for i in range(UN): aux.append(AA1)
-        aux2 = [Uniquesample[i]-aux[i] for i in range(UN)]
-        uspi = np.sum(np.power(aux2,2),axis=1)+DT1
-
-    if mode == 'cosine':
-        Xnorm = np.matrix(np.sqrt(np.sum(np.power(Uniquesample,2),axis=1))).T
-        aux2 = Xnorm
-        for i in range(W-1):
-            aux2 = np.insert(aux2,0,Xnorm.T,axis=1)
-        Uniquesample1 = Uniquesample / aux2
-        AA2 = np.mean(Uniquesample1,0)
+    if Frequency is not None:
+        Frequency = np.asarray(Frequency, dtype=dtype)
+    uspi = {}
+    squared_norm = np.einsum('ij,ij->i', Uniquesample, Uniquesample)
+    buffer = np.empty_like(Uniquesample)
+
+    if mode in ('euclidean', 'both'):
+        AA1 = _weighted_mean(Uniquesample, Frequency)
+        X1 = _weighted_mean(squared_norm, Frequency)
+        DT1 = X1 - np.dot(AA1,AA1)
+        np.subtract(Uniquesample, AA1, out=buffer)
+        uspi['euclidean'] = np.einsum('ij,ij->i', buffer, buffer)+DT1
+
+    if mode in ('cosine', 'both'):
+        np.divide(Uniquesample, np.sqrt(squared_norm)[:,None], out=buffer)
+        AA2 = _weighted_mean(buffer, Frequency)
         X2 = 1
-        DT2 = X2 - np.sum(np.power(AA2,2))
-        aux = []
-        for i in range(UN): aux.append(AA2)
-        aux2 = [Uniquesample1[i]-aux[i] for i in range(UN)]
-        uspi = np.sum(np.sum(np.power(aux2,2),axis=1),axis=1)+DT2
-        
-    return uspi
+        DT2 = X2 - np.dot(AA2,AA2)
+        buffer -= AA2
+        uspi['cosine'] = np.einsum('ij,ij->i', buffer, buffer)+DT2
+
+    if mode == 'both':
+        return uspi['euclidean'], uspi['cosine']
+    return uspi[mode]
 
-def Globaldensity_Calculator(Uniquesample, distancetype):
+def Globaldensity_Calculator(Uniquesample, distancetype, dtype=np.float64, Frequency=None):
     '''
     # Return:
     # GD - Global Density
@@ -68,15 +123,25 @@ def Globaldensity_Calculator(Uniquesample, distancetype):
     # Density_1 - Euclidean Density
     # Density_2 - Cosine Density
     # Uniquesample - Samples sorted by Global Density
+    #
+    # dtype: float dtype of the density computation (see pi_calculator)
+    # Frequency: number of samples represented by each unique sample (see
+    #     unique_samples), densities are normalized over all represented samples
+    # SortedFrequency - Frequency sorted by Global Density, None without Frequency
     '''
-    uspi1 = pi_calculator(Uniquesample, distancetype)
+    if distancetype == 'cosine':
+        uspi1 = uspi2 = pi_calculator(Uniquesample, 'cosine', dtype, Frequency)
+    else:
+        uspi1, uspi2 = pi_calculator(Uniquesample, 'both', dtype, Frequency)
     
-    sum_uspi1 = sum(uspi1)
-    Density_1 = uspi1 / sum_uspi1
-
-    uspi2 = pi_calculator(Uniquesample, 'cosine')
+    if Frequency is None:
+        sum_uspi1 = uspi1.sum()
+        sum_uspi2 = uspi2.sum()
+    else:
+        sum_uspi1 = np.dot(Frequency, uspi1)
+        sum_uspi2 = np.dot(Frequency, uspi2)
 
-    sum_uspi2 = sum(uspi2)
+    Density_1 = uspi1 / sum_uspi1
     Density_2 = uspi2 / sum_uspi2
 
     GD = (Density_2+Density_1)
@@ -84,39 +149,167 @@ def Globaldensity_Calculator(Uniquesample, distancetype):
     GD = GD[index]
     Uniquesample = Uniquesample[index]
 
+    SortedFrequency = None if Frequency is None else Frequency[index]
+    return GD, Density_1, Density_2, Uniquesample, SortedFrequency
 
-    return GD, Density_1, Density_2, Uniquesample
-
-#@njit(fastmath = True)
 def hand_dist(XA,XB):   
     '''
     # Euclidean and Cosine distance between one sample (XA) and a set of samples (XB)
+    # Return: distance matrix with shape (L, 2)
     '''
+    XA = XA.reshape(-1)
     L, W = XB.shape
     distance = np.zeros((L,2))
-    
-    for i in range(L):
-        aux = 0 # Euclidean
-        dot = 0 # Cosine
-        denom_a = 0 # Cosine
-        denom_b = 0 # Cosine
-        for j in range(W):
-            aux += ((XA[0,j]-XB[i,j])**2) # Euclidean
-            dot += (XA[0,j]*XB[i,j]) # Cosine
-            denom_a += (XA[0,j] * XA[0,j]) # Cosine
-            denom_b += (XB[i,j] * XB[i,j]) # Cosine
 
-        distance[i,0] = aux**.5
-        distance[i,1] = ((1 - ((dot / ((denom_a ** 0.5) * (denom_b ** 0.5)))))**2)**.25
-    
+    aux = XA - XB # Euclidean
+    distance[:,0] = np.sqrt(np.sum(aux*aux,axis=1))
+    dot = np.sum(XA*XB,axis=1) # Cosine
+    denom_a = np.sqrt(np.sum(XA*XA)) # Cosine
+    denom_b = np.sqrt(np.sum(XB*XB,axis=1)) # Cosine
+    distance[:,1] = ((1 - (dot / (denom_a * denom_b)))**2)**.25
+    return distance
+
+def hand_dist_many(XA,XB,block_size=256):
+    '''
+    # Euclidean and Cosine distance between every sample of XA and a set of samples (XB)
+    # Return: distance tensor with shape (LA, L, 2)
+    #
+    # XA is processed in blocks of block_size rows to bound the (block_size, L, W)
+    # temporaries
+    '''
+    LA, W = XA.shape
+    L, _ = XB.shape
+    distance = np.zeros((LA,L,2))
+
+    denom_b = np.sqrt(np.sum(XB*XB,axis=1)) # Cosine
+    for start in range(0,LA,block_size):
+        A = XA[start:start+block_size]
+        aux = A[:,None,:] - XB[None,:,:] # Euclidean
+        distance[start:start+block_size,:,0] = np.sqrt(np.sum(aux*aux,axis=2))
+        dot = np.sum(A[:,None,:]*XB[None,:,:],axis=2) # Cosine
+        denom_a = np.sqrt(np.sum(A*A,axis=1)) # Cosine
+        distance[start:start+block_size,:,1] = ((1 - (dot / (denom_a[:,None] * denom_b[None,:])))**2)**.25
+
+    return distance
+
+def hand_dist_pairs(XA,XB):
+    '''
+    # Euclidean and Cosine distance between paired samples XA[k] and XB[k]
+    # Return: distance matrix with shape (K, 2)
+    '''
+    K, _ = XA.shape
+    distance = np.zeros((K,2))
+    aux = XA - XB # Euclidean
+    distance[:,0] = np.sqrt(np.sum(aux*aux,axis=1))
+    dot = np.sum(XA*XB,axis=1) # Cosine
+    denom = np.sqrt(np.sum(XA*XA,axis=1)) * np.sqrt(np.sum(XB*XB,axis=1)) # Cosine
+    distance[:,1] = ((1 - (dot / denom))**2)**.25
     return distance
         
-#@njit
-def chessboard_division_njit(Uniquesample, MMtypicality, grid_trad, grid_angl, distancetype):
+class _BoxGridHash(object):
+    '''
+    # Spatial hash of the DA plane means (BOX_miu)
+    #
+    # Boxes are bucketed by the first n_dims coordinates of their mean on a grid
+    # with cell_size side. If cell_size >= grid_trad, every box satisfying
+    # Condition 1 for a sample lies in the sample cell or in one of its
+    # adjacent cells, so only those buckets have to be checked
+    '''
+    def __init__(self, cell_size, n_dims):
+        self.cell_size = cell_size
+        self.n_dims = n_dims
+        self.cells = {}
+        self.keys = {}
+        self.offsets = list(product((-1,0,1), repeat=n_dims))
+
+    def __getstate__(self):
+        '''
+        # The buckets are rebuilt from the boxes when needed, they aren't pickled
+        '''
+        return {'cell_size': self.cell_size, 'n_dims': self.n_dims}
+
+    def __setstate__(self, state):
+        self.__init__(state['cell_size'], state['n_dims'])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def key(self, x):
+        return tuple(math.floor(v / self.cell_size) for v in x[:self.n_dims].tolist())
+
+    def add(self, idx, x):
+        k = self.key(x)
+        self.keys[idx] = k
+        self.cells.setdefault(k, set()).add(idx)
+
+    def move(self, idx, x):
+        '''
+        # Rehash box idx after its mean drifted to x
+        '''
+        k = self.key(x)
+        old = self.keys[idx]
+        if k != old:
+            self.cells[old].discard(idx)
+            if not self.cells[old]:
+                del self.cells[old]
+            self.keys[idx] = k
+            self.cells.setdefault(k, set()).add(idx)
+
+    def candidates(self, x):
+        '''
+        # Sorted indexes of the boxes in the cell of x and in its adjacent cells
+        '''
+        k = self.key(x)
+        SQ = []
+        for off in self.offsets:
+            cell = self.cells.get(tuple(a + b for a, b in zip(k, off)))
+            if cell:
+                SQ.extend(cell)
+        SQ.sort()
+        return np.array(SQ, dtype=np.intp)
+
+    def near(self, indexes, radius):
+        '''
+        # Sorted indexes of the boxes in the cells up to radius away from the
+        # cells of the boxes in indexes, a superset of the boxes closer than
+        # radius (Euclidean) to one of them
+        '''
+        reach = int(math.ceil(radius / self.cell_size))
+        keys = np.array(sorted({self.keys[i] for i in indexes}), dtype=np.int64).reshape(-1, self.n_dims)
+        offsets = np.array(list(product(range(-reach, reach + 1), repeat=self.n_dims)), dtype=np.int64)
+        cells = np.unique((keys[:,None,:] + offsets[None,:,:]).reshape(-1, self.n_dims), axis=0)
+        SQ = []
+        for k in map(tuple, cells.tolist()):
+            cell = self.cells.get(k)
+            if cell:
+                SQ.extend(cell)
+        SQ.sort()
+        return np.array(SQ, dtype=np.intp)
+
+def chessboard_division_njit(Uniquesample, MMtypicality, grid_trad, grid_angl, distancetype, backend='numpy',
+                             grid_hash=True, hash_dims=3, Frequency=None):
     '''
     # Stage 2: DA Plane Projection
+    #
+    # Frequency: np.array, shape (L,)
+    #     Number of samples represented by each unique sample, a unique sample
+    #     counts as Frequency samples in BOX_S, BOX_miu, BOX_X and BOXMT.
+    #     None means every sample counts once
+    # grid_hash: bool
+    #     Each sample is compared only with the boxes found in the neighbouring
+    #     cells of a spatial hash keyed on grid_trad (see _BoxGridHash),
+    #     otherwise it is compared with every box
+    # hash_dims: int
+    #     Number of leading dimensions used by the spatial hash
     '''
     L, WW = Uniquesample.shape
+    if Frequency is None:
+        Frequency = np.ones(L)
+    Frequency = np.asarray(Frequency, dtype=np.float64)
+
+    if _resolve_backend(backend) == 'numba':
+        return _chessboard_division_numba(Uniquesample, MMtypicality, grid_trad, grid_angl, Frequency)
+
     W = 1
     
     contador = 0
@@ -129,46 +322,54 @@ def chessboard_division_njit(Uniquesample, MMtypicality, grid_trad, grid_angl, d
     
     BOX[contador,:] = Uniquesample[0,:]
     BOX_miu[contador,:] = Uniquesample[0,:]
-    BOX_S[contador] = 1
+    BOX_S[contador] = Frequency[0]
     BOX_X[contador] = np.sum(Uniquesample[0]**2)
-    BOXMT[contador] = MMtypicality[0]
+    BOXMT[contador] = Frequency[0]*MMtypicality[0]
     contador += 1
+
+    Hash = None
+    if grid_hash and np.isfinite(grid_trad) and grid_trad > 0:
+        Hash = _BoxGridHash(grid_trad, min(hash_dims, WW))
+        Hash.add(0, BOX_miu[0])
                    
     for i in range(W,L):
         
-        distance = hand_dist(Uniquesample[i].reshape(1,-1),BOX_miu[:contador,:])
+        if Hash is None:
+            SQ = np.arange(contador)
+        else:
+            SQ = Hash.candidates(Uniquesample[i])
+        distance = hand_dist(Uniquesample[i],BOX_miu[SQ,:])
         
-        SQ = []
         # Condition 1
-        for j,d in enumerate(distance):
-            if d[0] < grid_trad and d[1] < grid_angl:
-                SQ.append(j)
+        seq = (distance[:,0] < grid_trad) & (distance[:,1] < grid_angl)
+        SQ = SQ[seq]
+        distance = distance[seq]
         COUNT = len(SQ)
 
         if COUNT == 0:
             BOX[contador,:] = Uniquesample[i]
             BOX_miu[contador,:] = Uniquesample[i] # Eq. 22b
-            BOX_S[contador] = 1 # Eq. 22c
+            BOX_S[contador] = Frequency[i] # Eq. 22c
             BOX_X[contador] = np.sum(Uniquesample[i]**2)
-            BOXMT[contador] = MMtypicality[i] # Eq. 22d
+            BOXMT[contador] = Frequency[i]*MMtypicality[i] # Eq. 22d
             NB = NB + 1 # Eq. 22a
+            if Hash is not None:
+                Hash.add(contador, BOX_miu[contador])
             contador += 1
 
         if COUNT >= 1:
             # If two or more centers satisfies condidition 1, the sample is associated to the nearest 
             # Eq. 20
-            DIS = [distance[S,0]/grid_trad + distance[S,1]/grid_angl for S in SQ] 
-            b = 0
-            mini = DIS[0]
-            for ii in range(1,len(DIS)):
-                if DIS[ii] < mini:
-                    mini = DIS[ii]
-                    b = ii
-
-            BOX_S[SQ[b]] = BOX_S[SQ[b]] + 1 #Eq. 21b
-            BOX_miu[SQ[b]] = (BOX_S[SQ[b]]-1)/BOX_S[SQ[b]]*BOX_miu[SQ[b]] + Uniquesample[i]/BOX_S[SQ[b]] # Eq. 21a
-            BOX_X[SQ[b]] = (BOX_S[SQ[b]]-1)/BOX_S[SQ[b]]*BOX_X[SQ[b]] + np.sum(Uniquesample[i]**2)/BOX_S[SQ[b]]
-            BOXMT[SQ[b]] = BOXMT[SQ[b]] + MMtypicality[i] # Eq. 21c
+            DIS = distance[:,0]/grid_trad + distance[:,1]/grid_angl
+            b = SQ[np.argmin(DIS)]
+
+            F = Frequency[i]
+            BOX_S[b] = BOX_S[b] + F #Eq. 21b
+            BOX_miu[b] = (BOX_S[b]-F)/BOX_S[b]*BOX_miu[b] + F*Uniquesample[i]/BOX_S[b] # Eq. 21a
+            BOX_X[b] = (BOX_S[b]-F)/BOX_S[b]*BOX_X[b] + F*np.sum(Uniquesample[i]**2)/BOX_S[b]
+            BOXMT[b] = BOXMT[b] + F*MMtypicality[i] # Eq. 21c
+            if Hash is not None:
+                Hash.move(b, BOX_miu[b])
 
     BOX_new = BOX[:contador,:]
     BOX_miu_new = BOX_miu[:contador,:]
@@ -177,85 +378,560 @@ def chessboard_division_njit(Uniquesample, MMtypicality, grid_trad, grid_angl, d
     BOXMT_new = BOXMT[:contador]
     return BOX_new, BOX_miu_new, BOX_X_new, BOX_S_new, BOXMT_new, NB
 
-#@njit(fastmath = True)
-def ChessBoard_PeakIdentification_njit(BOX_miu,BOXMT,NB,grid_trad,grid_angl, distancetype):
+def ChessBoard_PeakIdentification_njit(BOX_miu,BOXMT,NB,grid_trad,grid_angl, distancetype, block_size=256, backend='numpy', neighbour_search='kdtree'):
     '''
     # Stage 3: Itendtifying Focal Points
+    #
+    # neighbour_search: 'kdtree' or 'scan'
+    #     'kdtree' queries the DA plane neighbourhood (Condition 2) on a KD-tree
+    #     built over BOX_miu, 'scan' compares every pair of DA planes
     '''
+    if _resolve_backend(backend) == 'numba':
+        peaks = _peak_identification_numba(BOX_miu, BOXMT, grid_trad, grid_angl)
+        return list(BOX_miu[peaks]), int(peaks.sum())
+
+    if neighbour_search == 'kdtree':
+        peaks = _peak_identification_kdtree(BOX_miu, BOXMT, grid_trad, grid_angl)
+        return list(BOX_miu[peaks]), int(peaks.sum())
+
     Centers = []
     n = 2
     ModeNumber = 0
     L, W = BOX_miu.shape
     
-    for i in range(L):
-        distance = hand_dist(BOX_miu[i,:].reshape(1,-1),BOX_miu)
-        seq = []
+    for start in range(0,L,block_size):
+        distance = hand_dist_many(BOX_miu[start:start+block_size,:],BOX_miu,block_size)
         # Condition 2
-        for j,(d1,d2) in enumerate(distance):
-            if d1 < n*grid_trad and d2 < n*grid_angl:
-                seq.append(j)
-        Chessblocak_typicality = [BOXMT[j] for j in seq]
+        seq = (distance[:,:,0] < n*grid_trad) & (distance[:,:,1] < n*grid_angl)
+        Chessblocak_typicality = np.where(seq, BOXMT[None,:], -np.inf)
         # Condition 3
         # Density peak is inside the current DA plane?
-        if max(Chessblocak_typicality) == BOXMT[i]:
-            Centers.append(BOX_miu[i])
+        for i in np.flatnonzero(Chessblocak_typicality.max(axis=1) == BOXMT[start:start+block_size]):
+            Centers.append(BOX_miu[start+i])
             ModeNumber = ModeNumber + 1
     return Centers, ModeNumber
 
-#@njit(fastmath = True)
-def cloud_member_recruitment_njit(ModelNumber,Center_samples,Uniquesample,grid_trad,grid_angl, distancetype):
+def _peak_identification_kdtree(BOX_miu, BOXMT, grid_trad, grid_angl):
+    '''
+    # Stage 3 with a KD-tree neighbourhood query
+    #
+    # Only DA plane pairs closer than n*grid_trad are returned by the tree, the
+    # angular part of Condition 2 is checked afterwards on those pairs
+    # Return: boolean mask of the DA planes that are focal points
+    '''
+    n = 2
+    L, W = BOX_miu.shape
+
+    # Small slack on the radius, the exact (strict) test is done with hand_dist_pairs
+    pairs = cKDTree(BOX_miu).query_pairs(n*grid_trad*(1 + 1e-9), output_type='ndarray')
+    distance = hand_dist_pairs(BOX_miu[pairs[:,0]], BOX_miu[pairs[:,1]])
+    # Condition 2
+    pairs = pairs[(distance[:,0] < n*grid_trad) & (distance[:,1] < n*grid_angl)]
+
+    # Every DA plane belongs to its own neighbourhood
+    self_distance = hand_dist_pairs(BOX_miu, BOX_miu)
+    Chessblocak_typicality = np.where((self_distance[:,0] < n*grid_trad) & (self_distance[:,1] < n*grid_angl), 
+                                      BOXMT, -np.inf)
+    np.maximum.at(Chessblocak_typicality, pairs[:,0], BOXMT[pairs[:,1]])
+    np.maximum.at(Chessblocak_typicality, pairs[:,1], BOXMT[pairs[:,0]])
+    # Condition 3
+    return Chessblocak_typicality == BOXMT
+
+def cloud_member_recruitment_njit(ModelNumber,Center_samples,Uniquesample,grid_trad,grid_angl, distancetype, block_size=256, backend='numpy'):
     '''
     # Stage 4: Forming Data Clouds
     #
     # One data samples is associated to the Data Cloud with the nearest focal point
     #
     '''
+    if _resolve_backend(backend) == 'numba':
+        return _cloud_member_recruitment_numba(Center_samples, Uniquesample)
+
     L, W = Uniquesample.shape
     
     B = np.zeros(L)
-    for ii in range(L):        
-        distance = hand_dist(Uniquesample[ii,:].reshape(1,-1),Center_samples)
+    for start in range(0,L,block_size):
+        distance = hand_dist_many(Uniquesample[start:start+block_size,:],Center_samples,block_size)
         
-        dist3 = np.sum(distance, axis=1)
-        mini = dist3[0]
-        mini_idx = 0
-        for jj in range(1, len(dist3)):
-            # Condition 4
-            if dist3[jj] < mini:
-                mini = dist3[jj]
-                mini_idx = jj
-        B[ii] = mini_idx
+        dist3 = np.sum(distance, axis=2)
+        # Condition 4
+        B[start:start+block_size] = np.argmin(dist3, axis=1)
+    return B
+
+def nearest_focal_point(Center_samples, Samples, tree=None, brute_force=64):
+    '''
+    # Stage 4 for new samples: index of the nearest focal point of each sample
+    #
+    # Same distance (Euclidean + angular term) and tie-breaking as
+    # cloud_member_recruitment_njit, without scanning every focal point:
+    # the angular term is at most sqrt(2), so the distance to the focal point
+    # nearest in Euclidean distance bounds the search, and only focal points
+    # within that Euclidean radius (KD-tree ball query) are compared
+    # tree: cKDTree of Center_samples, built here if None
+    # brute_force: with up to brute_force focal points every focal point is
+    #     compared, cheaper than the KD-tree queries
+    '''
+    Center_samples = np.asarray(Center_samples, dtype=float)
+    Samples = np.atleast_2d(np.asarray(Samples, dtype=float))
+    if Center_samples.shape[0] <= brute_force:
+        return np.argmin(np.sum(hand_dist_many(Samples, Center_samples), axis=2), axis=1)
+    if tree is None:
+        tree = cKDTree(Center_samples)
+
+    _, nearest = tree.query(Samples, k=1)
+    bound = np.sum(hand_dist_pairs(Samples, Center_samples[nearest]), axis=1)
+    # samples without direction (zero vector) are compared with every focal point
+    radius = np.where(np.isfinite(bound), bound*(1 + 1e-9) + 1e-12, np.inf)
+
+    B = np.zeros(Samples.shape[0], dtype=np.intp)
+    for ii, candidates in enumerate(tree.query_ball_point(Samples, radius)):
+        candidates = np.sort(np.asarray(candidates, dtype=np.intp))
+        dist3 = np.sum(hand_dist_many(Samples[ii:ii+1], Center_samples[candidates]), axis=2)[0]
+        # Condition 4
+        B[ii] = candidates[np.argmin(dist3)]
     return B
 
-def SelfOrganisedDirectionAwareDataPartitioning(Input):
+def _box_buffer(view, n, extra, dtype=float):
+    '''
+    # Array holding the n rows of view with room for extra rows
+    #
+    # view is extended in place when it is the first n rows of a larger array
+    # (the buffers of a previous call, or of chessboard_division_njit), else the
+    # rows are copied to a buffer twice as large, so appends cost amortized O(1)
+    '''
+    view = np.asarray(view, dtype=dtype)
+    base = view.base
+    if (type(base) is np.ndarray and base.dtype == view.dtype and base.shape[1:] == view.shape[1:]
+            and base.shape[0] >= n + extra and base.flags.writeable and base.flags.c_contiguous
+            and view.__array_interface__['data'][0] == base.__array_interface__['data'][0]):
+        return base
+    buffer = np.zeros((max(2*n, n + extra),) + view.shape[1:], dtype=dtype)
+    buffer[:n] = view[:n]
+    return buffer
+
+def chessboard_online_division(StreamingData, SystemParams, distancetype, grid_hash=True, hash_dims=3):
+    '''
+    # Stage 2 in evolving mode: DA Plane Projection of streaming samples
+    #
+    # The global statistics (XM, AvM, AvA, L) and the grids are updated
+    # recursively for every new sample, then the sample is associated to an
+    # existing DA plane (Eq. 21) or creates a new one (Eq. 22).
+    #
+    # SystemParams is updated in place and returned: the box arrays are views
+    # of buffers growing geometrically and the _BoxGridHash of the boxes is
+    # kept in SystemParams['Hash'], only new and moved boxes are (re)hashed and
+    # the hash is rebuilt only when grid_trad drifts out of its cell size, so
+    # each sample costs amortized O(1). The boxes changed since the last
+    # online_peak_identification are collected in SystemParams['Changed'].
+    # Return: SystemParams, grid_trad, grid_angl
+    '''
+    L, WW = StreamingData.shape
+    N = SystemParams['GridSize']
+    XM = SystemParams['XM']
+    AvM = np.array(SystemParams['AvM'], dtype=float)
+    AvA = np.array(SystemParams['AvA'], dtype=float)
+    L2 = SystemParams['L']
+    NB = SystemParams['NB']
+
+    BOX = _box_buffer(SystemParams['BOX'], NB, L)
+    BOX_miu = _box_buffer(SystemParams['BOX_miu'], NB, L)
+    BOX_S = _box_buffer(SystemParams['BOX_S'], NB, L)
+    BOX_X = _box_buffer(SystemParams['BOX_X'], NB, L)
+    Changed = SystemParams.get('Changed')
+    if Changed is None:
+        Changed = set()
+
+    Hash = SystemParams.get('Hash') if grid_hash else None
+    if Hash is not None and len(Hash) != NB:
+        # unpickled hash or boxes changed elsewhere, the buckets are rebuilt
+        Hash = None
+    for i in range(L):
+        x = StreamingData[i]
+        L2 = L2 + 1
+        AvM = AvM*(L2-1)/L2 + x/L2
+        xnorm = x / np.sqrt(np.sum(x**2))
+        xnorm[np.isnan(xnorm)] = 1
+        AvA = AvA*(L2-1)/L2 + xnorm/L2
+        XM = XM*(L2-1)/L2 + np.sum(x**2)/L2
+        grid_trad = np.sqrt(2*(XM - np.sum(AvM*AvM)))/N
+        grid_angl = np.sqrt(1 - np.sum(AvA*AvA))/N
+
+        # The hash stays exact while its cells are not smaller than grid_trad,
+        # it is rebuilt with some slack when the grid grows (or shrinks a lot)
+        if grid_hash and np.isfinite(grid_trad) and grid_trad > 0:
+            if Hash is None or grid_trad > Hash.cell_size or grid_trad < Hash.cell_size/4:
+                Hash = _BoxGridHash(1.5*grid_trad, min(hash_dims, WW))
+                for j in range(NB):
+                    Hash.add(j, BOX_miu[j])
+            SQ = Hash.candidates(x)
+        else:
+            Hash = None
+            SQ = np.arange(NB)
+
+        distance = hand_dist(x,BOX_miu[SQ,:])
+        # Condition 1
+        seq = (distance[:,0] < grid_trad) & (distance[:,1] < grid_angl)
+        SQ = SQ[seq]
+        distance = distance[seq]
+
+        if len(SQ) == 0:
+            BOX[NB,:] = x
+            BOX_miu[NB,:] = x # Eq. 22b
+            BOX_S[NB] = 1 # Eq. 22c
+            BOX_X[NB] = np.sum(x**2)
+            if Hash is not None:
+                Hash.add(NB, BOX_miu[NB])
+            Changed.add(NB)
+            NB = NB + 1 # Eq. 22a
+        else:
+            # Eq. 20
+            DIS = distance[:,0]/grid_trad + distance[:,1]/grid_angl
+            b = SQ[np.argmin(DIS)]
+
+            BOX_S[b] = BOX_S[b] + 1 #Eq. 21b
+            BOX_miu[b] = (BOX_S[b]-1)/BOX_S[b]*BOX_miu[b] + x/BOX_S[b] # Eq. 21a
+            BOX_X[b] = (BOX_S[b]-1)/BOX_S[b]*BOX_X[b] + np.sum(x**2)/BOX_S[b]
+            if Hash is not None:
+                Hash.move(b, BOX_miu[b])
+            Changed.add(int(b))
+
+    if L == 0:
+        grid_trad = np.sqrt(2*(XM - np.sum(AvM*AvM)))/N
+        grid_angl = np.sqrt(1 - np.sum(AvA*AvA))/N
+
+    SystemParams.update({'BOX': BOX[:NB],
+                         'BOX_miu': BOX_miu[:NB],
+                         'BOX_X': BOX_X[:NB],
+                         'BOX_S': BOX_S[:NB],
+                         'NB': NB,
+                         'XM': XM,
+                         'L': L2,
+                         'AvM': AvM,
+                         'AvA': AvA,
+                         'GridSize': N,
+                         'Hash': Hash,
+                         'Changed': Changed})
+    return SystemParams, grid_trad, grid_angl
+
+def online_peak_identification(SystemParams, grid_trad, grid_angl, drift=0.05):
+    '''
+    # Stage 3 in evolving mode: Focal Points of the DA planes updated by
+    # chessboard_online_division, with the number of samples per DA plane
+    # (BOX_S) as their density
+    #
+    # The focal point mask is kept in SystemParams['Peaks'] and only the DA
+    # planes near the boxes in SystemParams['Changed'] are checked again
+    # (Conditions 2 and 3 through the grid hash). Every DA plane is checked
+    # (ChessBoard_PeakIdentification_njit) when there is no mask or hash yet,
+    # or when grid_trad or grid_angl drifted by more than drift (relative)
+    # since the last full identification
+    # Return: Centers, ModeNumber
+    '''
+    n = 2
+    NB = SystemParams['NB']
+    BOX_miu = SystemParams['BOX_miu']
+    BOX_S = SystemParams['BOX_S']
+    Peaks = SystemParams.get('Peaks')
+    Hash = SystemParams.get('Hash')
+    Changed = SystemParams.get('Changed') or set()
+    PeakGrid = SystemParams.get('PeakGrid')
+
+    full = (Peaks is None or Hash is None or len(Hash) != NB or PeakGrid is None
+            or abs(grid_trad - PeakGrid[0]) > drift*PeakGrid[0] or abs(grid_angl - PeakGrid[1]) > drift*PeakGrid[1])
+    if full:
+        Peaks = _peak_identification_kdtree(BOX_miu, BOX_S, grid_trad, grid_angl)
+        PeakGrid = (grid_trad, grid_angl)
+    elif Changed:
+        Peaks = _box_buffer(Peaks, Peaks.shape[0], NB - Peaks.shape[0], bool)[:NB]
+        # a changed box moved less than grid_trad, the planes whose neighbourhood
+        # held it before or holds it now are within (n+1)*grid_trad of it, and
+        # their neighbourhoods within (2*n+1)*grid_trad
+        affected = Hash.near(Changed, (n + 1)*grid_trad)
+        sources = Hash.near(Changed, (2*n + 1)*grid_trad)
+        # Small slack on the radius, the exact (strict) test is done with hand_dist_pairs
+        neighbours = cKDTree(BOX_miu[sources]).query_ball_point(BOX_miu[affected], n*grid_trad*(1 + 1e-9))
+        counts = np.array([len(nb) for nb in neighbours], dtype=np.intp)
+        rows = np.repeat(np.arange(affected.shape[0]), counts)
+        cols = sources[np.concatenate(neighbours).astype(np.intp)] if rows.shape[0] else np.empty(0, dtype=np.intp)
+        distance = hand_dist_pairs(BOX_miu[affected[rows]], BOX_miu[cols])
+        # Condition 2
+        seq = (distance[:,0] < n*grid_trad) & (distance[:,1] < n*grid_angl)
+        Chessblocak_typicality = np.full(affected.shape[0], -np.inf)
+        np.maximum.at(Chessblocak_typicality, rows[seq], BOX_S[cols[seq]])
+        # Condition 3
+        Peaks[affected] = Chessblocak_typicality == BOX_S[affected]
+
+    SystemParams.update({'Peaks': Peaks, 'PeakGrid': PeakGrid, 'Changed': set()})
+    return list(BOX_miu[Peaks]), int(Peaks.sum())
+
+# Numba Backend
+#
+# Compiled versions of the SODA stages 2, 3 and 4. They only work over
+# preallocated NumPy arrays (no Python lists), so numba can compile them
+# in nopython mode. Compiled code is cached on disk (cache=True), hence
+# the compilation cost is paid only once per environment.
+
+def _resolve_backend(backend):
+    '''
+    # Return the backend that will actually run
+    # 'numba' falls back to 'numpy' when numba is not installed
+    '''
+    if backend not in BACKENDS:
+        raise ValueError('backend must be one of {}'.format(BACKENDS))
+    if backend == 'numba' and not NUMBA_AVAILABLE:
+        return 'numpy'
+    return backend
+
+if NUMBA_AVAILABLE:
+
+    @njit(cache=True)
+    def _hand_dist_numba(XA, XB, L):
+        '''
+        # Euclidean and Cosine distance between XA and the first L samples of XB
+        '''
+        W = XB.shape[1]
+        distance = np.zeros((L,2))
+        denom_a = 0.
+        for j in range(W):
+            denom_a += XA[j] * XA[j]
+        for i in range(L):
+            aux = 0.
+            dot = 0.
+            denom_b = 0.
+            for j in range(W):
+                aux += (XA[j]-XB[i,j])**2
+                dot += XA[j]*XB[i,j]
+                denom_b += XB[i,j] * XB[i,j]
+            distance[i,0] = aux**.5
+            distance[i,1] = ((1 - ((dot / ((denom_a ** 0.5) * (denom_b ** 0.5)))))**2)**.25
+        return distance
+
+    @njit(cache=True)
+    def _chessboard_division_numba(Uniquesample, MMtypicality, grid_trad, grid_angl, Frequency):
+        L, WW = Uniquesample.shape
+        BOX = np.zeros((L,WW))
+        BOX_miu = np.zeros((L,WW))
+        BOX_S = np.zeros(L)
+        BOX_X = np.zeros(L)
+        BOXMT = np.zeros(L)
+
+        BOX[0,:] = Uniquesample[0,:]
+        BOX_miu[0,:] = Uniquesample[0,:]
+        BOX_S[0] = Frequency[0]
+        BOX_X[0] = np.sum(Uniquesample[0]**2)
+        BOXMT[0] = Frequency[0]*MMtypicality[0]
+        contador = 1
+
+        for i in range(1,L):
+            distance = _hand_dist_numba(Uniquesample[i], BOX_miu, contador)
+            # Condition 1 and Eq. 20
+            b = -1
+            mini = np.inf
+            for j in range(contador):
+                if distance[j,0] < grid_trad and distance[j,1] < grid_angl:
+                    DIS = distance[j,0]/grid_trad + distance[j,1]/grid_angl
+                    if b == -1 or DIS < mini:
+                        mini = DIS
+                        b = j
+
+            if b == -1:
+                BOX[contador,:] = Uniquesample[i]
+                BOX_miu[contador,:] = Uniquesample[i] # Eq. 22b
+                BOX_S[contador] = Frequency[i] # Eq. 22c
+                BOX_X[contador] = np.sum(Uniquesample[i]**2)
+                BOXMT[contador] = Frequency[i]*MMtypicality[i] # Eq. 22d
+                contador += 1
+            else:
+                F = Frequency[i]
+                BOX_S[b] = BOX_S[b] + F #Eq. 21b
+                BOX_miu[b] = (BOX_S[b]-F)/BOX_S[b]*BOX_miu[b] + F*Uniquesample[i]/BOX_S[b] # Eq. 21a
+                BOX_X[b] = (BOX_S[b]-F)/BOX_S[b]*BOX_X[b] + F*np.sum(Uniquesample[i]**2)/BOX_S[b]
+                BOXMT[b] = BOXMT[b] + F*MMtypicality[i] # Eq. 21c
+
+        return (BOX[:contador].copy(), BOX_miu[:contador].copy(), BOX_X[:contador].copy(),
+                BOX_S[:contador].copy(), BOXMT[:contador].copy(), contador)
+
+    @njit(cache=True)
+    def _peak_identification_numba(BOX_miu, BOXMT, grid_trad, grid_angl):
+        n = 2
+        L = BOX_miu.shape[0]
+        peaks = np.zeros(L, dtype=np.bool_)
+        for i in range(L):
+            distance = _hand_dist_numba(BOX_miu[i], BOX_miu, L)
+            # Condition 2
+            maxi = -np.inf
+            for j in range(L):
+                if distance[j,0] < n*grid_trad and distance[j,1] < n*grid_angl:
+                    if BOXMT[j] > maxi:
+                        maxi = BOXMT[j]
+            # Condition 3
+            peaks[i] = maxi == BOXMT[i]
+        return peaks
+
+    @njit(cache=True)
+    def _cloud_member_recruitment_numba(Center_samples, Uniquesample):
+        L = Uniquesample.shape[0]
+        C = Center_samples.shape[0]
+        B = np.zeros(L)
+        for ii in range(L):
+            distance = _hand_dist_numba(Uniquesample[ii], Center_samples, C)
+            # Condition 4
+            mini = distance[0,0] + distance[0,1]
+            mini_idx = 0
+            for jj in range(1, C):
+                dist3 = distance[jj,0] + distance[jj,1]
+                if dist3 < mini:
+                    mini = dist3
+                    mini_idx = jj
+            B[ii] = mini_idx
+        return B
+
+def SelfOrganisedDirectionAwareDataPartitioning(Input, Mode='Offline', backend='numpy', density_dtype=np.float64,
+                                                unique=False, tolerance=None, profiler=None):
+    '''
+    # Self-Organised Direction Aware Data Partitioning
+    #
+    # Mode: 'Offline' or 'Evolving'
+    #     'Offline' partitions Input['StaticData'] from scratch
+    #     'Evolving' absorbs Input['StreamingData'] into Input['SystemParams']
+    #     (the 'SystemParams' of a previous Output, updated in place) without
+    #     revisiting old samples. Focal points are updated from the changed DA
+    #     planes (see online_peak_identification), using the number of samples
+    #     per DA plane (BOX_S) as their density, and 'IDX' is given for the
+    #     streaming samples only
+    # backend: 'numpy' or 'numba'
+    #     'numba' runs stages 2 to 4 compiled, falling back to 'numpy'
+    #     when numba is not installed
+    # density_dtype: float dtype of the global density computation,
+    #     np.float32 halves its memory on large sets
+    # unique: bool, default False
+    #     'Offline' mode works on the unique samples weighted by their
+    #     frequency (see unique_samples), and the labels of the unique samples
+    #     are expanded back to every sample in 'IDX'. When there are no repeated
+    #     samples the data is used as is. With repeated samples the result can
+    #     differ from the original algorithm, so it has to be enabled
+    # tolerance: float
+    #     quantization used by unique_samples, None merges identical samples only
+    # profiler: profiling.Profiler
+    #     records each stage, None disables instrumentation
+    '''
+    if Mode == 'Evolving':
+        return _evolving_soda(Input, backend, profiler)
+    elif Mode != 'Offline':
+        raise ValueError("Mode must be 'Offline' or 'Evolving'")
+
+    Outputs = MultiGranularitySODA(Input, [Input['GridSize']], backend=backend, density_dtype=density_dtype,
+                                   unique=unique, tolerance=tolerance, profiler=profiler)
+    return Outputs[Input['GridSize']]
+
+def MultiGranularitySODA(Input, granularities, backend='numpy', density_dtype=np.float64, unique=False, tolerance=None,
+                         reuse_boxes=False, profiler=None):
+    '''
+    # Offline SODA at several granularities
+    #
+    # Input: same as SelfOrganisedDirectionAwareDataPartitioning, 'GridSize' is not used
+    # granularities: list of granularities (N)
+    # backend, density_dtype, unique, tolerance, profiler: see SelfOrganisedDirectionAwareDataPartitioning
+    # reuse_boxes: bool
+    #     False gives for each granularity the same Output as a single run.
+    #     True divides each coarser grid using the DA planes of the previous finer
+    #     grid, each plane weighted by its number of samples (BOX_S), instead of
+    #     the samples. It is much faster for many granularities but the planes
+    #     are an approximation of a single run, focal points are still recruited
+    #     from the samples
+    #
+    # Stage 1 (grid_set up to the division by N, unique samples and Global
+    # Density) is computed once and shared by every granularity.
+    #
+    # Return: dict, keys = granularities, values = Output of SODA
+    '''
     data = Input['StaticData']
     L, W = data.shape
-    N = Input['GridSize']
     distancetype = Input['DistanceType']
+    if profiler is None:
+        profiler = NULL_PROFILER
 
-    X1, AvD1, AvD2, grid_trad, grid_angl = grid_set(data,N)
-        
-    GD, D1, D2, Uniquesample = Globaldensity_Calculator(data, distancetype)
+    with profiler.stage('grid_set', L):
+        X1, AvD1, AvD2, grid_trad_1, grid_angl_1 = grid_set(data,1)
 
-    BOX,BOX_miu,BOX_X,BOX_S,BOXMT,NB = chessboard_division_njit(Uniquesample,GD,grid_trad,grid_angl, distancetype)
+    Frequency = None
+    if unique:
+        with profiler.stage('unique_samples', L):
+            Unique, Frequency, inverse = unique_samples(data, tolerance)
+        if Unique.shape[0] == L and tolerance is None:
+            Frequency = None
 
-    Center,ModeNumber = ChessBoard_PeakIdentification_njit(BOX_miu,BOXMT,NB,grid_trad,grid_angl, distancetype)
-     
-    IDX = cloud_member_recruitment_njit(ModeNumber,np.array(Center),data,grid_trad,grid_angl, distancetype)
-           
-        
-    Boxparameter = {'BOX': BOX,
-                'BOX_miu': BOX_miu,
-                'BOX_S': BOX_S,
-                'NB': NB,
-                'XM': X1,
-                'L': L,
-                'AvM': AvD1,
-                'AvA': AvD2,
-                'GridSize': N}
+    if Frequency is None:
+        Unique = data
+        with profiler.stage('density', L):
+            GD, D1, D2, Uniquesample, SortedFrequency = Globaldensity_Calculator(data, distancetype, density_dtype)
+    else:
+        with profiler.stage('density', Unique.shape[0]):
+            GD, D1, D2, Uniquesample, SortedFrequency = Globaldensity_Calculator(Unique, distancetype, density_dtype,
+                                                                                 Frequency)
+
+    Outputs = {}
+    Samples, Typicality, Weights = Uniquesample, GD, SortedFrequency
+    for N in sorted(set(granularities), reverse=True):
+        grid_trad = grid_trad_1/N
+        grid_angl = grid_angl_1/N
+
+        with profiler.stage('division', Samples.shape[0]):
+            BOX,BOX_miu,BOX_X,BOX_S,BOXMT,NB = chessboard_division_njit(Samples,Typicality,grid_trad,grid_angl, distancetype, 
+                                                                        backend=backend, Frequency=Weights)
+
+        with profiler.stage('peak_identification', NB):
+            Center,ModeNumber = ChessBoard_PeakIdentification_njit(BOX_miu,BOXMT,NB,grid_trad,grid_angl, distancetype, backend=backend)
+
+        with profiler.stage('recruitment', Unique.shape[0]):
+            IDX = cloud_member_recruitment_njit(ModeNumber,np.array(Center),Unique,grid_trad,grid_angl, distancetype, backend=backend)
+        if Frequency is not None:
+            IDX = IDX[inverse]
+
+        Boxparameter = {'BOX': BOX,
+                    'BOX_miu': BOX_miu,
+                    'BOX_X': BOX_X,
+                    'BOX_S': BOX_S,
+                    'NB': NB,
+                    'XM': X1,
+                    'L': L,
+                    'AvM': AvD1,
+                    'AvA': AvD2,
+                    'GridSize': N}
+
+        Outputs[N] = {'C': Center,
+                      'IDX': list(IDX.astype(int)+1),
+                      'SystemParams': Boxparameter,
+                      'DistanceType': distancetype}
+
+        if reuse_boxes:
+            index = (BOXMT/BOX_S).argsort()[::-1]
+            Samples, Typicality, Weights = BOX_miu[index], (BOXMT/BOX_S)[index], BOX_S[index]
+
+    return {N: Outputs[N] for N in granularities}
+
+def _evolving_soda(Input, backend, profiler=None):
+    '''
+    # Evolving SODA, see SelfOrganisedDirectionAwareDataPartitioning
+    '''
+    data = Input['StreamingData']
+    distancetype = Input['DistanceType']
+    if profiler is None:
+        profiler = NULL_PROFILER
+
+    with profiler.stage('division', data.shape[0]):
+        Boxparameter, grid_trad, grid_angl = chessboard_online_division(data, Input['SystemParams'], distancetype)
+
+    with profiler.stage('peak_identification', len(Boxparameter['Changed'])):
+        Center,ModeNumber = online_peak_identification(Boxparameter, grid_trad, grid_angl)
+
+    with profiler.stage('recruitment', data.shape[0]):
+        # the focal points as an array, without stacking the rows of Center
+        Centers = Boxparameter['BOX_miu'][Boxparameter['Peaks']]
+        IDX = cloud_member_recruitment_njit(ModeNumber,Centers,data,grid_trad,grid_angl, distancetype, backend=backend)
 
     Output = {'C': Center,
               'IDX': list(IDX.astype(int)+1),
               'SystemParams': Boxparameter,
               'DistanceType': distancetype}
-    return Output
\ No newline at end of file
+    return Output
@@ -0,0 +1 @@
+""" Benchmarks for the SODA algorithm and the Lathes model """
@@ -0,0 +1,61 @@
+""" Benchmark for SODA Stage 3 (Focal Points Identification)
+
+Compares the KD-tree neighbourhood query with the all-pairs DA plane scan on
+DA planes built from the synthetic data clouds of the other benchmarks (see
+synthetic.py).
+
+Usage
+-----
+    python -m benchmarks.bench_peak_identification --sizes 1000 5000 20000 --dims 3
+"""
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from SODA import grid_set, Globaldensity_Calculator, ChessBoard_PeakIdentification_njit
+
+from benchmarks.synthetic import make_clouds
+
+
+def make_boxes(n_boxes, n_dims, granularity, seed=0):
+    """ DA plane means and typicalities: samples of make_clouds and their global density, with their grid """
+    data = make_clouds(n_boxes, n_dims, seed=seed)
+    BOXMT, _, _, BOX_miu, _ = Globaldensity_Calculator(data, 'euclidean')
+    _, _, _, grid_trad, grid_angl = grid_set(BOX_miu, granularity)
+    return BOX_miu, BOXMT, grid_trad, grid_angl
+
+
+def time_peak_identification(BOX_miu, BOXMT, grid_trad, grid_angl, neighbour_search, repeat=3):
+    """ Best wall time over repeat runs and the focal points found """
+    best = np.inf
+    for _ in range(repeat):
+        start = perf_counter()
+        Centers, ModeNumber = ChessBoard_PeakIdentification_njit(BOX_miu, BOXMT, BOX_miu.shape[0], grid_trad, grid_angl,
+                                                           'euclidean', neighbour_search=neighbour_search)
+        best = min(best, perf_counter() - start)
+    return best, np.array(Centers).reshape(ModeNumber, -1)
+
+
+def main(sizes, dims, granularity, repeat, seed):
+    print('{:>8} {:>5} {:>12} {:>12} {:>8} {:>8}'.format('boxes', 'dims', 'scan [s]', 'kdtree [s]', 'speedup', 'centers'))
+    for n_dims in dims:
+        for n_boxes in sizes:
+            BOX_miu, BOXMT, grid_trad, grid_angl = make_boxes(n_boxes, n_dims, granularity, seed)
+            t_scan, C_scan = time_peak_identification(BOX_miu, BOXMT, grid_trad, grid_angl, 'scan', repeat)
+            t_tree, C_tree = time_peak_identification(BOX_miu, BOXMT, grid_trad, grid_angl, 'kdtree', repeat)
+            if not np.array_equal(C_scan, C_tree):
+                raise RuntimeError('kdtree and scan found different focal points')
+            print('{:>8} {:>5} {:>12.4f} {:>12.4f} {:>8.1f} {:>8}'.format(n_boxes, n_dims, t_scan, t_tree,
+                                                                          t_scan / t_tree, C_tree.shape[0]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--dims', type=int, nargs='+', default=[3])
+    parser.add_argument('--granularity', type=float, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    main(args.sizes, args.dims, args.granularity, args.repeat, args.seed)
@@ -0,0 +1,86 @@
+""" End-to-end benchmark of LathesModel.fit and LathesModel.predict
+
+Fits and predicts synthetic datasets in the Input layout (see synthetic.py) and
+records the best wall time of fit, predict and each of their stages (see
+profiling.py), with the accuracy on the predicted set.
+
+Usage
+-----
+    python -m benchmarks.bench_pipeline --n-ids 592 --awgn-db 1 3 10 --output pipeline.json
+    python -m benchmarks.bench_pipeline --n-ids 100 --n-measures 300 --baseline pipeline.json
+"""
+import argparse
+import warnings
+
+import numpy as np
+
+from lathes_model import LathesModel
+from profiling import Profiler
+
+from benchmarks.results import add_arguments, best_stage_times, finish
+from benchmarks.synthetic import make_input, make_tensor
+
+
+def make_sets(args, awgn_db):
+    """ Train and test sets, tensors or arrays in the Input layout """
+    sets = []
+    for seed in (args.seed, args.seed + 1):
+        if args.format == 'tensor':
+            sets.append(make_tensor(args.n_ids, args.n_measures, 6, args.worn_fraction, awgn_db, seed))
+        else:
+            data = make_input(args.n_ids, args.n_measures, 6, args.worn_fraction, awgn_db, seed)
+            sets.append((data[:,:-1], data[:,-1]))
+    return sets
+
+
+def time_pipeline(args, awgn_db):
+    """ Best wall time of fit, predict and their stages, and the accuracy of the last repeat """
+    (X_train, y_train), (X_test, y_test) = make_sets(args, awgn_db)
+    target = y_test if args.format == 'tensor' else y_test[::args.n_measures]
+    profilers = []
+    for _ in range(args.repeat):
+        profiler = Profiler(memory=False)
+        model = LathesModel(N_PCs=args.n_pcs, n_jobs=args.n_jobs, granularity=args.granularity, profiler=profiler)
+        model.fit(X_train, y_train)
+        y_pred = model.predict(X_test)
+        model.close()
+        profilers.append(profiler)
+    accuracy = None if y_pred is None else float(np.mean(y_pred == target)*100)
+    return best_stage_times(profilers), accuracy
+
+
+def main(args):
+    warnings.filterwarnings('ignore')
+    cases = []
+    print('{:>8} {:>10} {:>10} {:>12} {:>10} {:>10}'.format('AWGN', 'fit [s]', 'predict', 'extraction', 'soda',
+                                                           'accuracy'))
+    for awgn_db in args.awgn_db:
+        awgn_db = None if awgn_db < 0 else awgn_db
+        metrics, accuracy = time_pipeline(args, awgn_db)
+        params = {'n_ids': args.n_ids, 'n_measures': args.n_measures, 'worn_fraction': args.worn_fraction,
+                  'awgn_db': awgn_db, 'format': args.format, 'N_PCs': args.n_pcs, 'granularity': args.granularity,
+                  'n_jobs': args.n_jobs, 'repeat': args.repeat, 'accuracy': accuracy}
+        name = 'ids={}/measures={}/awgn={}'.format(args.n_ids, args.n_measures, 'none' if awgn_db is None
+                                                   else '{:g}dB'.format(awgn_db))
+        cases.append({'name': name, 'params': params, 'metrics': metrics})
+        print('{:>8} {:>10.3f} {:>10.3f} {:>12.3f} {:>10.3f} {:>10}'.format(
+              'none' if awgn_db is None else '{:g}dB'.format(awgn_db), metrics['fit'], metrics.get('predict', 0),
+              metrics['fit/extraction'], metrics['fit/soda'], 'n/a' if accuracy is None else '{:.1f}'.format(accuracy)))
+    finish(args, 'pipeline', cases)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-ids', type=int, default=200)
+    parser.add_argument('--n-measures', type=int, default=750)
+    parser.add_argument('--worn-fraction', type=float, default=240/592)
+    parser.add_argument('--awgn-db', type=float, nargs='+', default=[-1],
+                        help='signal to noise ratios of the added noise, negative adds no noise')
+    parser.add_argument('--format', choices=['input', 'tensor'], default='input')
+    parser.add_argument('--n-pcs', type=int, default=3)
+    parser.add_argument('--granularity', type=float, default=3)
+    parser.add_argument('--n-jobs', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,89 @@
+""" Latency benchmark for LathesModel.predict_one
+
+Measures the latency of single-measurement predictions. The budget is derived
+from a measured baseline: a first run writes its percentiles (--output), later
+runs fail (exit status 1) when the median or the 99th percentile is slower than
+the baseline by more than the tolerance (--baseline, --tolerance). An absolute
+99th percentile budget can be given too (--budget-ms).
+
+The model and measurements are either given (a model saved with
+LathesModel.save and a LathesDataset) or a model is fitted on synthetic
+measurements in the Input layout (see synthetic.py).
+
+Usage
+-----
+    python -m benchmarks.bench_predict_latency --output latency.json
+    python -m benchmarks.bench_predict_latency --baseline latency.json --tolerance 0.25
+    python -m benchmarks.bench_predict_latency --model models/lathes --dataset Input/Input_1 --budget-ms 50
+"""
+import argparse
+import sys
+import warnings
+from time import perf_counter
+
+import numpy as np
+
+from lathes_model import LathesModel
+from lathes_dataset import LathesDataset
+
+from benchmarks.results import add_arguments, finish
+from benchmarks.synthetic import make_tensor
+
+
+def latency_percentiles(model, X, n_calls, warmup=3):
+    """ predict_one latencies in s: median, 99th percentile and maximum """
+    for i in range(warmup):
+        model.predict_one(X[i % X.shape[0]])
+    latencies = np.empty(n_calls)
+    for i in range(n_calls):
+        start = perf_counter()
+        model.predict_one(X[i % X.shape[0]])
+        latencies[i] = perf_counter() - start
+    return np.percentile(latencies, 50), np.percentile(latencies, 99), latencies.max()
+
+
+def main(args):
+    warnings.filterwarnings('ignore')
+    if args.model is None:
+        X, y = make_tensor(args.n_timeseries, args.n_measures, awgn_db=args.awgn_db, seed=args.seed)
+        model = LathesModel(N_PCs=3, n_jobs=0)
+        model.fit(X, y)
+    else:
+        model = LathesModel.load(args.model)
+        X, _ = make_tensor(args.n_timeseries, model.n_measures_, model.n_sensors_, awgn_db=args.awgn_db,
+                           seed=args.seed)
+
+    if args.dataset is not None:
+        X = LathesDataset(args.dataset).tensor()
+
+    native = len(model.selected_columns_) - (len(model.feature_plan_.fallback_) if model.feature_plan_ is not None
+                                             else len(model.selected_columns_))
+    print('selected features: {} ({} native)'.format(len(model.selected_columns_), native))
+
+    p50, p99, worst = latency_percentiles(model, X, args.n_calls)
+    print('{:>10} {:>10} {:>10}'.format('p50 [ms]', 'p99 [ms]', 'max [ms]'))
+    print('{:>10.2f} {:>10.2f} {:>10.2f}'.format(p50*1000, p99*1000, worst*1000))
+
+    params = {'model': args.model, 'dataset': args.dataset, 'n_timeseries': int(X.shape[0]),
+              'n_measures': int(X.shape[1]), 'features': len(model.selected_columns_), 'native': native,
+              'n_calls': args.n_calls, 'max': worst}
+    name = 'predict_one/{}'.format(args.dataset or args.model or 'synthetic')
+    finish(args, 'predict_latency', [{'name': name, 'params': params, 'metrics': {'p50': p50, 'p99': p99}}])
+
+    if args.budget_ms is not None and p99*1000 > args.budget_ms:
+        sys.exit('p99 latency {:.2f} ms is over the {:.2f} ms budget'.format(p99*1000, args.budget_ms))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default=None, help='directory of a model saved with LathesModel.save')
+    parser.add_argument('--dataset', default=None, help='LathesDataset directory with the measurements to predict')
+    parser.add_argument('--n-timeseries', type=int, default=40)
+    parser.add_argument('--n-measures', type=int, default=300)
+    parser.add_argument('--awgn-db', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--n-calls', type=int, default=200)
+    parser.add_argument('--budget-ms', type=float, default=None, help='absolute budget of the 99th percentile')
+    add_arguments(parser)
+    parser.set_defaults(min_time=1e-4)
+    main(parser.parse_args())
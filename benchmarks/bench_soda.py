@@ -0,0 +1,68 @@
+""" Stage by stage benchmark of SelfOrganisedDirectionAwareDataPartitioning
+
+Sweeps the number of samples (L), the dimensionality and the granularity on
+synthetic data clouds and records the best wall time of each SODA stage
+(grid_set, unique_samples, density, division, peak_identification and
+recruitment, see profiling.py) and of the whole call.
+
+Usage
+-----
+    python -m benchmarks.bench_soda --sizes 1000 5000 --dims 2 3 5 --granularities 3 6 --output soda.json
+    python -m benchmarks.bench_soda --baseline soda.json --tolerance 0.25
+"""
+import argparse
+from time import perf_counter
+
+from SODA import SelfOrganisedDirectionAwareDataPartitioning
+from profiling import Profiler
+
+from benchmarks.results import add_arguments, best_stage_times, finish
+from benchmarks.synthetic import make_clouds
+
+
+def time_soda(data, granularity, backend, repeat, unique=False):
+    """ Best wall time of each stage and of the whole call, and the number of data clouds """
+    Input = {'GridSize': granularity, 'StaticData': data, 'DistanceType': 'euclidean'}
+    profilers, total = [], float('inf')
+    for _ in range(repeat):
+        profiler = Profiler(memory=False)
+        start = perf_counter()
+        Output = SelfOrganisedDirectionAwareDataPartitioning(Input, backend=backend, unique=unique,
+                                                             profiler=profiler)
+        total = min(total, perf_counter() - start)
+        profilers.append(profiler)
+    metrics = best_stage_times(profilers)
+    metrics['total'] = total
+    return metrics, len(Output['C'])
+
+
+def main(args):
+    cases = []
+    print('{:>8} {:>5} {:>5} {:>10} {:>10} {:>10} {:>10} {:>10} {:>7}'.format(
+          'L', 'dims', 'N', 'total [s]', 'density', 'division', 'peaks', 'recruit', 'clouds'))
+    for n_dims in args.dims:
+        for L in args.sizes:
+            data = make_clouds(L, n_dims, seed=args.seed)
+            for granularity in args.granularities:
+                metrics, n_clouds = time_soda(data, granularity, args.backend, args.repeat, args.unique)
+                params = {'L': L, 'dims': n_dims, 'granularity': granularity, 'backend': args.backend, 'unique': args.unique,
+                          'repeat': args.repeat, 'clouds': n_clouds}
+                cases.append({'name': 'L={}/dims={}/N={:g}'.format(L, n_dims, granularity), 'params': params,
+                              'metrics': metrics})
+                print('{:>8} {:>5} {:>5} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f} {:>7}'.format(
+                      L, n_dims, granularity, metrics['total'], metrics.get('density', 0), metrics['division'],
+                      metrics['peak_identification'], metrics['recruitment'], n_clouds))
+    finish(args, 'soda', cases)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--dims', type=int, nargs='+', default=[3])
+    parser.add_argument('--granularities', type=float, nargs='+', default=[3, 6])
+    parser.add_argument('--backend', default='numpy')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--unique', action='store_true', help='run SODA on unique samples weighted by frequency')
+    parser.add_argument('--seed', type=int, default=0)
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,102 @@
+""" Machine-readable benchmark results and regression checks
+
+A results file is JSON:
+
+    {"benchmark": "soda",
+     "environment": {"python": ..., "numpy": ..., "platform": ..., "cpu_count": ...},
+     "cases": [{"name": "L=1000/dims=3/N=3", "params": {...}, "metrics": {"total": 0.12, "density": 0.05, ...}}]}
+
+Metrics are wall times in seconds (best of the repeats). A case regresses when
+a metric is slower than the baseline metric by more than the tolerance, metrics
+under min_time in the baseline are too noisy to be checked.
+"""
+import json
+import os
+import platform
+import sys
+
+import numpy as np
+
+
+def environment():
+    """ Versions and machine the results were measured on """
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count()}
+
+
+def best_stage_times(profilers):
+    """ Minimum over repeats of the total wall time of each stage, profilers is one Profiler per repeat """
+    times = {}
+    for profiler in profilers:
+        for stage, wall_time in profiler.summary()['wall_time'].items():
+            times[stage] = min(times.get(stage, np.inf), float(wall_time))
+    return times
+
+
+def write_results(path, benchmark, cases):
+    """ Write cases (list of dictionaries with 'name', 'params' and 'metrics') to a results file """
+    results = {'benchmark': benchmark, 'environment': environment(), 'cases': cases}
+    with open(str(path), 'w') as f:
+        json.dump(results, f, indent=1)
+    return results
+
+
+def read_results(path):
+    with open(str(path)) as f:
+        return json.load(f)
+
+
+def compare_results(cases, baseline, tolerance=0.25, min_time=1e-3):
+    """Regressions of cases against a baseline results file
+
+    Parameters
+    ----------
+    cases: list
+        cases of the current run
+    baseline: dict
+        results read with 'read_results'
+    tolerance: float, default=0.25
+        allowed relative slowdown
+    min_time: float, default=1e-3
+        baseline metrics faster than min_time seconds are not checked
+
+    Returns
+    -------
+    regressions: list
+        (case, metric, baseline time, current time) of each regression
+    """
+    reference = {case['name']: case['metrics'] for case in baseline['cases']}
+    regressions = []
+    for case in cases:
+        if case['name'] not in reference:
+            continue
+        for metric, base in reference[case['name']].items():
+            current = case['metrics'].get(metric)
+            if current is None or base < min_time:
+                continue
+            if current > base*(1 + tolerance):
+                regressions.append((case['name'], metric, base, current))
+    return regressions
+
+
+def add_arguments(parser):
+    """ Output and regression check arguments shared by the benchmarks """
+    parser.add_argument('--output', default=None, help='results file (JSON) to write')
+    parser.add_argument('--baseline', default=None, help='results file to check regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown over the baseline')
+    parser.add_argument('--min-time', type=float, default=1e-3, help='baseline times under it [s] are not checked')
+
+
+def finish(args, benchmark, cases):
+    """ Write the results and exit with status 1 when a case regresses against the baseline """
+    if args.output is not None:
+        write_results(args.output, benchmark, cases)
+    if args.baseline is None:
+        return
+    regressions = compare_results(cases, read_results(args.baseline), args.tolerance, args.min_time)
+    for name, metric, base, current in regressions:
+        print('REGRESSION {} {}: {:.4f} s -> {:.4f} s ({:+.0f}%)'.format(name, metric, base, current,
+                                                                     (current/base - 1)*100))
+    if regressions:
+        sys.exit('{} regressions over the {:.0f}% tolerance'.format(len(regressions), args.tolerance*100))
+    print('no regressions against {}'.format(args.baseline))
@@ -0,0 +1,95 @@
+""" Synthetic datasets following the Input layout (see Input/README.md)
+
+Each measurement holds the three voltages and currents of the lathe's motor,
+inadequate condition tools (target 1) draw currents with larger amplitude and
+harmonic distortion. AWGN is added at a given signal to noise ratio, like
+Input_2 to Input_6 (1, 3, 5, 7 and 10 dB).
+
+Example
+-------
+    from benchmarks.synthetic import make_input
+    data = make_input(n_ids=592, awgn_db=3)
+    X, y = data[:,:-1], data[:,-1]
+"""
+import numpy as np
+
+# Input_1: 592 measurements, 240 with the inadequate condition tool
+WORN_FRACTION = 240/592
+
+
+def add_awgn(X, snr_db, rng):
+    """ X with white gaussian noise at snr_db, the signal power is taken per timeserie and sensor """
+    power = np.mean(X**2, axis=1, keepdims=True)
+    noise_std = np.sqrt(power / 10**(snr_db/10))
+    return X + rng.normal(size=X.shape) * noise_std
+
+
+def make_tensor(n_ids=592, n_measures=750, n_sensors=6, worn_fraction=WORN_FRACTION, awgn_db=None, seed=0):
+    """Synthetic measurements as a tensor
+
+    Parameters
+    ----------
+    n_ids: int, default=592
+        number of measurements (timeseries)
+    n_measures: int, default=750
+        samples of each timeserie
+    n_sensors: int, default=6
+        the first half of sensors are voltages and the second half currents
+    worn_fraction: float, default=240/592
+        fraction of measurements with target 1, the class balance of Input
+    awgn_db: float, default=None
+        signal to noise ratio in dB of the added white gaussian noise, None adds no noise
+    seed: int, default=0
+
+    Returns
+    -------
+    X: np.array, shape (n_ids, n_measures, n_sensors)
+    target: np.array, shape (n_ids,)
+    """
+    rng = np.random.default_rng(seed)
+    target = np.zeros(n_ids)
+    target[rng.choice(n_ids, int(round(worn_fraction*n_ids)), replace=False)] = 1
+
+    n_voltages = n_sensors - n_sensors//2
+    t = np.linspace(0, 10*np.pi, n_measures)[None,:,None]
+    phases = (np.arange(n_sensors) % n_voltages) * 2*np.pi/n_voltages
+    offset = rng.uniform(0, 2*np.pi, (n_ids,1,1))
+    worn = target[:,None,None]
+
+    X = np.sin(t + phases + offset)
+    currents = (1 + 0.3*worn) * np.sin(t + phases[n_voltages:] + offset - 0.5)
+    currents += 0.15*worn * np.sin(3*(t + phases[n_voltages:] + offset))
+    X[:,:,n_voltages:] = currents
+    X += rng.normal(scale=0.05, size=X.shape)
+
+    if awgn_db is not None:
+        X = add_awgn(X, awgn_db, rng)
+    return X, target
+
+
+def make_input(n_ids=592, n_measures=750, n_sensors=6, worn_fraction=WORN_FRACTION, awgn_db=None, seed=0):
+    """Synthetic measurements in the Input CSV layout
+
+    Parameters are the same as 'make_tensor'.
+
+    Returns
+    -------
+    data: np.array, shape (n_ids*n_measures, n_sensors+3)
+        ID, Time_ID, one column per sensor and Target
+    """
+    X, target = make_tensor(n_ids, n_measures, n_sensors, worn_fraction, awgn_db, seed)
+    data = np.empty((n_ids*n_measures, n_sensors+3))
+    data[:,0] = np.repeat(np.arange(1, n_ids+1), n_measures)
+    data[:,1] = np.tile(np.arange(1, n_measures+1), n_ids)
+    data[:,2:-1] = X.reshape(-1, n_sensors)
+    data[:,-1] = np.repeat(target, n_measures)
+    return data
+
+
+def make_clouds(n_samples, n_dims, n_clouds=8, seed=0):
+    """ Gaussian clouds of different spread, a stand-in for the PCA projection of features given to SODA """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(scale=4, size=(n_clouds, n_dims))
+    spread = rng.uniform(0.3, 1.5, n_clouds)
+    labels = rng.integers(n_clouds, size=n_samples)
+    return centers[labels] + rng.normal(size=(n_samples, n_dims)) * spread[labels,None]
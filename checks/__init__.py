@@ -0,0 +1 @@
+""" Runnable correctness checks for the Lathes model, each exits with status 1 on failure """
@@ -0,0 +1,58 @@
+""" End-to-end check of LathesModel.cross_validate in a process pool
+
+Runs a repeated stratified K-fold on synthetic measurements with n_jobs=2, so
+every fold (TSFRESH selection included) runs inside a pool worker, with the
+default single extraction and with fold_scaling (TSFRESH extraction in the
+workers), and fails (exit status 1) if a fold is missing or wasn't scored.
+
+Usage
+-----
+    python -m checks.check_cross_validate
+    python -m checks.check_cross_validate --n-ids 60 --n-splits 5 --n-repeats 2 --n-jobs 4
+"""
+import argparse
+import sys
+import warnings
+
+from lathes_model import LathesModel
+
+from benchmarks.synthetic import make_tensor
+
+
+def main(args):
+    warnings.filterwarnings('ignore')
+    X, y = make_tensor(args.n_ids, args.n_measures, awgn_db=10, seed=0)
+    model = LathesModel(N_PCs=3, n_jobs=args.n_jobs)
+
+    errors = []
+    for fold_scaling in (False, True):
+        # the default extracts once
+        kwargs = {'fold_scaling': True} if fold_scaling else {}
+        results = model.cross_validate(X, y, n_splits=args.n_splits, n_repeats=args.n_repeats, random_state=0,
+                                       n_jobs=args.n_jobs, **kwargs)
+        print(results.to_string())
+
+        mode = 'fold_scaling={}'.format(fold_scaling)
+        if results.shape[0] != args.n_splits*args.n_repeats:
+            errors.append('{}: {} folds evaluated, {} expected'.format(mode, results.shape[0],
+                                                                       args.n_splits*args.n_repeats))
+        elif 'Accuracy' not in results or results['Accuracy'].isna().any():
+            errors.append('{}: some folds were not scored'.format(mode))
+        elif (results['Fold_Scaling'] != fold_scaling).any():
+            errors.append('{}: wrong Fold_Scaling column'.format(mode))
+        else:
+            print('{}: {} folds, mean accuracy {:.1f}%'.format(mode, results.shape[0], results['Accuracy'].mean()))
+    if model.already_fitted_:
+        errors.append('cross_validate changed the model')
+    if errors:
+        sys.exit('\n'.join(errors))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-ids', type=int, default=40)
+    parser.add_argument('--n-measures', type=int, default=150)
+    parser.add_argument('--n-splits', type=int, default=3)
+    parser.add_argument('--n-repeats', type=int, default=1)
+    parser.add_argument('--n-jobs', type=int, default=2)
+    main(parser.parse_args())
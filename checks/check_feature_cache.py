@@ -0,0 +1,74 @@
+""" Concurrent writers check of FeatureCache
+
+Starts several processes that extract different timeseries into the same
+FeatureCache directory at the same time, as the pool workers of
+LathesModel.grid_search and cross_validate do, and fails (exit status 1) if
+the shared table can't be read or misses the rows of any writer.
+
+Usage
+-----
+    python -m checks.check_feature_cache
+    python -m checks.check_feature_cache --n-writers 8 --n-batches 10
+"""
+import argparse
+import multiprocessing
+import sys
+import tempfile
+import warnings
+
+import numpy as np
+from tsfresh.feature_extraction import MinimalFCParameters
+
+from feature_cache import FeatureCache
+from feature_plan import tensor_to_frame
+
+
+def make_batch(writer, batch, n_timeseries, n_measures):
+    """ Timeseries of a writer's batch, distinct from every other batch """
+    rng = np.random.default_rng([writer, batch])
+    return np.cumsum(rng.normal(size=(n_timeseries, n_measures, 1)), axis=1)
+
+
+def write(path, writer, args, barrier):
+    warnings.filterwarnings('ignore')
+    cache = FeatureCache(path)
+    barrier.wait()
+    for batch in range(args.n_batches):
+        X = tensor_to_frame(make_batch(writer, batch, args.n_timeseries, args.n_measures), ['Sensor_1'])
+        cache.extract(X, default_fc_parameters=MinimalFCParameters(), n_jobs=0)
+
+
+def main(args):
+    path = tempfile.mkdtemp(prefix='feature_cache_check_')
+    barrier = multiprocessing.Barrier(args.n_writers)
+    writers = [multiprocessing.Process(target=write, args=(path, i, args, barrier)) for i in range(args.n_writers)]
+    for p in writers:
+        p.start()
+    for p in writers:
+        p.join()
+    if any(p.exitcode != 0 for p in writers):
+        sys.exit('a writer failed')
+
+    cache = FeatureCache(path)
+    name = cache._table_name('Sensor_1', cache.fc_parameters_key(MinimalFCParameters()))
+    table = cache._load(name)
+    missing = 0
+    for writer in range(args.n_writers):
+        for batch in range(args.n_batches):
+            X = make_batch(writer, batch, args.n_timeseries, args.n_measures)
+            keys = cache.content_keys(X[:,:,0].reshape(-1), np.arange(0, X.size + 1, args.n_measures))
+            missing += int((~np.isin(keys, table.index)).sum())
+    expected = args.n_writers*args.n_batches*args.n_timeseries
+    print('{} writers x {} batches: {} rows in the table, {} expected, {} missing'.format(
+          args.n_writers, args.n_batches, table.shape[0], expected, missing))
+    if missing or table.shape[0] != expected:
+        sys.exit('rows of concurrent writers were lost')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-writers', type=int, default=4)
+    parser.add_argument('--n-batches', type=int, default=5)
+    parser.add_argument('--n-timeseries', type=int, default=5)
+    parser.add_argument('--n-measures', type=int, default=50)
+    main(parser.parse_args())
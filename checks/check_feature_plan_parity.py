@@ -0,0 +1,94 @@
+""" Parity check of CompiledFeaturePlan against TSFRESH
+
+Calculates every feature of ComprehensiveFCParameters with
+CompiledFeaturePlan.transform and with tsfresh.extract_features on random
+walks of several lengths and on degenerate timeseries (constant, all-zero,
+shorter than the calculators' lags and NaN-containing), and fails (exit status
+1) if any feature differs. NaN only matches NaN. TSFRESH rejects timeseries
+with NaN values, transform must reject them too.
+
+Usage
+-----
+    python -m checks.check_feature_plan_parity
+    python -m checks.check_feature_plan_parity --cases constant short --n-timeseries 4
+"""
+import argparse
+import sys
+import warnings
+
+import numpy as np
+import tsfresh
+from tsfresh.feature_extraction import ComprehensiveFCParameters
+
+from feature_plan import CompiledFeaturePlan, tensor_to_frame
+
+
+def make_cases(n_timeseries, seed=0):
+    """ Timeseries of each case, np.array with shape (n_timeseries, n_measures) """
+    rng = np.random.default_rng(seed)
+    cases = {'random_walk_{}'.format(n): np.cumsum(rng.normal(size=(n_timeseries, n)), axis=1)
+             for n in (3, 5, 100, 300)}
+    cases['constant'] = np.repeat(rng.normal(size=(n_timeseries, 1)), 100, axis=1)
+    cases['all_zero'] = np.zeros((n_timeseries, 100))
+    # shorter than most lags (autocorrelation, c3, number_peaks, ...)
+    cases['short'] = rng.normal(size=(n_timeseries, 2))
+    with_nan = np.cumsum(rng.normal(size=(n_timeseries, 100)), axis=1)
+    with_nan[np.arange(n_timeseries), rng.integers(100, size=n_timeseries)] = np.nan
+    cases['nan'] = with_nan
+    return cases
+
+
+def compare(X, rtol, atol, n_jobs):
+    """ Columns of ComprehensiveFCParameters where CompiledFeaturePlan.transform differs from TSFRESH on X
+    If TSFRESH raises ValueError, every column differs unless transform raises it too"""
+    tensor = X[:, :, None]
+    columns = list(tsfresh.extract_features(tensor_to_frame(np.zeros((1, X.shape[1], 1)), ['Sensor_1']),
+                                            column_id='id', column_sort='time',
+                                            default_fc_parameters=ComprehensiveFCParameters(),
+                                            n_jobs=0, disable_progressbar=True).columns)
+    plan = CompiledFeaturePlan(columns, ['Sensor_1'], n_jobs=n_jobs)
+    native = {p for items in plan.native_.values() for p, _ in items}
+
+    try:
+        reference = tsfresh.extract_features(tensor_to_frame(tensor, ['Sensor_1']), column_id='id',
+                                             column_sort='time', default_fc_parameters=ComprehensiveFCParameters(),
+                                             n_jobs=n_jobs, disable_progressbar=True)
+    except ValueError:
+        try:
+            plan.transform(tensor)
+        except ValueError:
+            return [], len(native), len(columns)
+        return columns, len(native), len(columns)
+    features = plan.transform(tensor)
+
+    expected = reference.loc[np.arange(1, X.shape[0] + 1), columns].values.astype(np.float64)
+    match = np.isclose(features, expected, rtol=rtol, atol=atol, equal_nan=True).all(axis=0)
+    return [columns[p] for p in np.flatnonzero(~match)], len(native), len(columns)
+
+
+def main(args):
+    warnings.filterwarnings('ignore')
+    cases = make_cases(args.n_timeseries)
+    failures = 0
+    print('{:>15} {:>9} {:>9} {:>11}'.format('case', 'features', 'native', 'mismatches'))
+    for name in args.cases or cases:
+        mismatches, n_native, n_columns = compare(cases[name], args.rtol, args.atol, args.n_jobs)
+        print('{:>15} {:>9} {:>9} {:>11}'.format(name, n_columns, n_native, len(mismatches)))
+        for column in mismatches[:args.show]:
+            print('    ' + column)
+        failures += len(mismatches)
+    if failures:
+        sys.exit('{} features differ from TSFRESH'.format(failures))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', nargs='+', default=None,
+                        choices=['random_walk_3', 'random_walk_5', 'random_walk_100', 'random_walk_300',
+                                 'constant', 'all_zero', 'short', 'nan'])
+    parser.add_argument('--n-timeseries', type=int, default=8)
+    parser.add_argument('--rtol', type=float, default=1e-6)
+    parser.add_argument('--atol', type=float, default=1e-9)
+    parser.add_argument('--n-jobs', type=int, default=0)
+    parser.add_argument('--show', type=int, default=20, help='mismatching features listed per case')
+    main(parser.parse_args())
@@ -0,0 +1,194 @@
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import numpy as np
+import pandas as pd
+import tsfresh
+from tsfresh.feature_extraction import ComprehensiveFCParameters
+
+
+class FeatureCache(object):
+    """Persistent TSFRESH feature store
+
+    Features are stored per (timeserie content, sensor, fc parameters) and only
+    timeseries that are new or changed are sent to TSFRESH. The content key is a
+    hash of the values presented to the extraction, i.e. after normalization, so
+    a change of the fitted scaler also invalidates the cached features.
+
+    Several processes can share the directory (e.g. the workers of
+    LathesModel.grid_search and cross_validate): new rows are merged into the
+    table on disk under a per table file lock and written through a unique
+    temporary file, so no writer loses the rows of another. Without fcntl
+    (Windows) the tables are still written atomically, but concurrent writers
+    of the same table can drop each other's new rows.
+
+    Parameters
+    ----------
+    path: str or PATH
+        directory where the feature tables are stored, one pickle file per
+        sensor and fc parameters set
+
+    Attributes
+    ----------
+    path_: str
+        directory where the feature tables are stored
+    tables_: dict
+        feature tables already loaded from disk
+        keys = file names
+    hits_: int
+        number of (timeserie, sensor) pairs read from cache
+    misses_: int
+        number of (timeserie, sensor) pairs extracted by TSFRESH
+    """
+    def __init__(self, path):
+        self.path_ = str(path)
+        os.makedirs(self.path_, exist_ok=True)
+        self.tables_ = {}
+        self.hits_ = 0
+        self.misses_ = 0
+
+    def __getstate__(self):
+        """ Loaded tables are not pickled, they are read again from 'path_' when needed """
+        state = self.__dict__.copy()
+        state['tables_'] = {}
+        return state
+
+    @staticmethod
+    def fc_parameters_key(fc_parameters):
+        """ Hash of a TSFRESH fc parameters dictionary """
+        text = json.dumps(fc_parameters, sort_keys=True, default=repr)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    @staticmethod
+    def content_keys(values, bounds):
+        """ Hash of each timeserie of a sensor
+
+        Parameters
+        ----------
+        values: np.array, shape (n_rows,)
+            sensor values sorted by id and time
+        bounds: np.array, shape (n_timeseries+1,)
+            first row of each timeserie followed by n_rows
+        """
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        return [hashlib.sha1(values[bounds[i]:bounds[i+1]].tobytes()).hexdigest() for i in range(len(bounds)-1)]
+
+    def _table_name(self, kind, fc_key):
+        return '{}__{}.pkl'.format(kind, fc_key)
+
+    def _load(self, name):
+        if name not in self.tables_:
+            file = os.path.join(self.path_, name)
+            if os.path.exists(file):
+                with open(file, 'rb') as f:
+                    self.tables_[name] = pickle.load(f)
+            else:
+                self.tables_[name] = None
+        return self.tables_[name]
+
+    @contextmanager
+    def _locked(self, name):
+        """ Exclusive lock of a table between processes, see class description """
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.path_, name + '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _store(self, name, new):
+        """ Merge the rows of new missing in the table on disk and write it, returns the merged table """
+        file = os.path.join(self.path_, name)
+        with self._locked(name):
+            # other processes may have added rows since the table was loaded
+            self.tables_.pop(name, None)
+            table = self._load(name)
+            table = new if table is None else pd.concat((table, new[~new.index.isin(table.index)]))
+            fd, tmp = tempfile.mkstemp(dir=self.path_, prefix=name + '.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, file)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        self.tables_[name] = table
+        return table
+
+    def extract(self, X, default_fc_parameters=None, kind_to_fc_parameters=None, n_jobs=4, distributor=None):
+        """Extract TSFRESH features, reusing cached ones
+
+        Parameters
+        ----------
+        X: pd.DataFrame
+            timeseries in wide format, with 'id', 'time' and one column per sensor
+        default_fc_parameters: dict, default=ComprehensiveFCParameters()
+            features calculated for sensors missing in kind_to_fc_parameters
+        kind_to_fc_parameters: dict, default=None
+            features calculated for each sensor
+            keys = sensor names, only these sensors are extracted
+        n_jobs: int, default=4
+            The number of processes to use for parallelization in tsfresh
+        distributor: tsfresh distributor, default=None
+            passed to tsfresh.extract_features
+
+        Returns
+        -------
+        extracted_features: pd.DataFrame
+            same layout as tsfresh.extract_features
+        """
+        if default_fc_parameters is None:
+            default_fc_parameters = ComprehensiveFCParameters()
+        if kind_to_fc_parameters is None:
+            kinds = [c for c in X.columns if c not in ('id', 'time')]
+        else:
+            kinds = list(kind_to_fc_parameters)
+
+        X = X.sort_values(['id', 'time'])
+        ids, first = np.unique(X['id'].values, return_index=True)
+        bounds = np.append(first, X.shape[0])
+
+        features = []
+        for kind in kinds:
+            if kind_to_fc_parameters is None:
+                fc_parameters = default_fc_parameters
+            else:
+                fc_parameters = kind_to_fc_parameters[kind]
+            name = self._table_name(kind, self.fc_parameters_key(fc_parameters))
+            keys = self.content_keys(X[kind].values, bounds)
+
+            table = self._load(name)
+            if table is None:
+                missing = np.ones(len(keys), dtype=bool)
+            else:
+                missing = ~pd.Index(keys).isin(table.index)
+            self.hits_ += int((~missing).sum())
+            self.misses_ += int(missing.sum())
+
+            if missing.any():
+                rows = X['id'].isin(ids[missing]).values
+                new = tsfresh.extract_features(X.loc[rows, ['id', 'time', kind]], column_id='id', column_sort='time',
+                                               default_fc_parameters=fc_parameters, n_jobs=n_jobs,
+                                               distributor=distributor)
+                new = new.loc[ids[missing]]
+                new.index = pd.Index(keys)[missing]
+                new = new[~new.index.duplicated()]
+                table = self._store(name, new)
+
+            kind_features = table.loc[keys]
+            kind_features.index = pd.Index(ids)
+            features.append(kind_features)
+
+        return pd.concat(features, axis=1)
@@ -0,0 +1,865 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import tsfresh
+from scipy.stats import t as student_t
+from tsfresh.feature_extraction import feature_calculators
+from tsfresh.feature_extraction.settings import from_columns
+from tsfresh.utilities.string_manipulation import get_config_from_string
+
+try:
+    import pywt
+except ImportError:
+    pywt = None
+
+# Native Feature Calculators
+#
+# NumPy versions of TSFRESH feature calculators working on a whole block of
+# timeseries at once. Every calculator receives
+#     X: np.array, shape (n_timeseries, n_measures)
+#         one sensor of every timeseries
+#     configs: list
+#         parameters of each requested feature, [None] for calculators without parameters
+# and returns a np.array with shape (n_timeseries, len(configs)).
+# They follow tsfresh.feature_extraction.feature_calculators, including its
+# special cases (NaN or 0 returned for degenerate timeseries).
+
+
+def _column(values):
+    return np.asarray(values, dtype=float).reshape(-1, 1)
+
+def _shift(X, lag):
+    """ X[:, i+lag] aligned with X[:, i] (same as tsfresh _roll(x, -lag)) """
+    return np.roll(X, -lag, axis=1)
+
+def _simple(f):
+    """ Calculator without parameters """
+    return lambda X, configs: _column(f(X))
+
+def _per_config(f):
+    """ Calculator with parameters, evaluated once per configuration """
+    return lambda X, configs: np.column_stack([f(X, **c) for c in configs]).astype(float)
+
+def _linregress(Y, with_pvalue=True):
+    """ scipy.stats.linregress of each row of Y against range(Y.shape[1]), 'pvalue' is NaN with with_pvalue=False """
+    n = Y.shape[1]
+    x = np.arange(n, dtype=float)
+    xmean = x.mean()
+    ymean = Y.mean(axis=1)
+    ssxm = np.mean((x - xmean)**2)
+    ssxym = np.mean((x - xmean) * (Y - ymean[:, None]), axis=1)
+    ssym = np.mean((Y - ymean[:, None])**2, axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.clip(ssxym / np.sqrt(ssxm * ssym), -1.0, 1.0)
+        r[ssym == 0] = np.where(ssxym[ssym == 0] == 0, np.nan, 0.0)
+        slope = ssxym / ssxm
+        intercept = ymean - slope * xmean
+        if n == 2:
+            pvalue = np.where(Y[:, 0] == Y[:, 1], 1.0, 0.0)
+            stderr = np.zeros_like(slope)
+            intercept_stderr = np.zeros_like(slope)
+        else:
+            df = n - 2
+            TINY = 1.0e-20
+            t = r * np.sqrt(df / ((1.0 - r + TINY) * (1.0 + r + TINY)))
+            pvalue = 2 * student_t.sf(np.abs(t), df) if with_pvalue else np.full_like(slope, np.nan)
+            stderr = np.sqrt((1 - r**2) * ssym / ssxm / df)
+            intercept_stderr = stderr * np.sqrt(ssxm + xmean**2)
+    return {'slope': slope, 'intercept': intercept, 'rvalue': r, 'pvalue': pvalue,
+            'stderr': stderr, 'intercept_stderr': intercept_stderr}
+
+def _mean_second_derivative_central(X):
+    n = X.shape[1]
+    if n <= 2:
+        return np.full(X.shape[0], np.nan)
+    return (X[:, -1] - X[:, -2] - X[:, 1] + X[:, 0]) / (2 * (n - 2))
+
+def _fperr_tolerance(X, power):
+    """ Rounding error bound of the centered moment sums, below it pandas takes the timeserie as constant """
+    return (np.finfo(np.float64).eps * np.abs(X).max(axis=1)) ** power * X.shape[1]
+
+def _skewness(X):
+    """ pandas.Series.skew """
+    n = X.shape[1]
+    if n < 3:
+        return np.full(X.shape[0], np.nan)
+    adjusted = X - X.mean(axis=1, keepdims=True)
+    m2 = (adjusted**2).sum(axis=1)
+    m3 = (adjusted**3).sum(axis=1)
+    m2[np.abs(m2) < _fperr_tolerance(X, 2)] = 0
+    m3[np.abs(m3) < _fperr_tolerance(X, 3)] = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = (n * (n - 1) ** 0.5 / (n - 2)) * (m3 / m2 ** 1.5)
+    result[m2 == 0] = 0
+    return result
+
+def _kurtosis(X):
+    """ pandas.Series.kurtosis """
+    n = X.shape[1]
+    if n < 4:
+        return np.full(X.shape[0], np.nan)
+    adjusted = X - X.mean(axis=1, keepdims=True)
+    adjusted2 = adjusted**2
+    m2 = adjusted2.sum(axis=1)
+    m4 = (adjusted2**2).sum(axis=1)
+    m2[np.abs(m2) < _fperr_tolerance(X, 2)] = 0
+    m4[np.abs(m4) < _fperr_tolerance(X, 4)] = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        adj = 3 * (n - 1) ** 2 / ((n - 2) * (n - 3))
+        numerator = n * (n + 1) * (n - 1) * m4
+        denominator = (n - 2) * (n - 3) * m2**2
+        result = numerator / denominator - adj
+    result[m2 == 0] = 0
+    return result
+
+def _autocorrelation(X, lag):
+    n = X.shape[1]
+    if n < lag:
+        return np.full(X.shape[0], np.nan)
+    x_mean = X.mean(axis=1, keepdims=True)
+    sum_product = np.sum((X[:, :n-lag] - x_mean) * (X[:, lag:] - x_mean), axis=1)
+    v = np.var(X, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = sum_product / ((n - lag) * v)
+    result[np.isclose(v, 0)] = np.nan
+    return result
+
+def _agg_autocorrelation(X, configs):
+    n = X.shape[1]
+    max_maxlag = max(c['maxlag'] for c in configs)
+    var = np.var(X, axis=1)
+    centered = X - X.mean(axis=1, keepdims=True)
+    acf = np.zeros((X.shape[0], max_maxlag))
+    for lag in range(1, min(max_maxlag, n - 1) + 1):
+        acf[:, lag-1] = np.sum(centered[:, :n-lag] * centered[:, lag:], axis=1) / (n - lag)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        acf = acf / (np.sum(centered**2, axis=1) / n)[:, None]
+    acf[(np.abs(var) < 10**-10) | (n == 1)] = 0
+    return np.column_stack([getattr(np, c['f_agg'])(acf[:, :min(int(c['maxlag']), n - 1)], axis=1)
+                            for c in configs])
+
+def _c3(X, lag):
+    n = X.shape[1]
+    if 2 * lag >= n:
+        return np.zeros(X.shape[0])
+    return np.mean((_shift(X, 2 * lag) * _shift(X, lag) * X)[:, :n - 2 * lag], axis=1)
+
+def _time_reversal_asymmetry_statistic(X, lag):
+    n = X.shape[1]
+    if 2 * lag >= n:
+        return np.zeros(X.shape[0])
+    one_lag = _shift(X, lag)
+    two_lag = _shift(X, 2 * lag)
+    return np.mean((two_lag * two_lag * one_lag - one_lag * X * X)[:, :n - 2 * lag], axis=1)
+
+def _cid_ce(X, normalize):
+    if normalize:
+        s = np.std(X, axis=1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            X = (X - np.mean(X, axis=1, keepdims=True)) / s
+    dX = np.diff(X, axis=1)
+    result = np.sqrt(np.einsum('ij,ij->i', dX, dX))
+    if normalize:
+        result[s[:, 0] == 0] = 0.0
+    return result
+
+def _change_quantiles(X, configs):
+    div = np.diff(X, axis=1)
+    qs = sorted({c['ql'] for c in configs} | {c['qh'] for c in configs})
+    bounds = dict(zip(qs, np.quantile(X, qs, axis=1)))
+    pairs = sorted({(c['ql'], c['qh']) for c in configs if c['ql'] < c['qh']})
+    result = np.zeros((X.shape[0], len(configs)))
+    if not pairs:
+        return result
+    # corridor masks of every (ql, qh) pair, shape (n_pairs, n_timeseries, n_measures - 1)
+    low = np.stack([bounds[ql] for ql, _ in pairs])[:, :, None]
+    high = np.stack([bounds[qh] for _, qh in pairs])[:, :, None]
+    inside = (X >= low) & (X <= high)
+    corridors = inside[:, :, 1:] & inside[:, :, :-1]
+    counts = corridors.sum(axis=2)
+    # result 0 for an empty corridor and for repeated bin edges (pandas.qcut fails on them)
+    zero = (counts == 0) | (low[:, :, 0] == high[:, :, 0])
+    index = {pair: k for k, pair in enumerate(pairs)}
+    # mean and variance of the changes in each corridor, as np.nanmean and np.nanvar,
+    # indexed by (f_agg, isabs, pair)
+    values = (div, np.abs(div))
+    aggregated = np.empty((2, 2) + counts.shape)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for a, v in enumerate(values):
+            aggregated[0, a] = np.where(corridors, v, 0.0).sum(axis=2) / counts
+            deviations = np.where(corridors, v - aggregated[0, a][:, :, None], 0.0)
+            aggregated[1, a] = np.einsum('kij,kij->ki', deviations, deviations) / counts
+    aggregated[:, :, zero] = 0.0
+    columns, keys = [], []
+    for j, c in enumerate(configs):
+        if c['ql'] >= c['qh']:
+            continue
+        k = index[c['ql'], c['qh']]
+        if c['f_agg'] in ('mean', 'var'):
+            columns.append(j)
+            keys.append((('mean', 'var').index(c['f_agg']), int(c['isabs']), k))
+        else:
+            masked = np.where(corridors[k], values[int(c['isabs'])], np.nan)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result[:, j] = getattr(np, 'nan' + c['f_agg'])(masked, axis=1)
+            result[zero[k], j] = 0.0
+    if columns:
+        result[:, columns] = aggregated[tuple(np.transpose(keys))].T
+    return result
+
+def _template_distances(x, m):
+    """ Chebyshev distance between every pair of the len(x)-m+1 templates x[i:i+m] """
+    L = x.shape[0] - m + 1
+    D = np.abs(x[:L, None] - x[None, :L])
+    for k in range(1, m):
+        np.maximum(D, np.abs(x[k:k+L, None] - x[None, k:k+L]), out=D)
+    return D
+
+def _approximate_entropy(X, configs):
+    n = X.shape[1]
+    result = np.zeros((X.shape[0], len(configs)))
+    for i, x in enumerate(X):
+        std = np.std(x)
+        for m in {c['m'] for c in configs}:
+            if n <= m + 1:
+                continue
+            D = _template_distances(x, m)
+            D1 = np.maximum(D[:-1, :-1], np.abs(x[m:, None] - x[None, m:]))
+            for j, c in enumerate(configs):
+                if c['m'] != m:
+                    continue
+                r = c['r'] * std
+                phi = [np.sum(np.log(np.sum(d <= r, axis=0) / d.shape[0])) / (d.shape[0] + 0.0) for d in (D, D1)]
+                result[i, j] = np.abs(phi[0] - phi[1])
+    return result
+
+def _sample_entropy(X):
+    result = np.empty(X.shape[0])
+    for i, x in enumerate(X):
+        if np.isnan(x).any():
+            result[i] = np.nan
+            continue
+        tolerance = 0.2 * np.std(x)
+        D = _template_distances(x, 2)
+        B = np.sum(D <= tolerance) - D.shape[0]
+        D1 = _template_distances(x, 3)
+        A = np.sum(D1 <= tolerance) - D1.shape[0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result[i] = -np.log(A / B)
+    return result
+
+def _energy_ratio_by_chunks(X, num_segments, segment_focus):
+    n = X.shape[1]
+    full_series_energy = np.sum(X**2, axis=1)
+    size, extra = divmod(n, num_segments)
+    start = segment_focus * size + min(segment_focus, extra)
+    stop = start + size + (1 if segment_focus < extra else 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.sum(X[:, start:stop] ** 2.0, axis=1) / full_series_energy
+    result[full_series_energy == 0] = np.nan
+    return result
+
+def _index_mass_quantile(X, configs):
+    abs_x = np.abs(X)
+    s = np.sum(abs_x, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mass_centralized = np.cumsum(abs_x, axis=1) / s
+    result = np.column_stack([(np.argmax(mass_centralized >= c['q'], axis=1) + 1) / X.shape[1]
+                              for c in configs]).astype(float)
+    result[s[:, 0] == 0] = np.nan
+    return result
+
+def _fft_coefficient(X, configs):
+    fft = np.fft.rfft(X, axis=1)
+    result = np.full((X.shape[0], len(configs)), np.nan)
+    for j, c in enumerate(configs):
+        if c['coeff'] < fft.shape[1]:
+            value = fft[:, c['coeff']]
+            if c['attr'] == 'real':
+                result[:, j] = value.real
+            elif c['attr'] == 'imag':
+                result[:, j] = value.imag
+            elif c['attr'] == 'abs':
+                result[:, j] = np.abs(value)
+            else:
+                result[:, j] = np.angle(value, deg=True)
+    return result
+
+def _fft_aggregated(X, configs):
+    fft_abs = np.abs(np.fft.rfft(X, axis=1))
+    index = np.arange(fft_abs.shape[1], dtype=float)
+    total = fft_abs.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        moment = {m: fft_abs.dot(index ** m) / total for m in (1, 2, 3, 4)}
+        centroid = moment[1]
+        variance = moment[2] - centroid ** 2
+        skew = (moment[3] - 3 * centroid * variance - centroid ** 3) / variance ** 1.5
+        kurtosis = (moment[4] - 4 * centroid * moment[3] + 6 * moment[2] * centroid ** 2 - 3 * centroid) / variance ** 2
+    skew[variance < 0.5] = np.nan
+    kurtosis[variance < 0.5] = np.nan
+    aggregated = {'centroid': centroid, 'variance': variance, 'skew': skew, 'kurtosis': kurtosis}
+    return np.column_stack([aggregated[c['aggtype']] for c in configs])
+
+def _aggregate_on_chunks(X, f_agg, chunk_len):
+    n = X.shape[1]
+    n_full = n // chunk_len
+    full = getattr(np, f_agg)(X[:, :n_full * chunk_len].reshape(X.shape[0], n_full, chunk_len), axis=2)
+    if n_full * chunk_len < n:
+        last = getattr(np, f_agg)(X[:, n_full * chunk_len:], axis=1)
+        full = np.column_stack((full, last))
+    return full
+
+def _agg_linear_trend(X, configs):
+    n = X.shape[0]
+    result = np.full((n, len(configs)), np.nan)
+    for chunk_len in sorted({c['chunk_len'] for c in configs if c['chunk_len'] < X.shape[1]}):
+        # one regression over the aggregates of every f_agg with this chunk length
+        f_aggs = sorted({c['f_agg'] for c in configs if c['chunk_len'] == chunk_len})
+        with_pvalue = any(c['attr'] == 'pvalue' for c in configs if c['chunk_len'] == chunk_len)
+        lin_reg = _linregress(np.concatenate([_aggregate_on_chunks(X, f_agg, chunk_len) for f_agg in f_aggs]),
+                              with_pvalue)
+        for j, c in enumerate(configs):
+            if c['chunk_len'] == chunk_len:
+                k = f_aggs.index(c['f_agg'])
+                result[:, j] = lin_reg[c['attr']][k * n:(k + 1) * n]
+    return result
+
+def _linear_trend(X, configs):
+    lin_reg = _linregress(X, any(c['attr'] == 'pvalue' for c in configs))
+    return np.column_stack([lin_reg[c['attr']] for c in configs])
+
+def _number_peaks(X, n):
+    x_reduced = X[:, n:-n]
+    res = np.ones(x_reduced.shape, dtype=bool)
+    for i in range(1, n + 1):
+        res &= x_reduced > np.roll(X, i, axis=1)[:, n:-n]
+        res &= x_reduced > np.roll(X, -i, axis=1)[:, n:-n]
+    return np.sum(res, axis=1)
+
+def _mean_n_absolute_max(X, number_of_maxima):
+    if X.shape[1] <= number_of_maxima:
+        return np.full(X.shape[0], np.nan)
+    return np.mean(np.sort(np.abs(X), axis=1)[:, -number_of_maxima:], axis=1)
+
+def _welch(X):
+    """ scipy.signal.welch(X, nperseg=min(n_measures, 256), axis=1) power spectral density """
+    n = X.shape[1]
+    nperseg = min(n, 256)
+    step = nperseg - nperseg // 2
+    # periodic Hann window, scipy uses a window of ones for a single sample
+    window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(nperseg) / nperseg) if nperseg > 1 else np.ones(1)
+    starts = np.arange(0, n - nperseg + 1, step)
+    segments = X[:, starts[:, None] + np.arange(nperseg)]
+    spectrum = np.fft.rfft((segments - segments.mean(axis=2, keepdims=True)) * window, axis=2)
+    pxx = np.mean(spectrum.real**2 + spectrum.imag**2, axis=1) / np.sum(window**2)
+    # one-sided density, the Nyquist bin of an even segment is not doubled
+    pxx[:, 1:(nperseg + 1) // 2] *= 2
+    return pxx
+
+def _spkt_welch_density(X, configs):
+    pxx = _welch(X)
+    result = np.full((X.shape[0], len(configs)), np.nan)
+    for j, c in enumerate(configs):
+        if c['coeff'] < pxx.shape[1]:
+            result[:, j] = pxx[:, c['coeff']]
+    return result
+
+def _cwt_coefficients(X, configs):
+    calculated_cwt = {}
+    result = np.full((X.shape[0], len(configs)), np.nan)
+    for j, c in enumerate(configs):
+        widths = tuple(c['widths'])
+        if widths not in calculated_cwt:
+            calculated_cwt[widths], _ = pywt.cwt(X, scales=widths, wavelet='mexh', axis=1)
+        if c['coeff'] < X.shape[1]:
+            result[:, j] = calculated_cwt[widths][widths.index(c['w']), :, c['coeff']]
+    return result
+
+def _symmetry_looking(X, configs):
+    mean_median_difference = np.abs(np.mean(X, axis=1) - np.median(X, axis=1))
+    max_min_difference = np.max(X, axis=1) - np.min(X, axis=1)
+    return np.column_stack([mean_median_difference < (c['r'] * max_min_difference) for c in configs]).astype(float)
+
+def _binned_entropy_rows(X, max_bins):
+    result = np.empty(X.shape[0])
+    for i, x in enumerate(X):
+        if np.isnan(x).any():
+            result[i] = np.nan
+            continue
+        hist, _ = np.histogram(x, bins=max_bins)
+        probs = hist / x.size
+        probs[probs == 0] = 1.0
+        result[i] = -np.sum(probs * np.log(probs))
+    return result
+
+def _fourier_entropy(X, configs):
+    pxx = _welch(X)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pxx = pxx / np.max(pxx, axis=1, keepdims=True)
+    return np.column_stack([_binned_entropy_rows(pxx, c['bins']) for c in configs])
+
+def _permutation_entropy(X, tau, dimension):
+    n_shifts = (X.shape[1] - dimension) // tau + 1
+    if n_shifts <= 0:
+        return np.full(X.shape[0], np.nan)
+    indexer = np.arange(dimension)[None, :] + tau * np.arange(n_shifts)[:, None]
+    permutations = np.argsort(np.argsort(X[:, indexer], axis=2), axis=2)
+    codes = permutations.dot(dimension ** np.arange(dimension))
+    rows = np.repeat(np.arange(X.shape[0]), n_shifts)
+    # one integer per (row, pattern), np.unique of a 1d array is much faster than with axis=0
+    _, row_of_pattern, counts = np.unique(rows * dimension**dimension + codes.ravel(),
+                                          return_index=True, return_counts=True)
+    probs = counts / n_shifts
+    return np.bincount(rows[row_of_pattern], weights=-probs * np.log(probs), minlength=X.shape[0])
+
+def _friedrich_coefficients(x, m, r):
+    """ Polynomial fit of the mean step against the mean value of r quantile bins (pandas.qcut in tsfresh) """
+    signal, delta = x[:-1], np.diff(x)
+    bins = np.percentile(signal, np.linspace(0, 1, r + 1) * 100)
+    if np.isnan(bins).any() or (len(bins) != 2 and np.unique(bins).shape[0] < len(bins)):
+        return np.full(m + 1, np.nan)
+    ids = np.searchsorted(bins, signal, side='left')
+    ids[signal == bins[0]] = 1
+    counts = np.bincount(ids, minlength=r + 1)[1:]
+    filled = counts > 0
+    x_mean = np.bincount(ids, weights=signal, minlength=r + 1)[1:][filled] / counts[filled]
+    y_mean = np.bincount(ids, weights=delta, minlength=r + 1)[1:][filled] / counts[filled]
+    try:
+        return np.polyfit(x_mean, y_mean, deg=m)
+    except (np.linalg.LinAlgError, ValueError):
+        return np.full(m + 1, np.nan)
+
+def _friedrich(X, configs):
+    result = np.empty((X.shape[0], len(configs)))
+    for i, x in enumerate(X):
+        coefficients = {}
+        for j, c in enumerate(configs):
+            if (c['m'], c['r']) not in coefficients:
+                coefficients[c['m'], c['r']] = _friedrich_coefficients(x, c['m'], c['r'])
+            coeff = coefficients[c['m'], c['r']]
+            result[i, j] = coeff[c['coeff']] if c['coeff'] < len(coeff) else np.nan
+    return result
+
+def _max_langevin_fixed_point(X, configs):
+    result = np.empty((X.shape[0], len(configs)))
+    for i, x in enumerate(X):
+        for j, c in enumerate(configs):
+            try:
+                result[i, j] = np.max(np.real(np.roots(_friedrich_coefficients(x, c['m'], c['r']))))
+            except (np.linalg.LinAlgError, ValueError):
+                result[i, j] = np.nan
+    return result
+
+def _ar_coefficient(X, configs):
+    """ Least squares fit of AutoReg(x, lags=k, trend='c') with the pseudo-inverse, as statsmodels """
+    n = X.shape[1]
+    calculated_ar_params = {}
+    result = np.empty((X.shape[0], len(configs)))
+    for j, c in enumerate(configs):
+        k, p = c['k'], c['coeff']
+        if k not in calculated_ar_params:
+            if n < 2 * k + 1:
+                # AutoReg raises ValueError, tsfresh keeps k NaN parameters
+                calculated_ar_params[k] = np.full((X.shape[0], k), np.nan)
+            else:
+                design = np.stack([np.ones((X.shape[0], n - k))] + [X[:, k - i:n - i] for i in range(1, k + 1)], axis=2)
+                calculated_ar_params[k] = np.einsum('rij,rj->ri', np.linalg.pinv(design, rcond=1e-15), X[:, k:])
+        params = calculated_ar_params[k]
+        if p > k:
+            result[:, j] = np.nan
+        else:
+            result[:, j] = params[:, p] if p < params.shape[1] else 0.0
+    return result
+
+def _lempel_ziv_complexity(X, bins):
+    result = np.empty(X.shape[0])
+    n = X.shape[1]
+    for i, x in enumerate(X):
+        edges = np.linspace(np.min(x), np.max(x), bins + 1)[1:]
+        # 4 bytes per symbol, byte strings are faster to slice and hash than tuples
+        sequence = np.searchsorted(edges, x, side='left').astype(np.int32).tobytes()
+        sub_strings = set()
+        ind, inc = 0, 1
+        while ind + inc <= n:
+            sub_str = sequence[4*ind:4*(ind + inc)]
+            if sub_str in sub_strings:
+                inc += 1
+            else:
+                sub_strings.add(sub_str)
+                ind += inc
+                inc = 1
+        result[i] = len(sub_strings) / n
+    return result
+
+def _benford_correlation(X):
+    # first digit of the shortest repr of each value, as np.format_float_scientific gives it,
+    # the division by a power of 10 is only trusted away from a digit boundary, values close
+    # to one are formatted (0.3 / 10**-1 is 2.99...)
+    X = np.abs(np.nan_to_num(X))
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        mantissa = X / 10.0**np.floor(np.log10(X))
+    first = np.floor(mantissa)
+    exact = np.isfinite(mantissa) & (np.abs(mantissa - np.round(mantissa)) > 1e-9)
+    first[X == 0] = 0
+    for i in zip(*np.nonzero(~exact & (X != 0))):
+        first[i] = int(np.format_float_scientific(X[i])[0])
+    distribution = np.stack([np.mean(first == d, axis=1) for d in range(1, 10)], axis=1)
+    benford = np.log10(1 + 1 / np.arange(1, 10))
+    # np.corrcoef of each row with the Benford distribution
+    data = distribution - distribution.mean(axis=1, keepdims=True)
+    benford = benford - benford.mean()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = data @ benford / np.sqrt(np.sum(data**2, axis=1) * np.sum(benford**2))
+    return np.clip(r, -1.0, 1.0)
+
+def _has_duplicate(X):
+    S = np.sort(X, axis=1)
+    return np.any(S[:, 1:] == S[:, :-1], axis=1)
+
+def _variation_coefficient(X):
+    avg = np.mean(X, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.std(X, axis=1) / avg
+    result[avg == 0] = np.nan
+    return result
+
+def _value_count(X, value):
+    if np.isnan(value):
+        return np.isnan(X).sum(axis=1)
+    return np.sum(X == value, axis=1)
+
+NATIVE_CALCULATORS = {
+    'mean': _simple(lambda X: np.mean(X, axis=1)),
+    'median': _simple(lambda X: np.median(X, axis=1)),
+    'sum_values': _simple(lambda X: np.sum(X, axis=1)),
+    'length': _simple(lambda X: np.full(X.shape[0], X.shape[1])),
+    'standard_deviation': _simple(lambda X: np.std(X, axis=1)),
+    'variance': _simple(lambda X: np.var(X, axis=1)),
+    'root_mean_square': _simple(lambda X: np.sqrt(np.mean(np.square(X), axis=1))),
+    'maximum': _simple(lambda X: np.max(X, axis=1)),
+    'minimum': _simple(lambda X: np.min(X, axis=1)),
+    'absolute_maximum': _simple(lambda X: np.max(np.abs(X), axis=1)),
+    'abs_energy': _simple(lambda X: np.einsum('ij,ij->i', X, X)),
+    'mean_abs_change': _simple(lambda X: np.mean(np.abs(np.diff(X, axis=1)), axis=1)),
+    'absolute_sum_of_changes': _simple(lambda X: np.sum(np.abs(np.diff(X, axis=1)), axis=1)),
+    'mean_change': _simple(lambda X: (X[:, -1] - X[:, 0]) / (X.shape[1] - 1)),
+    'mean_second_derivative_central': _simple(_mean_second_derivative_central),
+    'variation_coefficient': _simple(_variation_coefficient),
+    'skewness': _simple(_skewness),
+    'kurtosis': _simple(_kurtosis),
+    'count_above_mean': _simple(lambda X: np.sum(X > X.mean(axis=1, keepdims=True), axis=1)),
+    'count_below_mean': _simple(lambda X: np.sum(X < X.mean(axis=1, keepdims=True), axis=1)),
+    'first_location_of_maximum': _simple(lambda X: np.argmax(X, axis=1) / X.shape[1]),
+    'last_location_of_maximum': _simple(lambda X: 1.0 - np.argmax(X[:, ::-1], axis=1) / X.shape[1]),
+    'first_location_of_minimum': _simple(lambda X: np.argmin(X, axis=1) / X.shape[1]),
+    'last_location_of_minimum': _simple(lambda X: 1.0 - np.argmin(X[:, ::-1], axis=1) / X.shape[1]),
+    'has_duplicate': _simple(_has_duplicate),
+    'benford_correlation': _simple(_benford_correlation),
+    'has_duplicate_max': _simple(lambda X: np.sum(X == X.max(axis=1, keepdims=True), axis=1) >= 2),
+    'has_duplicate_min': _simple(lambda X: np.sum(X == X.min(axis=1, keepdims=True), axis=1) >= 2),
+    'variance_larger_than_standard_deviation': _simple(lambda X: np.var(X, axis=1) > np.sqrt(np.var(X, axis=1))),
+    'quantile': lambda X, configs: np.quantile(X, [c['q'] for c in configs], axis=1).T,
+    'autocorrelation': _per_config(_autocorrelation),
+    'agg_autocorrelation': _agg_autocorrelation,
+    'c3': _per_config(_c3),
+    'time_reversal_asymmetry_statistic': _per_config(_time_reversal_asymmetry_statistic),
+    'cid_ce': _per_config(_cid_ce),
+    'change_quantiles': _change_quantiles,
+    'approximate_entropy': _approximate_entropy,
+    'sample_entropy': _simple(_sample_entropy),
+    'energy_ratio_by_chunks': _per_config(_energy_ratio_by_chunks),
+    'index_mass_quantile': _index_mass_quantile,
+    'fft_coefficient': _fft_coefficient,
+    'fft_aggregated': _fft_aggregated,
+    'agg_linear_trend': _agg_linear_trend,
+    'linear_trend': _linear_trend,
+    'number_peaks': _per_config(_number_peaks),
+    'number_crossing_m': _per_config(lambda X, m: np.sum(np.diff(X > m, axis=1), axis=1)),
+    'mean_n_absolute_max': _per_config(_mean_n_absolute_max),
+    'ratio_beyond_r_sigma': _per_config(lambda X, r: np.sum(np.abs(X - X.mean(axis=1, keepdims=True)) >
+                                                            r * X.std(axis=1, keepdims=True), axis=1) / X.shape[1]),
+    'large_standard_deviation': _per_config(lambda X, r: np.std(X, axis=1) > (r * (np.max(X, axis=1) - np.min(X, axis=1)))),
+    'symmetry_looking': _symmetry_looking,
+    'count_above': _per_config(lambda X, t: np.sum(X >= t, axis=1) / X.shape[1]),
+    'count_below': _per_config(lambda X, t: np.sum(X <= t, axis=1) / X.shape[1]),
+    'range_count': _per_config(lambda X, min, max: np.sum((X >= min) & (X < max), axis=1)),
+    'value_count': _per_config(_value_count),
+    'spkt_welch_density': _spkt_welch_density,
+    'binned_entropy': _per_config(_binned_entropy_rows),
+    'fourier_entropy': _fourier_entropy,
+    'permutation_entropy': _per_config(_permutation_entropy),
+    'friedrich_coefficients': _friedrich,
+    'max_langevin_fixed_point': _max_langevin_fixed_point,
+    'lempel_ziv_complexity': _per_config(_lempel_ziv_complexity),
+    'ar_coefficient': _ar_coefficient,
+}
+if pywt is not None:
+    NATIVE_CALCULATORS['cwt_coefficients'] = _cwt_coefficients
+
+
+def _direct(func):
+    """ TSFRESH calculator called on each timeserie, without the DataFrame round trip of tsfresh.extract_features """
+    def calculator(X, configs):
+        out = np.empty((X.shape[0], len(configs)))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for i, x in enumerate(X):
+                x = np.ascontiguousarray(x)
+                if getattr(func, 'fctype', None) == 'combiner':
+                    out[i] = [value for _, value in func(x, param=configs)]
+                elif configs == [None]:
+                    out[i] = func(x)
+                else:
+                    out[i] = [func(x, **c) for c in configs]
+        return out
+    return calculator
+
+def _calculator(name):
+    """ Calculator of a TSFRESH feature, None if it needs the pandas index (tsfresh fallback) """
+    if name in NATIVE_CALCULATORS:
+        return NATIVE_CALCULATORS[name]
+    func = getattr(feature_calculators, name, None)
+    if func is None or getattr(func, 'input', None) == 'pd.Series':
+        return None
+    return _direct(func)
+
+
+def tensor_to_frame(X, columns, ids=None):
+    """TSFRESH long format of a timeseries array
+
+    Parameters
+    ----------
+    X: np.array, shape (n_timeseries, n_measures, n_sensors)
+    columns: list
+        sensor names
+    ids: np.array, shape (n_timeseries,), default=None
+        timeseries ids, 1 to n_timeseries if None
+
+    Returns
+    -------
+    df: pd.DataFrame
+        'id', 'time' (1 to n_measures) and one column per sensor
+    """
+    n_timeseries, n_measures, n_sensors = X.shape
+    if ids is None:
+        ids = np.arange(1, n_timeseries + 1)
+    df = pd.DataFrame(X.reshape(-1, n_sensors), columns=columns)
+    df.insert(0, 'time', np.tile(np.arange(1, n_measures + 1), n_timeseries))
+    df.insert(0, 'id', np.repeat(ids, n_measures))
+    return df
+
+
+def impute_values(features):
+    """Fill values of impute_array, calculated on finite values of each column
+
+    Parameters
+    ----------
+    features: np.array, shape (n_timeseries, n_features)
+
+    Returns
+    -------
+    col_min, col_max, col_median: np.array, shape (n_features,)
+        zeros for columns without finite values
+    """
+    features = np.asarray(features, dtype=np.float64)
+    values = np.where(np.isfinite(features), features, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        col_min = np.nan_to_num(np.nanmin(values, axis=0))
+        col_max = np.nan_to_num(np.nanmax(values, axis=0))
+        col_median = np.nan_to_num(np.nanmedian(values, axis=0))
+    return col_min, col_max, col_median
+
+
+def impute_array(features, fill_values=None):
+    """NumPy version of tsfresh.utilities.dataframe_functions.impute
+
+    Column-wise replaces -inf by the column minimum, +inf by the maximum and
+    NaN by the median of the finite values, columns without finite values are
+    filled with zeros. features is changed in place.
+
+    Parameters
+    ----------
+    features: np.array, shape (n_timeseries, n_features)
+    fill_values: tuple, default=None
+        (col_min, col_max, col_median) given by 'impute_values', e.g. of training
+        features, None calculates them on features
+
+    Returns
+    -------
+    features: np.array
+    """
+    finite = np.isfinite(features)
+    if finite.all():
+        return features
+
+    columns = np.where(~finite.all(axis=0))[0]
+    if fill_values is None:
+        col_min, col_max, col_median = impute_values(features[:, columns])
+    else:
+        col_min, col_max, col_median = (np.asarray(v)[columns] for v in fill_values)
+
+    block = features[:, columns]
+    block = np.where(block == np.inf, col_max, block)
+    block = np.where(block == -np.inf, col_min, block)
+    block = np.where(np.isnan(block), col_median, block)
+    features[:, columns] = block
+    return features
+
+
+class CompiledFeaturePlan(object):
+    """Compiled evaluator for the features selected by TSFRESH
+
+    Features are evaluated on a dense (n_timeseries, n_measures, n_sensors) array,
+    each (sensor, feature calculator) pair in one vectorized call over all
+    timeseries. Calculators without a native version (see NATIVE_CALCULATORS)
+    are called directly on each timeserie, and the ones needing the pandas
+    index fall back to tsfresh.extract_features.
+
+    Parameters
+    ----------
+    columns: list
+        feature names in TSFRESH format (e.g. 'Sensor_1__quantile__q_0.1')
+    sensors: list
+        sensor name of each position in the last axis of the input array
+    n_jobs: int, default=0
+        The number of processes to use for parallelization in tsfresh fallback
+
+    Attributes
+    ----------
+    columns_: list
+        feature names, in output order
+    sensors_: list
+        sensor names, in input order
+    native_: dict
+        native features grouped by calculator
+        keys = (sensor position, calculator name)
+        values = list of (column position, parameters)
+    fallback_: list
+        column positions calculated by tsfresh
+    """
+    def __init__(self, columns, sensors, n_jobs=0):
+        self.columns_ = list(columns)
+        self.sensors_ = list(sensors)
+        self.n_jobs_ = n_jobs
+        self.native_ = {}
+        self.fallback_ = []
+
+        for position, column in enumerate(self.columns_):
+            parts = column.split('__')
+            kind, name = parts[0], parts[1]
+            if _calculator(name) is not None and kind in self.sensors_:
+                key = (self.sensors_.index(kind), name)
+                self.native_.setdefault(key, []).append((position, get_config_from_string(parts)))
+            else:
+                self.fallback_.append(position)
+
+    def _demote(self, positions):
+        """ Move columns from native evaluation to tsfresh fallback """
+        positions = set(positions)
+        for key in list(self.native_):
+            self.native_[key] = [(p, c) for p, c in self.native_[key] if p not in positions]
+            if not self.native_[key]:
+                del self.native_[key]
+        self.fallback_ = sorted(set(self.fallback_) | positions)
+
+    def _native_transform(self, X, out):
+        for (sensor, name), features in self.native_.items():
+            positions = [p for p, _ in features]
+            configs = [c for _, c in features]
+            out[:, positions] = _calculator(name)(X[:, :, sensor], configs)
+
+    def _fallback_transform(self, X, out, positions, distributor=None, n_jobs=None):
+        n_timeseries = X.shape[0]
+        columns = [self.columns_[p] for p in positions]
+        kind_to_fc_parameters = from_columns(columns)
+        kinds = list(kind_to_fc_parameters)
+        sensors = [self.sensors_.index(k) for k in kinds]
+
+        df = tensor_to_frame(X[:, :, sensors], kinds)
+        extracted = tsfresh.extract_features(df, column_id='id', column_sort='time',
+                                             kind_to_fc_parameters=kind_to_fc_parameters,
+                                             distributor=distributor,
+                                             n_jobs=self.n_jobs_ if n_jobs is None else n_jobs,
+                                             disable_progressbar=True)
+        out[:, positions] = extracted.loc[np.arange(1, n_timeseries + 1), columns].values
+
+    def transform(self, X, distributor=None, n_jobs=None):
+        """Calculate the features
+
+        Parameters
+        ----------
+        X: np.array, shape (n_timeseries, n_measures, n_sensors)
+            normalized timeseries
+        distributor: tsfresh distributor, default=None
+            used by tsfresh fallback
+        n_jobs: int, default=None
+            processes used by tsfresh fallback without distributor, 'n_jobs_' if None
+
+        Returns
+        -------
+        features: np.array, shape (n_timeseries, len(columns_))
+
+        Raises ValueError if X contains NaN, as tsfresh.extract_features does
+        """
+        X = np.asarray(X, dtype=np.float64)
+        if np.isnan(X).any():
+            raise ValueError('Timeseries must not contain NaN values')
+        out = np.empty((X.shape[0], len(self.columns_)))
+        self._native_transform(X, out)
+        if self.fallback_:
+            self._fallback_transform(X, out, self.fallback_, distributor, n_jobs)
+        return out
+
+    def parity(self, X, reference=None, rtol=1e-6, atol=1e-9):
+        """Compare native features with TSFRESH
+
+        Parameters
+        ----------
+        X: np.array, shape (n_timeseries, n_measures, n_sensors)
+            normalized timeseries
+        reference: np.array or pd.DataFrame, shape (n_timeseries, len(columns_)), default=None
+            TSFRESH features for X, calculated here if None
+        rtol, atol: float
+            tolerances as in np.isclose, NaN only matches NaN
+
+        Returns
+        -------
+        report: pd.DataFrame
+            one row per native feature with its maximum absolute error and
+            whether it matches TSFRESH
+        """
+        X = np.asarray(X, dtype=np.float64)
+        positions = sorted(p for features in self.native_.values() for p, _ in features)
+
+        native = np.empty((X.shape[0], len(self.columns_)))
+        self._native_transform(X, native)
+        if reference is None:
+            reference = np.empty((X.shape[0], len(self.columns_)))
+            self._fallback_transform(X, reference, positions)
+        reference = np.asarray(reference, dtype=np.float64)
+
+        a = native[:, positions]
+        b = reference[:, positions]
+        with np.errstate(invalid='ignore'):
+            error = np.where(np.isnan(a) & np.isnan(b), 0, np.abs(a - b))
+        match = np.isclose(a, b, rtol=rtol, atol=atol, equal_nan=True).all(axis=0)
+        return pd.DataFrame({'max_abs_error': np.nanmax(np.where(np.isnan(error), np.inf, error), axis=0, initial=0),
+                             'match': match}, index=[self.columns_[p] for p in positions])
+
+    def calibrate(self, X, reference, rtol=1e-6, atol=1e-9):
+        """Check native features against TSFRESH and send mismatching ones to tsfresh fallback
+
+        Parameters are the same as in 'parity'
+
+        Returns
+        -------
+        report: pd.DataFrame
+            parity report before calibration
+        """
+        report = self.parity(X, reference, rtol, atol)
+        mismatch = report.index[~report.match]
+        self._demote([self.columns_.index(c) for c in mismatch])
+        return report
@@ -0,0 +1,314 @@
+import json
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import perf_counter
+
+import numpy as np
+
+from lathes_model import LathesModel
+from micro_batch import MicroBatchScheduler
+
+# Local Inference Server
+#
+# One fitted LathesModel is shared by every request. HTTP requests are parsed
+# in their own threads and queued in a MicroBatchScheduler, whose workers
+# score each micro-batch with one LathesModel.predict_batch call. As
+# predict_batch doesn't change the model, workers share it without a lock.
+#
+# Endpoints
+#   POST /predict  {"measurement": [[...], ...]} -> {"prediction": ...}
+#                  {"measurements": [[[...], ...], ...]} -> {"predictions": [...]}
+#                  measurements have shape (n_measures_, n_sensors_), not normalized
+#                  400 if any measurement is invalid (nothing is queued), 503 if the
+#                  workers are stopped or scoring failed, 504 after request_timeout
+#   GET  /metrics  queue depth, counters, batch sizes and latency percentiles
+#   GET  /health   {"status": "ok"}
+#
+# Usage
+#   python inference_server.py --model models/lathes --port 8000
+
+
+class InferenceMetrics(object):
+    """Counters and latency window of an InferenceServer
+
+    Parameters
+    ----------
+    window: int, default=1024
+        number of most recent requests and batches used in the percentiles
+
+    Attributes
+    ----------
+    requests_: int
+        requests answered, including failed ones
+    errors_: int
+        requests answered with an error
+    batches_: int
+        batches scored
+    latencies_: deque
+        latency of the most recent requests in ms, from submission to answer
+    batch_sizes_: deque
+        size of the most recent batches
+    batch_latencies_: deque
+        scoring time of the most recent batches in ms
+    """
+    def __init__(self, window=1024):
+        self.requests_ = 0
+        self.errors_ = 0
+        self.batches_ = 0
+        self.latencies_ = deque(maxlen=window)
+        self.batch_sizes_ = deque(maxlen=window)
+        self.batch_latencies_ = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record_batch(self, size, seconds):
+        with self._lock:
+            self.batches_ += 1
+            self.batch_sizes_.append(size)
+            self.batch_latencies_.append(seconds*1000)
+
+    def record_request(self, seconds, error=False):
+        with self._lock:
+            self.requests_ += 1
+            self.errors_ += int(error)
+            self.latencies_.append(seconds*1000)
+
+    @staticmethod
+    def _percentiles(values):
+        if not values:
+            return {'p50': None, 'p90': None, 'p99': None, 'max': None}
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        return {'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(max(values))}
+
+    def snapshot(self, queue_depth=0):
+        """ Metrics as a JSON serializable dictionary """
+        with self._lock:
+            latencies = list(self.latencies_)
+            batch_sizes = list(self.batch_sizes_)
+            batch_latencies = list(self.batch_latencies_)
+            requests, errors, batches = self.requests_, self.errors_, self.batches_
+        return {'queue_depth': queue_depth,
+                'requests': requests,
+                'errors': errors,
+                'batches': batches,
+                'mean_batch_size': float(np.mean(batch_sizes)) if batch_sizes else None,
+                'latency_ms': self._percentiles(latencies),
+                'batch_latency_ms': self._percentiles(batch_latencies)}
+
+
+class InferenceServer(object):
+    """Thread-safe inference service around a fitted LathesModel
+
+    Parameters
+    ----------
+    model: LathesModel
+        fitted model, shared read-only by all workers (see 'from_store')
+    max_batch_size: int, default=32
+        maximum number of measurements scored in one predict_batch call
+    max_wait_ms: float, default=5.0
+        maximum time a worker waits for more measurements once a batch is started
+    flush_policy: str, default='deadline'
+        see micro_batch.py
+    n_workers: int, default=1
+        number of threads scoring batches
+    host: str, default='127.0.0.1'
+    port: int, default=8000
+        address of the HTTP interface, port 0 picks a free port
+    metrics_window: int, default=1024
+        number of most recent requests used in latency percentiles
+    request_timeout: float, default=30.0
+        seconds a HTTP request waits for its predictions, the measurements not
+        scored by then are cancelled
+
+    Attributes
+    ----------
+    model_: LathesModel
+    scheduler_: MicroBatchScheduler
+        batches the measurements for LathesModel.predict_batch
+    metrics_: InferenceMetrics
+    address_: tuple
+        (host, port) the HTTP interface is bound to, None before .start
+    """
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5.0, flush_policy='deadline', n_workers=1,
+                 host='127.0.0.1', port=8000, metrics_window=1024, request_timeout=30.0):
+        if not model.already_fitted_:
+            raise Exception('Model not fitted!')
+        self.model_ = model
+        self.host_ = host
+        self.port_ = port
+        self.request_timeout_ = request_timeout
+        self.metrics_ = InferenceMetrics(metrics_window)
+        self.scheduler_ = MicroBatchScheduler(lambda X: model.predict_batch(X).tolist(), max_batch_size=max_batch_size,
+                                              max_wait_ms=max_wait_ms, flush_policy=flush_policy,
+                                              n_workers=n_workers, on_batch=self.metrics_.record_batch)
+        self.address_ = None
+        self._httpd = None
+        self._http_thread = None
+
+    @classmethod
+    def from_store(cls, path, **kwargs):
+        """ Server for a model saved with LathesModel.save, its arrays are memory-mapped read-only """
+        return cls(LathesModel.load(path, mmap_mode='r'), **kwargs)
+
+    def start(self, http=True):
+        """Start the workers and, if http, the HTTP interface
+
+        Returns
+        -------
+        self
+        """
+        self.scheduler_.start()
+        if http:
+            self._httpd = ThreadingHTTPServer((self.host_, self.port_), _make_handler(self))
+            self._httpd.daemon_threads = True
+            self.address_ = self._httpd.server_address
+            self._http_thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+            self._http_thread.start()
+        return self
+
+    def stop(self):
+        """ Stop the HTTP interface and the workers, queued measurements are scored first """
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._http_thread.join()
+            self._httpd = None
+        self.scheduler_.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def submit(self, measurement):
+        """Queue a measurement
+
+        Parameters
+        ----------
+        measurement: np.array, shape (n_measures_, n_sensors_)
+            not normalized
+
+        Returns
+        -------
+        prediction: concurrent.futures.Future
+            resolves to the predicted class
+        """
+        return self._submit(self._validate(measurement))
+
+    def _validate(self, measurement):
+        """ measurement as a float array, ValueError if its shape doesn't match the model """
+        measurement = np.asarray(measurement, dtype=np.float64)
+        if measurement.shape != (self.model_.n_measures_, self.model_.n_sensors_):
+            raise ValueError('measurement must have shape ({}, {}), got {}'.format(
+                self.model_.n_measures_, self.model_.n_sensors_, measurement.shape))
+        return measurement
+
+    def _submit(self, measurement):
+        submitted = perf_counter()
+        future = self.scheduler_.submit(measurement)
+        future.add_done_callback(lambda f: self.metrics_.record_request(perf_counter() - submitted,
+                                                                        f.cancelled() or f.exception() is not None))
+        return future
+
+    @staticmethod
+    def _results(futures, timeout=None):
+        """ Results of futures within timeout seconds in total, on timeout or failure the others are cancelled """
+        deadline = None if timeout is None else perf_counter() + timeout
+        try:
+            return [f.result(None if deadline is None else max(deadline - perf_counter(), 0)) for f in futures]
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            raise
+
+    def predict(self, measurement, timeout=None):
+        """ Predicted class of a measurement, blocks until its batch is scored """
+        return self.submit(measurement).result(timeout)
+
+    def predict_many(self, measurements, timeout=None):
+        """Predicted classes of measurements
+
+        All measurements are validated before any is queued. On timeout
+        (concurrent.futures.TimeoutError) or failure the measurements not
+        scored yet are cancelled.
+        """
+        futures = [self._submit(m) for m in [self._validate(m) for m in measurements]]
+        return self._results(futures, timeout)
+
+    def metrics(self):
+        """ See InferenceMetrics.snapshot """
+        return self.metrics_.snapshot(self.scheduler_.pending())
+
+
+def _make_handler(server):
+    """ BaseHTTPRequestHandler class answering with 'server' """
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._reply(200, server.metrics())
+            elif self.path == '/health':
+                self._reply(200, {'status': 'ok'})
+            else:
+                self._reply(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._reply(404, {'error': 'Not found'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                many = 'measurements' in body
+                measurements = [server._validate(m) for m in (body['measurements'] if many else [body['measurement']])]
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {'error': str(e)})
+                return
+            if not server.scheduler_.running():
+                self._reply(503, {'error': 'Server is not running'})
+                return
+            try:
+                predictions = server._results([server._submit(m) for m in measurements], server.request_timeout_)
+            except FutureTimeoutError:
+                self._reply(504, {'error': 'Prediction timed out after {} s'.format(server.request_timeout_)})
+                return
+            except Exception as e:
+                self._reply(503, {'error': 'Scoring failed: {}'.format(e)})
+                return
+            self._reply(200, {'predictions': predictions} if many else {'prediction': predictions[0]})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local inference server for a saved LathesModel')
+    parser.add_argument('--model', required=True, help='directory of a model saved with LathesModel.save')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--flush-policy', default='deadline', choices=['deadline', 'greedy'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--request-timeout', type=float, default=30.0, help='seconds a request waits for predictions')
+    args = parser.parse_args()
+
+    server = InferenceServer.from_store(args.model, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                                        flush_policy=args.flush_policy, n_workers=args.workers, host=args.host, port=args.port,
+                                        request_timeout=args.request_timeout).start()
+    print('Serving on http://{}:{}'.format(*server.address_))
+    try:
+        server._http_thread.join()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def convert_csv(csv_path, path, dtype=np.float64):
+    """Convert an Input CSV to the memory-mapped dataset layout
+
+    The CSV follows Input/README.md: ID, Time_ID, one column per sensor and Target,
+    without header. Rows are sorted by (ID, Time_ID) during conversion and every
+    measurement must have the same number of samples. The dataset directory holds
+
+     - values.npy: np.array, shape (n_timeseries, n_measures, n_sensors)
+     - target.npy: np.array, shape (n_timeseries,)
+     - ids.npy: np.array, shape (n_timeseries,), measurement IDs in increasing order
+
+    Parameters
+    ----------
+    csv_path: str or PATH
+        Input CSV file
+    path: str or PATH
+        dataset directory, created if needed
+    dtype: numpy dtype, default=np.float64
+        dtype of stored sensor values
+
+    Returns
+    -------
+    dataset: LathesDataset
+    """
+    data = pd.read_csv(csv_path, header=None, dtype=np.float64, float_precision='round_trip').values
+    data = data[np.lexsort((data[:,1], data[:,0]))]
+
+    ids, first, counts = np.unique(data[:,0], return_index=True, return_counts=True)
+    if (counts != counts[0]).any():
+        raise Exception('All measurements must have the same number of samples!')
+    n_timeseries, n_measures = ids.shape[0], int(counts[0])
+
+    os.makedirs(str(path), exist_ok=True)
+    values = data[:,2:-1].astype(dtype, copy=False).reshape(n_timeseries, n_measures, -1)
+    np.save(os.path.join(str(path), 'values.npy'), values)
+    np.save(os.path.join(str(path), 'target.npy'), data[first,-1])
+    np.save(os.path.join(str(path), 'ids.npy'), ids.astype(np.int64))
+
+    return LathesDataset(path)
+
+
+class LathesDataset(object):
+    """Memory-mapped Input dataset
+
+    Sensor values are memory-mapped, so only the measurements that are
+    sliced are read from disk. See 'convert_csv' for the layout.
+
+    Parameters
+    ----------
+    path: str or PATH
+        dataset directory written by 'convert_csv'
+
+    Attributes
+    ----------
+    path_: str
+        dataset directory
+    values_: np.memmap, shape (n_timeseries_, n_measures_, n_sensors_)
+        sensor values
+    target_: np.array, shape (n_timeseries_,)
+        target of each measurement
+    ids_: np.array, shape (n_timeseries_,)
+        measurement IDs in increasing order
+    n_timeseries_: int
+    n_measures_: int
+    n_sensors_: int
+    """
+    def __init__(self, path):
+        self.path_ = str(path)
+        self.values_ = np.load(os.path.join(self.path_, 'values.npy'), mmap_mode='r')
+        self.target_ = np.load(os.path.join(self.path_, 'target.npy'))
+        self.ids_ = np.load(os.path.join(self.path_, 'ids.npy'))
+        self.n_timeseries_, self.n_measures_, self.n_sensors_ = self.values_.shape
+
+    def __len__(self):
+        return self.n_timeseries_
+
+    def positions(self, ids):
+        """ Positions of measurement IDs in the dataset """
+        ids = np.asarray(ids)
+        positions = np.searchsorted(self.ids_, ids)
+        if (positions >= self.n_timeseries_).any() or (self.ids_[np.minimum(positions, self.n_timeseries_-1)] != ids).any():
+            raise Exception('Measurement ID not found!')
+        return positions
+
+    def tensor(self, ids=None):
+        """Sensor values of measurements
+
+        Parameters
+        ----------
+        ids: array-like, default=None
+            measurement IDs, all measurements if None
+
+        Returns
+        -------
+        X: np.array, shape (len(ids), n_measures_, n_sensors_)
+            a read-only view of the memory map if ids is None,
+            otherwise only the requested measurements are read
+        """
+        if ids is None:
+            return self.values_
+        return self.values_[self.positions(ids)]
+
+    def target(self, ids=None):
+        """ Target of measurements, shape (len(ids),) """
+        if ids is None:
+            return self.target_
+        return self.target_[self.positions(ids)]
+
+    def long_format(self, ids=None):
+        """Measurements in the Input CSV layout, without the Target column
+
+        Returns
+        -------
+        X: np.array, shape (len(ids)*n_measures_, n_sensors_+2)
+        y: np.array, shape (len(ids)*n_measures_,)
+        """
+        if ids is None:
+            ids = self.ids_
+        values = self.tensor(ids)
+        X = np.empty((values.shape[0]*self.n_measures_, self.n_sensors_+2))
+        X[:,0] = np.repeat(ids, self.n_measures_)
+        X[:,1] = np.tile(np.arange(1, self.n_measures_+1), values.shape[0])
+        X[:,2:] = values.reshape(-1, self.n_sensors_)
+        return X, np.repeat(self.target(ids), self.n_measures_)
@@ -1,3 +1,9 @@
+import copy
+import functools
+import weakref
+from collections import OrderedDict
+from multiprocessing import Pool
+
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -5,6 +11,7 @@ from matplotlib.lines import Line2D
 import tsfresh
 from tsfresh.feature_selection.relevance import calculate_relevance_table
 from tsfresh.utilities.dataframe_functions import impute
+from tsfresh.utilities.distribution import MultiprocessingDistributor
 from datetime import date, datetime
 
 from sklearn.neural_network import MLPClassifier
@@ -17,9 +24,47 @@ from sklearn.ensemble import RandomForestClassifier, AdaBoostClassifier
 from sklearn.naive_bayes import GaussianNB
 from sklearn.discriminant_analysis import QuadraticDiscriminantAnalysis
 
+from sklearn.base import clone
+from sklearn.model_selection import ParameterGrid
+from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
 from sklearn.preprocessing import MinMaxScaler, StandardScaler
 from sklearn.decomposition import PCA
-from SODA import SelfOrganisedDirectionAwareDataPartitioning
+from scipy.spatial import cKDTree
+from SODA import (SelfOrganisedDirectionAwareDataPartitioning, chessboard_online_division, online_peak_identification,
+                  cloud_member_recruitment_njit, nearest_focal_point)
+from feature_cache import FeatureCache
+from feature_plan import CompiledFeaturePlan, tensor_to_frame, impute_array, impute_values
+from lathes_dataset import LathesDataset
+from model_store import save_object, load_object
+from profiling import NULL_PROFILER
+
+class PersistentMultiprocessingDistributor(MultiprocessingDistributor):
+    """ TSFRESH MultiprocessingDistributor whose pool survives between extractions
+    TSFRESH closes the distributor after each extraction, here the pool is only
+    released by 'shutdown', when owner is garbage collected or at interpreter exit"""
+    def __init__(self, owner, *args, **kwargs):
+        MultiprocessingDistributor.__init__(self, *args, **kwargs)
+        self._finalizer = weakref.finalize(owner, MultiprocessingDistributor.close, self)
+
+    def close(self):
+        pass
+
+    def shutdown(self):
+        self._finalizer()
+
+def _instrumented(name, items=None):
+    """ Run a LathesModel method as a profiler stage (see profiling.py)
+    items(model, result) gives the number of items processed by the stage"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self._stage(name) as stage:
+                result = method(self, *args, **kwargs)
+                if items is not None and getattr(self, 'profiler_', NULL_PROFILER).enabled:
+                    stage.items = items(self, result)
+            return result
+        return wrapper
+    return decorator
 
 class LathesModel(object):
     """Lathes Cutting Tool Model Class
@@ -37,6 +82,30 @@ class LathesModel(object):
     percent: float, default=50
         purity percent for grouping algorithm, must be within (50, 100) interval
         percent=50 means hard voting
+    soda_backend: str, default='numpy'
+        SODA backend, 'numpy' or 'numba'
+        'numba' falls back to 'numpy' when numba is not installed
+    feature_cache: str, PATH or FeatureCache, default=None
+        persistent TSFRESH feature store, only timeseries not found
+        in cache are extracted
+        None means no cache
+    compiled_features: bool, default=True
+        calculate selected features with NumPy in prediction stage, features
+        without native version or not matching TSFRESH in training data are
+        still calculated by TSFRESH
+    stage_cache_size: int, default=16
+        number of PCA, SODA and grouping algorithm results kept by 'fit_after_tsfresh'
+        0 means no cache
+    predict_mode: str, default='clf'
+        'clf' predicts with the classifier fitted on grouping algorithm labels
+        'soda' predicts the class of the data cloud with the nearest focal point,
+        no classifier is fitted
+    profiler: profiling.Profiler, default=None
+        records time, CPU time, peak memory and items of each stage
+        None disables instrumentation
+    partial_refit_every: int, default=10
+        number of .partial_fit calls between refits of focal points, grouping
+        algorithm and classifier (see 'partial_refit')
 
     Attributes
     ----------
@@ -48,6 +117,29 @@ class LathesModel(object):
         SODA granularity, sensibility factor for data partitioning module
     percent_: float
         purity percent for grouping algorithm
+    soda_backend_: str
+        SODA backend
+    feature_cache_: FeatureCache
+        persistent TSFRESH feature store
+    compiled_features_: bool
+        calculate selected features with NumPy in prediction stage
+    feature_plan_: CompiledFeaturePlan
+        compiled evaluator for selected features, None if not used
+    feature_plan_report_: pd.DataFrame
+        parity of native features with TSFRESH in training data
+    stage_cache_size_: int
+        number of stage results kept in 'stage_cache_'
+    predict_mode_: str
+        'clf' or 'soda'
+    profiler_: profiling.Profiler
+        stage instrumentation, profiling.NULL_PROFILER when disabled
+    partial_refit_every_: int
+        number of .partial_fit calls between refits
+    partial_fits_since_refit_: int
+        .partial_fit calls since the last refit
+    stage_cache_: OrderedDict
+        results of PCA, SODA and grouping algorithm for the current features, in LRU order
+        keys = (stage, hyperparams read by the stage and the stages before it)
     eigen_matrix_: np.array
         pca transformation eigen matrix
     nan_columns_: list
@@ -67,6 +159,9 @@ class LathesModel(object):
         keys = sensor names
     X_selected_: pd.DataFrame
         train data set features after TSFRESH selection
+    impute_values_: tuple
+        (min, max, median) of the finite values of each column of 'X_selected_',
+        fill values of -inf, +inf and NaN features in .predict_batch
     X_projectd_: np.array
         train data set projected in Principal Components
     variation_kept: np.array
@@ -75,15 +170,30 @@ class LathesModel(object):
         Dictionary with SODA output
     SODA_IDX_: np.array
         array with labels given by SODA algorithm
+    classes_: np.array
+        target classes in increasing order (wear levels, 0 for good tools)
+    cloud_counts_: np.array, shape (n_data_clouds, n_classes)
+        number of samples of each class in each data cloud
+    cloud_decision_: np.array, shape (n_data_clouds,)
+        position in 'classes_' of the class given to each data cloud by Grouping Algorithm,
+        -1 for data clouds without samples
     classifiers_label_: np.array
         array with labels given by Grouping Algorithm
+    focal_points_: np.array, shape (n_data_clouds, N_PCs_)
+        focal points of data clouds with samples, 'soda' predict mode only
+    focal_labels_: np.array, shape (n_data_clouds,)
+        class of each focal point, 'soda' predict mode only
+    focal_index_: scipy.spatial.cKDTree
+        KD-tree of 'focal_points_', 'soda' predict mode only
     GA_results: dict
         'Data_Clouds': int
             number of Data Clouds
         'Good_Tools_Groups': int
             number of Adequate Condition Data Clouds 
         'Worn_Tools_Groups': int
-            number of Inadequate Condition Data Clouds 
+            number of Inadequate Condition Data Clouds (any wear class)
+        'Groups_per_Class': np.array
+            number of Data Clouds given to each class of 'classes_'
         'Samples': int
             number of Samples
     X_test_seleected: np.array
@@ -128,13 +238,34 @@ class LathesModel(object):
         scaler to standardize selected features
     pca: sklearn.decomposition.PCA
         pca fitted model
+    projection_matrix_: np.array, shape (n_selected_features, N_PCs_)
+    projection_offset_: np.array, shape (N_PCs_,)
+        'pca_scaler' and 'pca' fused in one affine transform,
+        X_projected = X_selected @ projection_matrix_ + projection_offset_
     """
-    def __init__(self, N_PCs=3, clf='None', n_jobs=4, granularity=3, percent=50):
+    def __init__(self, N_PCs=3, clf='None', n_jobs=4, granularity=3, percent=50, soda_backend='numpy',
+                 feature_cache=None, compiled_features=True, stage_cache_size=16, predict_mode='clf',
+                 profiler=None, partial_refit_every=10):
 
         self.N_PCs_ = N_PCs
         self.granularity_ = granularity
         self.n_jobs_ = n_jobs
         self.percent_ = percent
+        self.soda_backend_ = soda_backend
+        if feature_cache is None or isinstance(feature_cache, FeatureCache):
+            self.feature_cache_ = feature_cache
+        else:
+            self.feature_cache_ = FeatureCache(feature_cache)
+        self.compiled_features_ = compiled_features
+        self.feature_plan_ = None
+        self.stage_cache_size_ = stage_cache_size
+        self.stage_cache_ = OrderedDict()
+        if predict_mode not in ('clf', 'soda'):
+            raise ValueError("predict_mode must be 'clf' or 'soda'")
+        self.predict_mode_ = predict_mode
+        self.profiler_ = NULL_PROFILER if profiler is None else profiler
+        self.partial_refit_every_ = partial_refit_every
+        self.partial_fits_since_refit_ = 0
         if clf == 'None':
             self.clf = MLPClassifier(alpha=1,max_iter=500)
         else:
@@ -145,36 +276,61 @@ class LathesModel(object):
         self.already_tested_ = False
         self.one_class_ = False
     
-    def _copy(self, params):
-        """ Suport function to copy model instance """
-        for p in params:
-            exec('self.{} = {}'.format(p, params[p]))
-
     def copy(self):
-        """ Copy model instance """
-        C = LathesModel(self.N_PCs_, self.clf, self.n_jobs_, self.granularity_, self.percent_)
-        if self.already_fitted_ == True:
-            param_names = ['GA_results_', 'N_PCs_', 'SODA_IDX_', 'SODA_output_', 'X_projected_', 'X_selected_',
-                           'already_fitted_', 'already_tested_', 'classifiers_label_', 'clf', 'granularity_', 
-                           'kind_to_fc_parameters_', 'n_jobs_', 'n_measures_', 'n_sensors', 'n_timeseries_', 'nan_columns_', 
-                           'pca', 'pca_scaler', 'percent_', 'relevance_table_', 'relevant_features_', 'scaler', 
-                           'selected_columns_', 'target_', 'valid_columns_', 'variation_kept_','fit_time_',
-                           'tsfresh_time_', 'one_class_']
-            param_dict = {}
-            for p in param_names:
-                exec('param_dict[p] = self.{}'.format(p))
-
-            C._copy(param_dict)
-            if self.already_tested_ == True:
-                param_names = ['already_tested_''predict_time_', 'tsfresh_predict_time_', 'X_test_projected_', 'X_test_selected_']
-
-                param_dict = {}
-                for p in param_names:
-                    exec('param_dict[p] = self.{}'.format(p))
-
-                C._copy(param_dict)
-
-        return C
+        """ Copy model instance
+        Fitted attributes, stage cache and classifier are deep copied, the worker
+        pool is not copied and the feature cache and profiler are shared with the copy"""
+        memo = {}
+        if self.feature_cache_ is not None:
+            memo[id(self.feature_cache_)] = self.feature_cache_
+        profiler = getattr(self, 'profiler_', NULL_PROFILER)
+        memo[id(profiler)] = profiler
+        return copy.deepcopy(self, memo)
+
+    def _stage(self, name, items=None):
+        """ Instrumentation of a stage, see profiling.py """
+        return getattr(self, 'profiler_', NULL_PROFILER).stage(name, items)
+
+    def save(self, path):
+        """Save the model to a directory
+
+        NumPy arrays (scalers, PCA, SODA results, features, classifier weights)
+        are stored in a memory-mappable file and the rest in a small metadata
+        file, see model_store. The worker pool, the stage cache and the feature
+        tables loaded by the feature cache are not saved.
+
+        Parameters
+        ----------
+        path: str or PATH
+            model directory, created if needed
+        """
+        model = copy.copy(self)
+        model._distributor = None
+        model.stage_cache_ = OrderedDict()
+        save_object(model, path)
+
+    @classmethod
+    def load(cls, path, mmap_mode='c'):
+        """Load a model saved with 'save'
+
+        Only load models from trusted sources, the metadata file is a pickle.
+
+        Parameters
+        ----------
+        path: str or PATH
+            model directory
+        mmap_mode: str, default='c'
+            arrays are memory-mapped copy-on-write by default,
+            'r' maps them read-only and None reads them into memory
+
+        Returns
+        -------
+        model: LathesModel
+        """
+        model = load_object(path, mmap_mode)
+        if not isinstance(model, cls):
+            raise Exception('{} is not a saved {}!'.format(path, cls.__name__))
+        return model
 
     def reset(self):
         """ Reset model 
@@ -184,11 +340,21 @@ class LathesModel(object):
         self.already_fitted_ = False
         self.already_tested_ = False
         self.one_class_ = False
+        self.stage_cache_.clear()
 
     ### Fitting Methods
 
+    @_instrumented('normalization', lambda self, r: self.n_timeseries_)
     def _normalization(self, X, y):
-        """ Normalize input data in fit stage """
+        """ Normalize input data in fit stage
+        Tensor input is normalized as a tensor, see '_tensor_normalization'"""
+        if np.ndim(X) == 3:
+            self.n_timeseries_, self.n_measures_, self.n_sensors_ = X.shape
+            self.target_ = self._timeseries_target(X, y)
+
+            self.scaler = MinMaxScaler()
+            self.scaler.fit(X.reshape(-1, self.n_sensors_))
+            return self._tensor_normalization(X)
 
         self.n_timeseries_ = int(X[:,0].max())
         self.n_measures_ = int(X[:,1].max())
@@ -205,11 +371,45 @@ class LathesModel(object):
                         ['Sensor_' + str(x) for x in range(1,self.n_sensors_+1)])
         return df
 
+    def _tensor_normalization(self, X):
+        """ Normalize input tensor with 'scaler', shape (n_timeseries, n_measures, n_sensors)
+        The scaler is applied in place to a single float copy of the data"""
+        data = np.array(X, dtype=np.float64)
+        flat = data.reshape(-1, data.shape[2])
+        flat *= self.scaler.scale_
+        flat += self.scaler.min_
+        return data
+
+    def _timeseries_target(self, X, y):
+        """ One target per timeserie
+        y can be given per measure or, for tensor input, per timeserie"""
+        y = np.asarray(y)
+        if np.ndim(X) == 3 and y.shape[0] == X.shape[0]:
+            return y.reshape(X.shape[0], -1)[:,0]
+        return y[::self.n_measures_]
+
+    def _dataset_input(self, X, y=None):
+        """ LathesDataset input is read as a tensor, with its targets if y is None """
+        if isinstance(X, LathesDataset):
+            if y is None:
+                y = X.target_
+            X = X.tensor()
+        return X, y
+
+    def _sensor_names(self):
+        return ['Sensor_' + str(x) for x in range(1,self.n_sensors_+1)]
+
+    @_instrumented('extraction', lambda self, r: r.shape[0])
     def _tsfresh_extraction(self, X):
         """ Feature Extraction in fit stage
         After extraction columns with NaN values are dropped"""
-        extracted_features = tsfresh.extract_features(X, column_id="id", column_sort="time", 
-                                                        n_jobs=self.n_jobs_)
+        if np.ndim(X) == 3:
+            X = tensor_to_frame(X, self._sensor_names())
+        if self.feature_cache_ is None:
+            extracted_features = tsfresh.extract_features(X, column_id="id", column_sort="time", 
+                                                            n_jobs=self.n_jobs_)
+        else:
+            extracted_features = self.feature_cache_.extract(X, n_jobs=self.n_jobs_)
         
         features = extracted_features.columns
         self.nan_columns_ = []
@@ -222,11 +422,17 @@ class LathesModel(object):
         
         return extracted_features.drop(self.nan_columns_, axis=1)
 
-    def _tsfresh_selection(self,X):
-        """ Feature Selection for fit stage """
+    @_instrumented('selection', lambda self, r: self.X_selected_.shape[0])
+    def _tsfresh_selection(self, X, n_jobs=None):
+        """ Feature Selection for fit stage
+        n_jobs is passed to calculate_relevance_table, None keeps the TSFRESH default.
+        Use 0 in daemonic processes (pool workers), they can't start the TSFRESH pool"""
         y = pd.Series(self.target_, index=X.index)
 
-        self.relevance_table_ = calculate_relevance_table(X, y)
+        if n_jobs is None:
+            self.relevance_table_ = calculate_relevance_table(X, y)
+        else:
+            self.relevance_table_ = calculate_relevance_table(X, y, n_jobs=n_jobs)
 
         self.relevant_features_ = self.relevance_table_[self.relevance_table_.relevant].feature
 
@@ -236,7 +442,26 @@ class LathesModel(object):
 
         self.kind_to_fc_parameters_ = tsfresh.feature_extraction.settings.from_columns(self.X_selected_)
 
+        self.impute_values_ = impute_values(self.X_selected_.values)
+
+    @_instrumented('compile_features', lambda self, r: self.X_selected_.shape[0])
+    def _compile_features(self, X):
+        """ Build the compiled evaluator for selected features
+        Native features are checked against the TSFRESH values of training data,
+        the ones that don't match are calculated by TSFRESH in prediction stage"""
+        self.feature_plan_ = None
+        if not self.compiled_features_:
+            return
+
+        tensor, ids = self._to_tensor(X)
+        if tensor is None:
+            return
+
+        self.feature_plan_ = CompiledFeaturePlan(self.selected_columns_, self._sensor_names(), n_jobs=self.n_jobs_)
+        self.feature_plan_report_ = self.feature_plan_.calibrate(tensor, self.X_selected_.loc[ids].values)
+
 
+    @_instrumented('pca', lambda self, r: self.X_projected_.shape[0])
     def _pca(self):
         """ PCA calculation and projection for fit stage """
         self.pca_scaler = StandardScaler()
@@ -249,72 +474,129 @@ class LathesModel(object):
 
         self.variation_kept_ = self.pca.explained_variance_ratio_*100
 
+        components = self.pca.components_
+        if self.pca.whiten:
+            components = components / np.sqrt(self.pca.explained_variance_)[:,None]
+        self.projection_matrix_ = (components / self.pca_scaler.scale_).T
+        self.projection_offset_ = -(self.pca_scaler.mean_ / self.pca_scaler.scale_ + self.pca.mean_) @ components.T
+
+    @_instrumented('soda', lambda self, r: len(self.SODA_IDX_))
     def _soda(self):
         """ SODA Data Partitioning Algorithm for fit stage """
         Input = {'GridSize':self.granularity_, 'StaticData':self.X_projected_, 'DistanceType': 'euclidean'}
-        self.SODA_output_ = SelfOrganisedDirectionAwareDataPartitioning(Input)
+        self.SODA_output_ = SelfOrganisedDirectionAwareDataPartitioning(Input, backend=self.soda_backend_,
+                                                                         profiler=getattr(self, 'profiler_', None))
 
         self.SODA_IDX_ = self.SODA_output_['IDX']
 
-    def _grouping_algorithm(self): 
-        """ Grouping Algorithm for fit stage """         
-         #### Program Matrix's and Variables ####
-        n_DA_planes = np.max(self.SODA_IDX_)
-        Percent = np.zeros((int(n_DA_planes),3))
-        n_IDs_per_gp = np.zeros((int(n_DA_planes),2))
-        n_tot_Id_per_DA = np.zeros((int(n_DA_planes),1))
-        decision = np.zeros(int(n_DA_planes))
-        n_gp0 = 0
-        n_gp1 = 0
+    def _fit_stages(self):
+        """ PCA, SODA and grouping algorithm for fit stage
+        A stage is restored from 'stage_cache_' when it was already computed for the
+        current features with the same hyperparams, otherwise it is executed"""
+        self._cached_stage(('pca', self.N_PCs_), self._pca, 
+                           ['pca_scaler', 'pca', 'X_projected_', 'variation_kept_', 
+                            'projection_matrix_', 'projection_offset_'])
+        self._cached_stage(('soda', self.N_PCs_, self.granularity_), self._soda, 
+                           ['SODA_output_', 'SODA_IDX_'])
+        self._cached_stage(('grouping', self.N_PCs_, self.granularity_, self.percent_), self._grouping_algorithm, 
+                           ['classes_', 'cloud_counts_', 'cloud_decision_', 'classifiers_label_', 'GA_results_'])
+
+    def _cached_stage(self, key, stage, attributes):
+        """ Restore the attributes set by stage from 'stage_cache_', or execute it and store them
+        The least recently used result is dropped when the cache has more than 'stage_cache_size_' results.
+        Results missing some of the attributes (stored by an older version of the stage) are recomputed"""
+        if key in self.stage_cache_ and all(attribute in self.stage_cache_[key] for attribute in attributes):
+            self.stage_cache_.move_to_end(key)
+            for attribute, value in self.stage_cache_[key].items():
+                setattr(self, attribute, value)
+            return
 
-        #### Definition Percentage Calculation #####
+        stage()
 
-        for i in range(self.target_.shape[0]):
-            if self.target_[i] == 0:
-                n_IDs_per_gp [int(self.SODA_IDX_[i]-1),0] += 1 
-            else:
-                n_IDs_per_gp [int(self.SODA_IDX_[i]-1),1] += 1 
+        if self.stage_cache_size_ > 0:
+            self.stage_cache_[key] = {attribute: getattr(self, attribute) for attribute in attributes}
+            while len(self.stage_cache_) > self.stage_cache_size_:
+                self.stage_cache_.popitem(last=False)
+
+    @_instrumented('grouping', lambda self, r: len(self.SODA_IDX_))
+    def _grouping_algorithm(self): 
+        """ Grouping Algorithm for fit stage
+        Each data cloud is labeled with the first class of 'classes_' holding more than
+        'percent_' of its samples, or with the last class if there is none. For binary
+        targets the cloud is a Good Tool group if over 'percent_' of its samples are
+        good tools, and a Worn Tool group otherwise (data clouds without samples are
+        counted as Worn Tool groups)"""
+        clouds = np.asarray(self.SODA_IDX_, dtype=np.intp) - 1
+        n_DA_planes = int(clouds.max()) + 1
+        self.classes_, target = np.unique(self.target_, return_inverse=True)
+        n_classes = self.classes_.shape[0]
 
-            n_tot_Id_per_DA [int(self.SODA_IDX_[i]-1)] += 1 
+        #### Definition Percentage Calculation #####
 
+        self.cloud_counts_ = np.bincount(clouds*n_classes + target.ravel(),
+                                         minlength=n_DA_planes*n_classes).reshape(n_DA_planes, n_classes)
+        self._cloud_decisions()
+        self.classifiers_label_ = self.classes_[self.cloud_decision_[clouds]]
 
-        for i in range(int(n_DA_planes)):
+    def _cloud_decisions(self):
+        """ 'cloud_decision_' and 'GA_results_' from the class counts of data clouds 'cloud_counts_' """
+        n_DA_planes, n_classes = self.cloud_counts_.shape
+        with np.errstate(invalid='ignore', divide='ignore'):
+            Percent = (self.cloud_counts_ / self.cloud_counts_.sum(axis=1, keepdims=True)) * 100
 
-            Percent[i,0] = (n_IDs_per_gp[i,0] / n_tot_Id_per_DA[i]) * 100
-            Percent[i,1] = (n_IDs_per_gp[i,1] / n_tot_Id_per_DA[i]) * 100
-                    
         #### Using Definition Percentage as Decision Parameter ####
 
-        for i in range(Percent.shape[0]):
+        over = Percent > self.percent_
+        self.cloud_decision_ = np.where(over.any(axis=1), over.argmax(axis=1), n_classes-1)
+        self.cloud_decision_[self.cloud_counts_.sum(axis=1) == 0] = -1
 
-            if (Percent[i,0] > self.percent_):
-                n_gp0 += 1
-                decision[i] = 0
-            else:
-                n_gp1 += 1
-                decision[i] = 1
-                        
-                #### Defining labels
+        ### Printig Analitics results
 
-        self.classifiers_label_ = []
+        groups_per_class = np.bincount(self.cloud_decision_[self.cloud_decision_ >= 0], minlength=n_classes)
+        n_gp0 = int(groups_per_class[self.classes_ == 0].sum())
+        self.GA_results_ = {'Data_Clouds': n_DA_planes,
+                            'Good_Tools_Groups': n_gp0,
+                            'Worn_Tools_Groups': n_DA_planes - n_gp0,
+                            'Groups_per_Class': groups_per_class,
+                            'Samples': int(self.cloud_counts_.sum())}
+    
+    @_instrumented('classifier_fit', lambda self, r: self.X_projected_.shape[0])
+    def _fit_classifier(self):
+        """ Classifier for fit stage
+        With predict_mode_ 'soda' no classifier is fitted, the focal points of the data
+        clouds are indexed instead (see '_classify')"""
+        if getattr(self, 'predict_mode_', 'clf') == 'soda':
+            valid = np.flatnonzero(self.cloud_decision_ >= 0)
+            self.focal_points_ = np.asarray(self.SODA_output_['C'], dtype=float)[valid]
+            self.focal_labels_ = self.classes_[self.cloud_decision_[valid]]
+            self.focal_index_ = cKDTree(self.focal_points_)
+            self.one_class_ = np.unique(self.focal_labels_).shape[0] < 2
+            return
 
-        for i in range (len(self.SODA_IDX_)):
-            self.classifiers_label_.append(decision[int (self.SODA_IDX_[i]-1)])
-                    
+        try:
+            self.clf.fit(self.X_projected_, self.classifiers_label_)
+            self.one_class_ = False
+        except:
+            self.one_class_ = True
 
+    @_instrumented('classifier_predict', lambda self, r: len(r))
+    def _classify(self, X_projected):
+        """ Class of samples projected in Principal Components
+        With predict_mode_ 'soda' each sample gets the class of the data cloud with the
+        nearest focal point (same distance as SODA Stage 4), otherwise 'clf' predicts it"""
+        if getattr(self, 'predict_mode_', 'clf') == 'soda':
+            return self.focal_labels_[nearest_focal_point(self.focal_points_, X_projected, self.focal_index_)]
+        return self.clf.predict(X_projected)
 
-        ### Printig Analitics results
-                    
-        self.GA_results_ = {'Data_Clouds':n_DA_planes,
-                            'Good_Tools_Groups': n_gp0,
-                            'Worn_Tools_Groups': n_gp1,
-                            'Samples': int(len(self.SODA_IDX_))}
-    
     ### Prediction Methods
 
+    @_instrumented('normalization')
     def _predict_normalization(self,X):
         """ Normalize input data for prediction stage
         This step is executed using 'scaler' fitted in .fit"""
+        if np.ndim(X) == 3:
+            return self._tensor_normalization(X)
+
         info = X[:,0:2]
         data = X[:,2:]
 
@@ -330,27 +612,105 @@ class LathesModel(object):
     def _predict_tsfresh_extraction(self, X):
         """ Feature Extraction for prediction stage 
         This step is executed using 'kind_to_fc_parameters_' constructed in .fit"""
-        columns = []
-        for i,x in enumerate(self.kind_to_fc_parameters_):
-            aux = pd.DataFrame(np.hstack((X.loc[:,:'time'].values,
-                                X.loc[:,x].values.reshape((-1,1)))),
-                                columns=['id','time',x])
-                
-            aux2 = tsfresh.extract_features(aux, column_id="id", column_sort="time",
-                                            default_fc_parameters=self.kind_to_fc_parameters_[x],
-                                            n_jobs=self.n_jobs_)
-
-            for j in range(len(aux2.columns.tolist())):columns.append(aux2.columns.tolist()[j])
-
-            if i == 0:
-                extracted_features = np.array(aux2.values)
-            else:
-                extracted_features = np.hstack((extracted_features,aux2.values))
-
-        final_features = pd.DataFrame(extracted_features,columns=columns)
-        self.X_test_selected_ = impute(final_features[self.selected_columns_])
-        
+        self.X_test_selected_ = self._extract_selected_features(X)
+
+    @_instrumented('extraction', lambda self, r: r.shape[0])
+    def _extract_selected_features(self, X, imputed=True, n_jobs=None):
+        """ Extract features selected in .fit from normalized data
+        All sensors are extracted in a single TSFRESH call with 'kind_to_fc_parameters_',
+        sharing one worker pool between calls (see '_get_distributor').
+        If 'feature_plan_' was compiled in .fit it is used instead.
+        With imputed=False -inf, +inf and NaN features are kept.
+        With n_jobs given TSFRESH runs with n_jobs processes, without the shared pool
+        and the feature cache, so neither is changed (n_jobs=0 runs it in the calling thread)"""
+        stateless = n_jobs is not None
+        if stateless:
+            distributor = None
+        else:
+            n_jobs, distributor = self.n_jobs_, self._get_distributor()
+        if getattr(self, 'feature_plan_', None) is not None:
+            tensor, ids = self._to_tensor(X)
+            if tensor is not None:
+                features = self.feature_plan_.transform(tensor, distributor=distributor, n_jobs=n_jobs)
+                features = pd.DataFrame(features, index=ids, columns=self.selected_columns_)
+                return impute(features) if imputed else features
+
+        kinds = list(self.kind_to_fc_parameters_)
+        if np.ndim(X) == 3:
+            X = tensor_to_frame(X[:, :, [self._sensor_names().index(k) for k in kinds]], kinds)
+        else:
+            X = X.loc[:, ['id', 'time'] + kinds]
 
+        if self.feature_cache_ is None or stateless:
+            extracted = tsfresh.extract_features(X, column_id="id", column_sort="time",
+                                                 kind_to_fc_parameters=self.kind_to_fc_parameters_,
+                                                 distributor=distributor, n_jobs=n_jobs)
+        else:
+            extracted = self.feature_cache_.extract(X, kind_to_fc_parameters=self.kind_to_fc_parameters_,
+                                                    distributor=distributor, n_jobs=n_jobs)
+
+        position = extracted.columns.get_indexer(self.selected_columns_)
+        if (position < 0).any():
+            raise Exception('Selected features missing after extraction!')
+
+        features = np.empty((extracted.shape[0], position.shape[0]))
+        np.take(extracted.values, position, axis=1, out=features)
+
+        final_features = pd.DataFrame(features, index=extracted.index, columns=self.selected_columns_)
+        return impute(final_features) if imputed else final_features
+
+    def _to_tensor(self, X):
+        """ Normalized data in long format to np.array, shape (n_timeseries, n_measures, n_sensors)
+        Returns (None, None) if timeseries don't have the same length"""
+        if np.ndim(X) == 3:
+            return X, np.arange(1, X.shape[0]+1)
+
+        X = X.sort_values(['id', 'time'])
+        ids, counts = np.unique(X['id'].values, return_counts=True)
+        if (counts != counts[0]).any():
+            return None, None
+
+        data = X.loc[:, self._sensor_names()].values
+        return data.reshape(ids.shape[0], counts[0], self.n_sensors_), ids
+
+    def _get_distributor(self):
+        """ TSFRESH distributor for prediction stage
+        The multiprocessing pool is created once and reused by every prediction,
+        it is released by 'close'"""
+        if self.n_jobs_ in (0, 1):
+            return None
+        if getattr(self, '_distributor', None) is None or self._distributor.n_workers != self.n_jobs_:
+            self.close()
+            self._distributor = PersistentMultiprocessingDistributor(self, n_workers=self.n_jobs_,
+                                                                     progressbar_title="Feature Extraction")
+        return self._distributor
+
+    def close(self):
+        """ Release the worker pool used by prediction stage
+        The pool is also released when the model is garbage collected, or on
+        leaving a 'with' block of the model"""
+        distributor = getattr(self, '_distributor', None)
+        if distributor is not None:
+            distributor.shutdown()
+        self._distributor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getstate__(self):
+        """ The worker pool can't be pickled, it is created again when needed
+        Growth buffers of .partial_fit are dropped and pending features are added to 'X_selected_'"""
+        if '_X_selected' in self.__dict__:
+            self.X_selected_
+        state = self.__dict__.copy()
+        state['_distributor'] = None
+        state.pop('_growth_buffers', None)
+        return state
+
+    @_instrumented('pca', lambda self, r: self.X_test_projected_.shape[0])
     def _predict_pca(self):
         """ Project predict data using PCA fitted in .fit"""
         X_scaled = self.pca_scaler.transform(self.X_test_selected_)
@@ -359,7 +719,8 @@ class LathesModel(object):
 
     ### Main Methods
 
-    def fit(self, X, y):
+    @_instrumented('fit')
+    def fit(self, X, y=None):
         """Fit the model with X and target y
 
         Parameters
@@ -383,10 +744,20 @@ class LathesModel(object):
             | ...           | ...         | ...       | ... | ...       |
             | n_timeseries_ | n_measures_ | -0.83     | ... | -0.97     |
 
+            or np.array, shape (n_timeseries_, n_measures_, n_sensors)
+            Training data as a tensor, timeseries ids are 1 to n_timeseries_
+            and the long format is only built for TSFRESH extraction
+
+            or LathesDataset, read as a tensor
+
         y : np.array, shape (n_timeseries_*n_measures_)
             Target for training data
+            For tensor input shape (n_timeseries_,) is also accepted
+            For LathesDataset input the dataset target is used if y is None
         """
 
+        X, y = self._dataset_input(X, y)
+
         start = datetime.now()
 
         X_norm = self._normalization(X, y)
@@ -395,30 +766,188 @@ class LathesModel(object):
 
         self._tsfresh_selection(X_extracted)
 
-        self.tsfresh_time_ = datetime.now() - start
+        self._compile_features(X_norm)
 
-        self._pca()
+        self.tsfresh_time_ = datetime.now() - start
 
-        self._soda()
+        self.stage_cache_.clear()
 
-        self._grouping_algorithm()
+        self._fit_stages()
     
-        try:
-            self.clf.fit(self.X_projected_, self.classifiers_label_)
-            self.one_class_ = False
-        except:
-            self.one_class_ = True
+        self._fit_classifier()
 
         self.already_fitted_ = True
 
         self.fit_time_ = datetime.now() - start
 
-    def fit_predict(self, X, y):
+    @_instrumented('partial_fit')
+    def partial_fit(self, X, y=None, refit=None):
+        """Update the fitted model with new timeseries X and target y
+
+        Scalers, TSFRESH selection and PCA are kept as fitted in .fit. The new
+        timeseries are projected and absorbed by the DA planes of SODA in evolving
+        mode, then associated to the data clouds of the current focal points, whose
+        class counts and grouping decisions are updated. Training arrays grow
+        geometrically, so a call costs amortized O(n_new_timeseries).
+
+        Every 'partial_refit_every_' calls, when refit is True or when y has a
+        class missing in 'classes_', 'partial_refit' identifies the focal points
+        again from the updated DA planes and fits the grouping algorithm and the
+        classifier on all training timeseries. Between refits the classifier (in
+        'clf' predict mode) doesn't know the new timeseries and 'classifiers_label_'
+        of previous timeseries keeps the decisions of their data clouds at the time
+        they were added.
+
+        If the model wasn't fitted before the model will be fitted from the start.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_new_timeseries*n_measures_, n_sensors+2)
+            or np.array, shape (n_new_timeseries, n_measures_, n_sensors)
+            or LathesDataset
+            New training data
+
+        y : np.array, shape (n_new_timeseries*n_measures_)
+            Target for new training data, dataset target if None
+
+        refit: bool, default=None
+            True refits after the update, False doesn't, None refits every
+            'partial_refit_every_' calls
+        """
+        X, y = self._dataset_input(X, y)
+
+        if not self.already_fitted_:
+            print('Fitting from start!')
+            self.fit(X, y)
+            return
+
+        X_norm = self._predict_normalization(X)
+
+        X_selected = self._extract_selected_features(X_norm)
+
+        X_projected = self.pca.transform(self.pca_scaler.transform(X_selected))
+        target = self._timeseries_target(X, y)
+        n_new = X_projected.shape[0]
+
+        with self._stage('division', n_new):
+            SystemParams, _, _ = chessboard_online_division(X_projected, self.SODA_output_['SystemParams'], 'euclidean')
+
+        with self._stage('recruitment', n_new):
+            Center = self.SODA_output_['C']
+            clouds = cloud_member_recruitment_njit(len(Center), np.array(Center), X_projected, None, None, 
+                                                   'euclidean', backend=self.soda_backend_).astype(np.intp)
+
+        # cached stages and copies may share the previous arrays, they are not changed in place
+        self.stage_cache_.clear()
+        X_selected.index = np.arange(self.n_timeseries_ + 1, self.n_timeseries_ + n_new + 1)
+        self._append_selected(X_selected)
+        self._append('X_projected_', X_projected)
+        self._append('target_', target)
+        self._append('SODA_IDX_', clouds + 1)
+        self.SODA_output_ = dict(self.SODA_output_, SystemParams=SystemParams, IDX=self.SODA_IDX_)
+        self.n_timeseries_ += n_new
+
+        new_classes = not np.isin(target, self.classes_).all()
+        if not new_classes:
+            with self._stage('grouping', n_new):
+                n_clouds = max(self.cloud_counts_.shape[0], int(clouds.max()) + 1 if n_new else 0)
+                counts = np.zeros((n_clouds, self.classes_.shape[0]), dtype=self.cloud_counts_.dtype)
+                counts[:self.cloud_counts_.shape[0]] = self.cloud_counts_
+                np.add.at(counts, (clouds, np.searchsorted(self.classes_, target)), 1)
+                self.cloud_counts_ = counts
+                self._cloud_decisions()
+                self._append('classifiers_label_', self.classes_[self.cloud_decision_[clouds]])
+            if getattr(self, 'predict_mode_', 'clf') == 'soda':
+                # indexing the focal points is cheap, their labels follow every update
+                self._fit_classifier()
+
+        self.partial_fits_since_refit_ = getattr(self, 'partial_fits_since_refit_', 0) + 1
+        if refit is None:
+            refit = self.partial_fits_since_refit_ >= getattr(self, 'partial_refit_every_', 1)
+        if refit or new_classes:
+            self.partial_refit()
+
+    @_instrumented('partial_refit')
+    def partial_refit(self):
+        """ Refit after .partial_fit
+        Focal points are updated from the DA planes changed by .partial_fit (see
+        SODA.online_peak_identification), all training timeseries are associated
+        to their data clouds and the grouping algorithm and classifier are fitted again"""
+        SystemParams = self.SODA_output_['SystemParams']
+        _, grid_trad, grid_angl = chessboard_online_division(np.empty((0, self.X_projected_.shape[1])),
+                                                             SystemParams, 'euclidean')
+
+        with self._stage('peak_identification', len(SystemParams.get('Changed') or ())):
+            Center, ModeNumber = online_peak_identification(SystemParams, grid_trad, grid_angl)
+
+        with self._stage('recruitment', self.X_projected_.shape[0]):
+            IDX = cloud_member_recruitment_njit(ModeNumber, np.array(Center), self.X_projected_, None, None,
+                                                'euclidean', backend=self.soda_backend_)
+        self.SODA_IDX_ = IDX.astype(np.intp) + 1
+        self.SODA_output_ = dict(self.SODA_output_, C=Center, IDX=self.SODA_IDX_)
+
+        self.stage_cache_.clear()
+
+        self._grouping_algorithm()
+
+        self._fit_classifier()
+
+        self.partial_fits_since_refit_ = 0
+
+    def _append(self, attribute, values):
+        """ Append values to the array attribute
+        The attribute is a view of a buffer growing geometrically, so appends cost
+        amortized O(len(values)). Rows already in a view are never written: the
+        buffer is only extended in place by the view ending at its last used row
+        (shallow copies of the model share buffers)"""
+        current = np.asarray(getattr(self, attribute))
+        buffers = self.__dict__.setdefault('_growth_buffers', {})
+        buffer, used = buffers.get(attribute, (None, 0))
+        n, m = current.shape[0], len(values)
+        dtype = np.result_type(current, values)
+        if (buffer is None or current.base is not buffer or used != n or buffer.shape[0] < n + m
+                or buffer.dtype != dtype):
+            buffer = np.empty((max(2*n, n + m),) + current.shape[1:], dtype=dtype)
+            buffer[:n] = current
+        buffer[n:n + m] = values
+        buffers[attribute] = (buffer, n + m)
+        setattr(self, attribute, buffer[:n + m])
+
+    def _append_selected(self, X_selected):
+        """ Queue features of new timeseries, they are added to 'X_selected_' when it is read """
+        state = self._selected_state()
+        # a new list, shallow copies of the model may share the previous one
+        state['_X_selected_pending'] = state['_X_selected_pending'] + [X_selected]
+
+    def _selected_state(self):
+        """ Instance dictionary, with 'X_selected_' of older pickles moved behind the property """
+        state = self.__dict__
+        if '_X_selected' not in state:
+            state['_X_selected'] = state.pop('X_selected_', None)
+            state['_X_selected_pending'] = []
+        return state
+
+    @property
+    def X_selected_(self):
+        state = self._selected_state()
+        if state['_X_selected_pending']:
+            state['_X_selected'] = pd.concat([state['_X_selected']] + state['_X_selected_pending'])
+            state['_X_selected_pending'] = []
+        return state['_X_selected']
+
+    @X_selected_.setter
+    def X_selected_(self, value):
+        self.__dict__['_X_selected'] = value
+        self.__dict__['_X_selected_pending'] = []
+
+    @_instrumented('fit_predict')
+    def fit_predict(self, X, y=None):
         """Fit the model with X and target y and predict the target after that
 
         Parameters
         ----------
         X : array-like, shape (n_timeseries_*n_measures_, n_sensors+2)
+            or np.array, shape (n_timeseries_, n_measures_, n_sensors)
             Training data
 
         y : np.array, shape (n_timeseries_*n_measures_)
@@ -431,16 +960,19 @@ class LathesModel(object):
         """
         self.fit(X, y)
 
-        y_pred = self.clf.predict(self.X_projected_)
+        y_pred = self._classify(self.X_projected_)
 
         return y_pred
 
+    @_instrumented('predict')
     def predict(self,X):
         """Predict using the trained model
 
         Parameters
         ----------
         X : np.array, shape (n_timeseries_*n_measures_, n_sensors+2)
+            or np.array, shape (n_timeseries, n_measures_, n_sensors)
+            or LathesDataset
             The input data.
 
         Returns
@@ -449,6 +981,8 @@ class LathesModel(object):
             The predicted class for each timeseries presented to the model.
         """
 
+        X, _ = self._dataset_input(X)
+
         if self.one_class_:
             return
         else:
@@ -462,7 +996,7 @@ class LathesModel(object):
 
             self._predict_pca()
 
-            y_pred = self.clf.predict(self.X_test_projected_)
+            y_pred = self._classify(self.X_test_projected_)
 
             self.already_tested_ = True
 
@@ -470,12 +1004,75 @@ class LathesModel(object):
 
         return y_pred
     
+    @_instrumented('predict_batch', lambda self, r: len(r))
+    def predict_batch(self, X):
+        """Predict a batch of measurements without changing the model
+
+        Unlike .predict no attribute is set and no timing is stored. Features are
+        calculated by 'feature_plan_' or, without it, by TSFRESH, both in the calling
+        thread without the shared worker pool or the feature cache. They are imputed
+        with the statistics of training features ('impute_values_'), so a measurement
+        gets the same features in any batch, and projected by the fused affine
+        transform 'projection_matrix_', 'projection_offset_' before the classifier.
+
+        Parameters
+        ----------
+        X : np.array, shape (n_timeseries, n_measures_, n_sensors)
+            The input data, not normalized
+
+        Returns
+        -------
+        y_pred : np.array (n_timeseries,)
+            The predicted class for each timeseries, for a model with only one
+            class that class is predicted for every timeseries
+        """
+        if not self.already_fitted_:
+            raise Exception('Model not fitted!')
+        X = np.asarray(X)
+        if X.ndim != 3:
+            raise ValueError('X must have shape (n_timeseries, n_measures, n_sensors)')
+        if self.one_class_:
+            return np.full(X.shape[0], self.classifiers_label_[0])
+
+        with self._stage('normalization', X.shape[0]):
+            X_norm = self._tensor_normalization(X)
+        if getattr(self, 'feature_plan_', None) is not None:
+            with self._stage('extraction', X.shape[0]):
+                features = self.feature_plan_.transform(X_norm, n_jobs=0)
+        else:
+            features = self._extract_selected_features(X_norm, imputed=False, n_jobs=0).values
+        # models saved before 'impute_values_' impute with the batch itself
+        features = impute_array(features, getattr(self, 'impute_values_', None))
+
+        with self._stage('pca', X.shape[0]):
+            X_projected = features @ self.projection_matrix_ + self.projection_offset_
+        return self._classify(X_projected)
+
+    def predict_one(self, measurement):
+        """Predict a single measurement without changing the model, see 'predict_batch'
+
+        Parameters
+        ----------
+        measurement : np.array, shape (n_measures_, n_sensors)
+            The input data, not normalized
+
+        Returns
+        -------
+        y_pred : float
+            The predicted class
+        """
+        return self.predict_batch(np.asarray(measurement)[None])[0]
+
+    @_instrumented('fit_after_tsfresh')
     def fit_after_tsfresh(self,X,y):
         """Fit the model with X and target y after TSFRESH extraction
         and selection already had been performed.
         This method is useful for train the model after change some parameter
         as N_PCs, granularity or classifier without the need of execute the TSFRESH
         extraction module again.
+        PCA, SODA and grouping algorithm are only executed when a hyperparam they
+        depend on changed (see 'stage_cache_'), so changing only the classifier
+        costs only the classifier fitting.
 
         If the model wasn't fitted before the model will be fitted from the start.
 
@@ -489,23 +1086,16 @@ class LathesModel(object):
         """
         if self.already_fitted_:
             start = datetime.now()
-            self._pca()
+            self._fit_stages()
 
-            self._soda()
-
-            self._grouping_algorithm()
-
-            try:
-                self.clf.fit(self.X_projected_, self.classifiers_label_)
-                self.one_class_ = False
-            except:
-                self.one_class_ = True
+            self._fit_classifier()
 
             self.fit_time_ = datetime.now() - start + self.tsfresh_time_
         else:
             print('Fitting from start!')
             self.fit(X,y)
 
+    @_instrumented('predict_after_tsfresh')
     def predict_after_tsfresh(self, X):
         """ Predict using trained model same dataset that was last predicted.
         This method is useful for predict the model after change some parameter
@@ -527,7 +1117,7 @@ class LathesModel(object):
                 return
             else:
                 start = datetime.now()
-                y_pred = self.clf.predict(self.X_test_projected_)
+                y_pred = self._classify(self.X_test_projected_)
 
                 self.predict_time_ = datetime.now() - start + self.tsfresh_predict_time_
 
@@ -555,13 +1145,158 @@ class LathesModel(object):
                 SODA granularity, sensibility factor for data partitioning module
             'percent': float
                 purity percent for grouping algorithm, must be within (50, 100) interval
+            'soda_backend': str
+                SODA backend, 'numpy' or 'numba'
+            'predict_mode': str
+                'clf' or 'soda'
         """
 
         for p in params:
             if p == 'clf':
-                exec('self.{} = {}'.format(p, params[p]))
+                setattr(self, p, params[p])
             else:
-                exec('self.{}_ = {}'.format(p, params[p]))
+                setattr(self, p + '_', params[p])
+
+    @_instrumented('grid_search')
+    def grid_search(self, X, y, param_grid, X_test=None, y_test=None, n_jobs=None):
+        """Evaluate hyperparams combinations reusing TSFRESH features
+
+        TSFRESH extraction and selection are executed once (by .fit, if the model
+        wasn't fitted before) and the features of X_test are extracted once. Each
+        combination then runs PCA, SODA, grouping algorithm and classifier fitting
+        in a process pool, the workers share the feature matrices read-only.
+        The model itself is not changed by the search.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_timeseries_*n_measures_, n_sensors+2)
+            or np.array, shape (n_timeseries_, n_measures_, n_sensors)
+            or LathesDataset
+            Training data, only used if the model wasn't fitted before
+        y : np.array, shape (n_timeseries_*n_measures_)
+            Target for training data
+        param_grid: dict or list of dicts
+            hyperparams values to combine, keys as in 'change_hyperparams',
+            e.g. {'granularity': [2, 3, 4], 'clf': [SVC(), GaussianNB()]}
+        X_test : same formats as X, default=None
+            Test data, when given each combination is scored on it
+        y_test : np.array, shape (n_test_timeseries*n_measures_)
+            Target for test data
+        n_jobs: int, default=None
+            The number of processes used by the search, 'n_jobs_' if None
+            0 or 1 runs the search in this process
+
+        Returns
+        -------
+        results: pd.DataFrame
+            one row per combination with its hyperparams, number of data clouds,
+            'one_class', 'Fit_Time' and, when X_test is given, 'Accuracy',
+            'Precision', 'Recall', 'F1' (in %) and 'Predict_Time'
+        """
+        if not self.already_fitted_:
+            print('Fitting from start!')
+            self.fit(X, y)
+
+        X_test_selected = None
+        if X_test is not None:
+            X_test, y_test = self._dataset_input(X_test, y_test)
+            X_test_selected = self._extract_selected_features(self._predict_normalization(X_test))
+            y_test = self._timeseries_target(X_test, y_test)
+
+        if n_jobs is None:
+            n_jobs = self.n_jobs_
+
+        base = copy.copy(self)
+        base._distributor = None
+        base.stage_cache_ = OrderedDict(self.stage_cache_)
+        grid = list(ParameterGrid(param_grid))
+
+        if n_jobs in (0, 1):
+            results = [_evaluate_hyperparams(base, params, X_test_selected, y_test) for params in grid]
+        else:
+            with Pool(n_jobs, initializer=_grid_search_init, initargs=(base, X_test_selected, y_test)) as pool:
+                results = pool.map(_grid_search_worker, grid)
+
+        return pd.DataFrame(results)
+
+    @_instrumented('cross_validate')
+    def cross_validate(self, X, y=None, n_splits=5, n_repeats=1, random_state=None, n_jobs=None,
+                       fold_scaling=False):
+        """Repeated stratified K-fold cross validation
+
+        Normalization and TSFRESH extraction run once for all timeseries and
+        their features are reused by every fold, each fold runs the stages from
+        TSFRESH feature selection on (selection, PCA, SODA, grouping algorithm
+        and classifier fitting) on its training timeseries and is scored on its
+        test timeseries. The normalization scaler is unsupervised but it sees the
+        test timeseries too, so the estimate is slightly optimistic.
+
+        With fold_scaling=True the scaler is fitted on the training timeseries
+        of each fold instead, and every fold normalizes and extracts its
+        timeseries again: a 10x5 cross validation runs 50 TSFRESH extractions.
+        'feature_cache_' doesn't help there, the normalized timeseries (and
+        their cache keys) change with each fold's scaler.
+
+        Folds are evaluated in a process pool, the workers share the feature
+        matrix (or the data) read-only. The model itself is not changed.
+
+        Parameters
+        ----------
+        X : array-like, shape (n_timeseries*n_measures, n_sensors+2)
+            or np.array, shape (n_timeseries, n_measures, n_sensors)
+            or LathesDataset
+        y : np.array, shape (n_timeseries*n_measures)
+            Target, see .fit
+        n_splits: int, default=5
+        n_repeats: int, default=1
+            e.g. n_splits=5 and n_repeats=10 gives 10x5 cross validation
+        random_state: int, default=None
+        n_jobs: int, default=None
+            The number of processes used by the folds, 'n_jobs_' if None
+            0 or 1 evaluates the folds in this process
+        fold_scaling: bool, default=False
+            fit the normalization scaler on the training timeseries of each fold,
+            extracting TSFRESH features per fold
+
+        Returns
+        -------
+        results: pd.DataFrame
+            one row per fold with 'Repeat', 'Fold', 'Fold_Scaling', 'Train_Size',
+            'Test_Size', number of selected 'Features', 'Data_Clouds', 'one_class',
+            'Fit_Time' and, unless one_class, 'Accuracy', 'Precision', 'Recall',
+            'F1' (in %) and 'Predict_Time'. 'Fold_Scaling' False marks the
+            estimates with a scaler fitted on all timeseries
+        """
+        X, y = self._dataset_input(X, y)
+
+        if n_jobs is None:
+            n_jobs = self.n_jobs_
+
+        base = copy.copy(self)
+        base._distributor = None
+        base.feature_plan_ = None
+        base.stage_cache_ = OrderedDict()
+        if fold_scaling:
+            data = (X, y)
+            target = _measurement_target(X, y)
+        else:
+            data = base._tsfresh_extraction(base._normalization(X, y))
+            target = base.target_
+        if n_jobs not in (0, 1):
+            # pool workers are daemonic, TSFRESH must run in the worker itself
+            base.n_jobs_ = 0
+
+        splitter = RepeatedStratifiedKFold(n_splits=n_splits, n_repeats=n_repeats, random_state=random_state)
+        folds = [(i // n_splits, i % n_splits, train_idx, test_idx)
+                 for i, (train_idx, test_idx) in enumerate(_sorted_splits(splitter, target))]
+
+        if n_jobs in (0, 1):
+            results = [_evaluate_fold(base, data, target, fold) for fold in folds]
+        else:
+            with Pool(n_jobs, initializer=_cross_validate_init, initargs=(base, data, target)) as pool:
+                results = pool.map(_cross_validate_worker, folds)
+
+        return pd.DataFrame(results)
 
     ### PCA Analysis
 
@@ -951,36 +1686,203 @@ class LathesModel(object):
 
 
 
-from sklearn.model_selection import train_test_split
+def _evaluate_hyperparams(model, params, X_test_selected=None, y_test=None):
+    """ Fit stages after TSFRESH on a shallow copy of model with params, see LathesModel.grid_search """
+    m = copy.copy(model)
+    m.change_hyperparams(params)
+    m.clf = clone(m.clf)
+
+    start = datetime.now()
+    m._fit_stages()
+    m._fit_classifier()
+
+    result = dict(params)
+    result['Data_Clouds'] = m.GA_results_['Data_Clouds']
+    result['one_class'] = m.one_class_
+    result['Fit_Time'] = datetime.now() - start
+
+    if X_test_selected is not None and not m.one_class_:
+        _score_selected_features(m, X_test_selected, y_test, result)
+
+    return result
+
+def _score_selected_features(m, X_test_selected, y_test, result):
+    """ Add 'Predict_Time', 'Accuracy', 'Precision', 'Recall' and 'F1' (in %) of m on selected test features to result """
+    start = datetime.now()
+    y_pred = m._classify(m.pca.transform(m.pca_scaler.transform(X_test_selected)))
+    result['Predict_Time'] = datetime.now() - start
+    # macro average over wear classes for multi-class targets
+    average = 'binary' if np.isin(np.union1d(m.classes_, y_test), (0, 1)).all() else 'macro'
+    result['Accuracy'] = accuracy_score(y_test, y_pred)*100
+    result['Precision'] = precision_score(y_test, y_pred, average=average, zero_division=0)*100
+    result['Recall'] = recall_score(y_test, y_pred, average=average, zero_division=0)*100
+    result['F1'] = f1_score(y_test, y_pred, average=average, zero_division=0)*100
+
+_GRID_SEARCH_STATE = None
+
+def _grid_search_init(model, X_test_selected, y_test):
+    """ Pool initializer, keeps the shared state of LathesModel.grid_search in the worker """
+    global _GRID_SEARCH_STATE
+    _GRID_SEARCH_STATE = (model, X_test_selected, y_test)
+
+def _grid_search_worker(params):
+    model, X_test_selected, y_test = _GRID_SEARCH_STATE
+    return _evaluate_hyperparams(model, params, X_test_selected, y_test)
+
+def _evaluate_fold(model, data, target, fold):
+    """ Fit on the training measurements of fold, scored on its test measurements, see LathesModel.cross_validate
+    data is (X, y) to fit the scaler in the fold, or the features of all measurements extracted with a global scaler"""
+    repeat, k, train_idx, test_idx = fold
+    m = copy.copy(model)
+    m.clf = clone(m.clf)
+    m.stage_cache_ = OrderedDict()
+    fold_scaling = not isinstance(data, pd.DataFrame)
+
+    start = datetime.now()
+    if fold_scaling:
+        X, y = data
+        X_train, y_train = Lathes_take(X, y, train_idx)
+        X_extracted = m._tsfresh_extraction(m._normalization(X_train, y_train))
+        m._tsfresh_selection(X_extracted, n_jobs=0)
+    else:
+        m.target_ = target[train_idx]
+        m._tsfresh_selection(data.iloc[train_idx], n_jobs=0)
+    m.n_timeseries_ = train_idx.shape[0]
+    m._fit_stages()
+    m._fit_classifier()
+
+    result = {'Repeat': repeat, 'Fold': k, 'Fold_Scaling': fold_scaling, 'Train_Size': train_idx.shape[0],
+              'Test_Size': test_idx.shape[0], 'Features': len(m.selected_columns_),
+              'Data_Clouds': m.GA_results_['Data_Clouds'], 'one_class': m.one_class_,
+              'Fit_Time': datetime.now() - start}
+
+    if not m.one_class_:
+        if fold_scaling:
+            X_test_selected = m._extract_selected_features(m._predict_normalization(Lathes_take(X, y, test_idx)[0]))
+        else:
+            X_test_selected = data.iloc[test_idx][m.selected_columns_]
+        _score_selected_features(m, X_test_selected, target[test_idx], result)
+    m.close()
+
+    return result
+
+_CROSS_VALIDATE_STATE = None
+
+def _cross_validate_init(model, data, target):
+    """ Pool initializer, keeps the shared state of LathesModel.cross_validate in the worker """
+    global _CROSS_VALIDATE_STATE
+    _CROSS_VALIDATE_STATE = (model, data, target)
+
+def _cross_validate_worker(fold):
+    model, data, target = _CROSS_VALIDATE_STATE
+    return _evaluate_fold(model, data, target, fold)
+
+
+from sklearn.model_selection import train_test_split, RepeatedStratifiedKFold, StratifiedShuffleSplit
+
+def _measurement_target(X, y):
+    """ One target per measurement of X, see Lathes_train_test_split for the formats of X and y """
+    if isinstance(X, LathesDataset):
+        return X.target_ if y is None else np.asarray(y)
+    y = np.asarray(y)
+    if np.ndim(X) == 3:
+        return y if y.shape[0] == X.shape[0] else y[::X.shape[1]]
+    return y[::int(X[:,1].max())]
+
+def _sorted_splits(splitter, target):
+    """ (train_idx, test_idx) of splitter on measurements with target, indices in increasing order """
+    for train_idx, test_idx in splitter.split(np.zeros((target.shape[0], 1)), target):
+        yield np.sort(train_idx), np.sort(test_idx)
+
+def Lathes_take(X, y, idx):
+    """Measurements idx of X and y
+
+    Long format X is seen as a (n_timeseries, n_measures, n_sensors+2) view, so
+    the rows of all selected measurements are gathered with a single indexing.
+    A LathesDataset only reads the selected measurements from disk, y=None uses
+    its target.
+
+    Parameters
+    ----------
+    X, y: see Lathes_train_test_split, rows of long format X sorted by ID and Time_ID
+    idx: np.array
+        positions of the measurements (0 to n_timeseries-1)
+
+    Returns
+    -------
+    X_idx, y_idx: same formats as X and y, LathesDataset gives a tensor and one target per timeserie
+    """
+    if isinstance(X, LathesDataset):
+        target = X.target_ if y is None else np.asarray(y)
+        return X.tensor(X.ids_[idx]), target[idx]
+
+    y = np.asarray(y)
+    if np.ndim(X) == 3:
+        if y.shape[0] == X.shape[0]:
+            return X[idx], y[idx]
+        return X[idx], y.reshape(X.shape[0], -1)[idx].ravel()
 
-def Lathes_train_test_split(X, y, test_size, random_state):
     n_measures = int(X[:,1].max())
-    n_timeseries = int(X[:,0].max())
-    
-    index = X[::n_measures,0].astype(int) - 1
-    target = y[::n_measures]
+    n_timeseries = X.shape[0] // n_measures
+    X_idx = X.reshape(n_timeseries, n_measures, X.shape[1])[idx].reshape(-1, X.shape[1])
+    return X_idx, y.reshape(n_timeseries, n_measures)[idx].ravel()
 
-    L, W = X.shape
+def Lathes_train_test_split(X, y, test_size, random_state):
+    """Stratified split of timeseries in train and test sets
+
+    X can be in long format, shape (n_timeseries*n_measures, n_sensors+2), or a
+    tensor, shape (n_timeseries, n_measures, n_sensors). Tensors are split on the
+    first axis and y can be given per measure or per timeserie (shape (n_timeseries,)).
 
-    train_idx, test_idx, train_target, test_target = train_test_split(index, target, test_size=test_size, 
-                                                                    stratify=target, random_state=random_state)
+    X can also be a LathesDataset, y=None uses its target. The split is made on
+    measurement IDs and only the selected measurements are read from disk, the
+    sets are returned as tensors with one target per timeserie.
+    """
+    target = _measurement_target(X, y)
+    train_idx, test_idx = train_test_split(np.arange(target.shape[0]), test_size=test_size, 
+                                           stratify=target, random_state=random_state)
     train_idx.sort()
     test_idx.sort()
 
-    L_train = train_idx.shape[0]
-    train_index = np.zeros(L_train*n_measures, dtype=np.int32)
-    for ii in range(L_train):
-        train_index[ii*n_measures:(ii+1)*n_measures] = list(range(train_idx[ii]*n_measures,
-                                                                    (train_idx[ii]+1)*n_measures)) 
-    L_test = test_idx.shape[0]
-    test_index = np.zeros(L_test*n_measures, dtype=np.int32)
-    for ii in range(L_test):
-        test_index[ii*n_measures:(ii+1)*n_measures] = list(range(test_idx[ii]*n_measures,
-                                                                    (test_idx[ii]+1)*n_measures)) 
-        
-    X_train = X[train_index,:]
-    y_train = y[train_index]
-    X_test = X[test_index,:]
-    y_test = y[test_index]
+    X_train, y_train = Lathes_take(X, y, train_idx)
+    X_test, y_test = Lathes_take(X, y, test_idx)
 
     return X_train, X_test, y_train, y_test
+
+def Lathes_stratified_kfold(X, y, n_splits=5, n_repeats=1, random_state=None):
+    """Stratified K-fold of timeseries, repeated with different shuffles
+
+    Folds are made on measurements and only their positions are yielded, X is
+    not copied until the sets are built with 'Lathes_take'.
+
+    Parameters
+    ----------
+    X, y: see Lathes_train_test_split
+    n_splits: int, default=5
+    n_repeats: int, default=1
+        e.g. n_splits=5 and n_repeats=10 gives 10x5 cross validation
+    random_state: int, default=None
+
+    Yields
+    ------
+    train_idx, test_idx: np.array
+        positions of the measurements (0 to n_timeseries-1), in increasing order
+    """
+    splitter = RepeatedStratifiedKFold(n_splits=n_splits, n_repeats=n_repeats, random_state=random_state)
+    return _sorted_splits(splitter, _measurement_target(X, y))
+
+def Lathes_repeated_split(X, y, test_size, n_splits=10, random_state=None):
+    """Repeated stratified train and test splits of timeseries
+
+    Each split is drawn like Lathes_train_test_split, test sets of different
+    splits may overlap. See 'Lathes_stratified_kfold' for the yielded positions.
+
+    Parameters
+    ----------
+    X, y, test_size: see Lathes_train_test_split
+    n_splits: int, default=10
+        number of splits
+    random_state: int, default=None
+    """
+    splitter = StratifiedShuffleSplit(n_splits=n_splits, test_size=test_size, random_state=random_state)
+    return _sorted_splits(splitter, _measurement_target(X, y))
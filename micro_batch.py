@@ -0,0 +1,152 @@
+import queue
+import threading
+from concurrent.futures import Future
+from time import perf_counter
+
+import numpy as np
+
+# Micro-batching Scheduler
+#
+# Feature extraction is much cheaper per measurement on large batches, while
+# each lathe produces one measurement at a time. MicroBatchScheduler collects
+# the measurements submitted by every source, stacks them into one array,
+# calls process on it and sends each caller its own result through a Future.
+#
+# Flush policies
+#   'deadline': a batch is processed when it has max_batch_size items or
+#               max_wait_ms after its first item, whichever comes first
+#   'greedy':   a batch is processed with whatever is queued when a worker is
+#               free, never waiting (lowest latency at low load, batches still
+#               grow when the workers fall behind)
+
+FLUSH_POLICIES = ('deadline', 'greedy')
+
+
+class MicroBatchScheduler(object):
+    """Batch items submitted from many threads
+
+    Parameters
+    ----------
+    process: callable
+        process(batch) -> results, batch is np.array, shape (n_items, ...),
+        results has one element per item (e.g. LathesModel.predict_batch)
+    max_batch_size: int, default=32
+        maximum number of items in a batch
+    max_wait_ms: float, default=5.0
+        maximum time a batch waits for more items, 'deadline' policy only
+    flush_policy: str, default='deadline'
+        'deadline' or 'greedy', see module description
+    n_workers: int, default=1
+        number of threads calling process
+    on_batch: callable, default=None
+        on_batch(batch_size, seconds) called after each batch, e.g. for metrics
+
+    Attributes
+    ----------
+    queue_: queue.Queue
+        items waiting for a batch, as (item, future)
+    """
+    def __init__(self, process, max_batch_size=32, max_wait_ms=5.0, flush_policy='deadline', n_workers=1,
+                 on_batch=None):
+        if flush_policy not in FLUSH_POLICIES:
+            raise ValueError('flush_policy must be one of {}'.format(FLUSH_POLICIES))
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1')
+        self.process_ = process
+        self.max_batch_size_ = max_batch_size
+        self.max_wait_ms_ = max_wait_ms
+        self.flush_policy_ = flush_policy
+        self.n_workers_ = n_workers
+        self.on_batch_ = on_batch
+        self.queue_ = queue.Queue()
+        self._workers = []
+
+    def start(self):
+        """ Start the workers, returns self """
+        for _ in range(self.n_workers_):
+            worker = threading.Thread(target=self._worker, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        return self
+
+    def stop(self):
+        """ Stop the workers, queued items are processed first """
+        for _ in self._workers:
+            self.queue_.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def submit(self, item):
+        """Queue an item
+
+        Returns
+        -------
+        result: concurrent.futures.Future
+            resolves to the result of the item, or raises the exception of its batch,
+            cancelling it before its batch starts drops the item
+        """
+        future = Future()
+        self.queue_.put((item, future))
+        return future
+
+    def pending(self):
+        """ Number of items waiting for a batch """
+        return self.queue_.qsize()
+
+    def running(self):
+        """ True between .start and .stop """
+        return bool(self._workers)
+
+    def _next_batch(self):
+        """ Wait for an item and gather the batch it starts, None when stopping """
+        item = self.queue_.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = perf_counter() + self.max_wait_ms_/1000
+        while len(batch) < self.max_batch_size_:
+            remaining = deadline - perf_counter()
+            try:
+                if self.flush_policy_ == 'deadline' and remaining > 0:
+                    item = self.queue_.get(timeout=remaining)
+                else:
+                    item = self.queue_.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # stop after this batch
+                self.queue_.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            # items whose future was cancelled while queued are not processed
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            start = perf_counter()
+            try:
+                results = self.process_(np.stack([item for item, _ in batch]))
+                error = None
+            except Exception as e:
+                error = e
+            if self.on_batch_ is not None:
+                self.on_batch_(len(batch), perf_counter() - start)
+
+            for i, (_, future) in enumerate(batch):
+                if error is None:
+                    future.set_result(results[i])
+                else:
+                    future.set_exception(error)
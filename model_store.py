@@ -0,0 +1,150 @@
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+
+# Object store with memory-mapped arrays
+#
+# An object is saved to a directory with two files:
+#  - arrays.bin: the numeric np.arrays found anywhere in the object (model
+#    attributes, fitted sklearn estimators, pandas blocks), each aligned
+#    to ARRAY_ALIGNMENT bytes
+#  - metadata.pkl: the pickled object, where every array of arrays.bin is
+#    replaced by its (offset, dtype, shape, order) reference
+# An array referenced several times (e.g. by the model and its stage cache) is
+# written once and loaded as a single array.
+# On load arrays.bin is memory-mapped, so loading doesn't read the arrays and
+# processes loading the same store share their pages.
+#
+# metadata.pkl is a pickle, only load stores from trusted sources.
+
+FORMAT_VERSION = 1
+ARRAY_ALIGNMENT = 64
+MIN_ARRAY_BYTES = 1024
+
+
+class _ArrayPickler(pickle.Pickler):
+    """ Pickler writing large numeric arrays to a binary file """
+    def __init__(self, file, array_file):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.array_file = array_file
+        self.offset = 0
+        # persistent_id runs before the pickle memo, arrays are memoized here
+        # (the arrays are kept so their ids aren't reused during the dump)
+        self.references = {}
+        self.arrays = []
+
+    def persistent_id(self, obj):
+        if type(obj) is not np.ndarray and not isinstance(obj, np.memmap):
+            return None
+        if obj.dtype.hasobject or obj.nbytes < MIN_ARRAY_BYTES:
+            return None
+        if id(obj) in self.references:
+            return self.references[id(obj)]
+
+        order = 'F' if obj.flags.f_contiguous and not obj.flags.c_contiguous else 'C'
+        padding = -self.offset % ARRAY_ALIGNMENT
+        self.array_file.write(b'\0' * padding)
+        self.offset += padding
+
+        reference = ('ndarray', self.offset, obj.dtype.str, obj.shape, order)
+        data = np.asarray(obj, order=order)
+        self.array_file.write(data.tobytes(order=order))
+        self.offset += data.nbytes
+        self.references[id(obj)] = reference
+        self.arrays.append(obj)
+        return reference
+
+
+class _ArrayUnpickler(pickle.Unpickler):
+    """ Unpickler reading arrays from a memory-mapped binary file """
+    def __init__(self, file, array_path, mmap_mode):
+        super().__init__(file)
+        self.array_path = array_path
+        self.mmap_mode = mmap_mode
+        self.arrays = {}
+
+    def persistent_load(self, pid):
+        if pid not in self.arrays:
+            self.arrays[pid] = self._load_array(pid)
+        return self.arrays[pid]
+
+    def _load_array(self, pid):
+        kind, offset, dtype, shape, order = pid
+        if kind != 'ndarray':
+            raise pickle.UnpicklingError('Unknown reference {}'.format(kind))
+        dtype = np.dtype(dtype)
+        if int(np.prod(shape)) == 0:
+            return np.empty(shape, dtype=dtype, order=order)
+        if self.mmap_mode is None:
+            with open(self.array_path, 'rb') as f:
+                f.seek(offset)
+                data = np.fromfile(f, dtype=dtype, count=int(np.prod(shape)))
+            return data.reshape(shape, order=order)
+        data = np.memmap(self.array_path, dtype=dtype, mode=self.mmap_mode, offset=offset,
+                         shape=shape, order=order)
+        return np.asarray(data)
+
+
+def save_object(obj, path):
+    """Save obj to a store directory
+
+    The store is written to a temporary directory next to path, which then
+    replaces path, so a store being overwritten is never left half written
+    (metadata and arrays always come from the same save). An existing store is
+    renamed aside before the new one takes its place and deleted afterwards.
+
+    Parameters
+    ----------
+    obj: object
+        any picklable object
+    path: str or PATH
+        store directory, created if needed
+    """
+    path = os.path.abspath(str(path))
+    parent, name = os.path.split(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix='.' + name + '.', suffix='.tmp', dir=parent)
+    os.chmod(tmp_path, 0o755)
+    try:
+        with open(os.path.join(tmp_path, 'arrays.bin'), 'wb') as array_file, \
+             open(os.path.join(tmp_path, 'metadata.pkl'), 'wb') as metadata_file:
+            pickle.dump(FORMAT_VERSION, metadata_file, protocol=pickle.HIGHEST_PROTOCOL)
+            _ArrayPickler(metadata_file, array_file).dump(obj)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    old_path = None
+    if os.path.exists(path):
+        old_path = tempfile.mkdtemp(prefix='.' + name + '.', suffix='.old', dir=parent)
+        os.rename(path, os.path.join(old_path, name))
+    os.rename(tmp_path, path)
+    if old_path is not None:
+        shutil.rmtree(old_path, ignore_errors=True)
+
+def load_object(path, mmap_mode='c'):
+    """Load an object saved by 'save_object'
+
+    Parameters
+    ----------
+    path: str or PATH
+        store directory
+    mmap_mode: str, default='c'
+        np.memmap mode of the arrays
+        'c' (copy-on-write) arrays can be changed without changing the store
+        'r' arrays are read-only
+        None reads the arrays into memory
+
+    Returns
+    -------
+    obj: object
+    """
+    path = str(path)
+    with open(os.path.join(path, 'metadata.pkl'), 'rb') as metadata_file:
+        version = pickle.load(metadata_file)
+        if version != FORMAT_VERSION:
+            raise Exception('Unsupported store version {}!'.format(version))
+        return _ArrayUnpickler(metadata_file, os.path.join(path, 'arrays.bin'), mmap_mode).load()
@@ -0,0 +1,235 @@
+import json
+import threading
+import tracemalloc
+from time import perf_counter, process_time
+
+import pandas as pd
+
+# Stage Instrumentation
+#
+# LathesModel and SODA wrap each stage in 'with profiler.stage(name, items):'.
+# The default profiler is NULL_PROFILER, whose stage() returns one shared
+# context manager doing nothing, so instrumentation costs a method call per
+# stage when disabled.
+#
+# A Profiler records one dictionary per executed stage:
+#     'stage': str, stage name, nested stages are prefixed by their parent
+#              (e.g. 'fit/soda/density')
+#     'wall_time': float, seconds
+#     'cpu_time': float, seconds of CPU time of this process (all threads)
+#     'peak_memory': int, peak bytes allocated during the stage above the
+#                    allocations at its start, None if memory=False or the
+#                    stage overlapped a stage of another thread
+#     'items': int, number of items processed (timeseries, samples, ...), None if unknown
+# and calls every hook with it when the stage ends.
+#
+# Peak memory is traced with tracemalloc, it covers NumPy and Python
+# allocations of this process (not TSFRESH worker processes) and slows down
+# Python heavy stages, use memory=False to measure times only. The tracemalloc
+# peak is process-wide, so it is only recorded for stages during which no
+# other thread ran a stage of the same profiler; stages overlapping another
+# thread's stages (inference server, micro-batch worker) get peak_memory None.
+#
+# Example
+#   profiler = Profiler(hooks=[print])
+#   model = LathesModel(profiler=profiler)
+#   model.fit(X, y)
+#   profiler.summary()
+#   profiler.to_json('fit_profile.json')
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullProfiler(object):
+    """ Disabled profiler, see module description """
+    enabled = False
+    _stage = _NullStage()
+
+    def stage(self, name, items=None):
+        return self._stage
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class _Stage(object):
+    """ Context manager recording one stage of a Profiler """
+    def __init__(self, profiler, name, items):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+        self.start_memory = self.peak = 0
+
+    def __enter__(self):
+        self.profiler._enter(self)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._exit(self)
+        return False
+
+
+class Profiler(object):
+    """Per-stage instrumentation
+
+    Parameters
+    ----------
+    hooks: list, default=None
+        callables hook(record) called when a stage ends
+    memory: bool, default=True
+        record peak memory with tracemalloc, started by the first stage if it
+        isn't tracing already and stopped by .close
+
+    Attributes
+    ----------
+    records_: list
+        one dictionary per executed stage, in order of completion
+    hooks_: list
+        hooks called when a stage ends, not saved with the model
+    """
+    enabled = True
+
+    def __init__(self, hooks=None, memory=True):
+        self.hooks_ = list(hooks) if hooks else []
+        self.memory_ = memory
+        self.records_ = []
+        self._init_runtime()
+
+    def _init_runtime(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started_tracing = False
+        # threads inside a stage, and number of times a stage started while another thread was inside one
+        self._threads = 0
+        self._overlaps = 0
+
+    def __getstate__(self):
+        """ Locks and hooks can't be pickled, records are kept """
+        return {'memory_': self.memory_, 'records_': self.records_, 'hooks_': []}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_runtime()
+
+    def add_hook(self, hook):
+        """ Call hook(record) when a stage ends """
+        self.hooks_.append(hook)
+
+    def stage(self, name, items=None):
+        """Context manager measuring a stage
+
+        Parameters
+        ----------
+        name: str
+            stage name, prefixed by the names of the enclosing stages
+        items: int, default=None
+            number of items processed by the stage
+        """
+        return _Stage(self, name, items)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _enter(self, stage):
+        stack = self._stack()
+        stage.path = '/'.join([s.path for s in stack[-1:]] + [stage.name])
+        with self._lock:
+            if not stack:
+                self._threads += 1
+            stage.concurrent = self._threads > 1
+            if stage.concurrent:
+                self._overlaps += 1
+            stage.overlaps = self._overlaps
+        if self.memory_ and not stage.concurrent:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            current, peak = tracemalloc.get_traced_memory()
+            # the peak is reset for this stage, enclosing stages keep the peak seen so far
+            for s in stack:
+                s.peak = max(s.peak, peak)
+            tracemalloc.reset_peak()
+            stage.start_memory, stage.peak = current, current
+        stack.append(stage)
+        stage.start_cpu = process_time()
+        stage.start_wall = perf_counter()
+
+    def _exit(self, stage):
+        wall_time = perf_counter() - stage.start_wall
+        cpu_time = process_time() - stage.start_cpu
+        stack = self._stack()
+        stack.pop()
+        with self._lock:
+            # another thread's stage overlapped this one, the process-wide peak isn't this stage's
+            alone = not stage.concurrent and stage.overlaps == self._overlaps
+            if not stack:
+                self._threads -= 1
+
+        peak_memory = None
+        if self.memory_ and alone and tracemalloc.is_tracing():
+            stage.peak = max(stage.peak, tracemalloc.get_traced_memory()[1])
+            peak_memory = stage.peak - stage.start_memory
+            for s in stack:
+                s.peak = max(s.peak, stage.peak)
+
+        record = {'stage': stage.path, 'wall_time': wall_time, 'cpu_time': cpu_time,
+                  'peak_memory': peak_memory, 'items': None if stage.items is None else int(stage.items)}
+        with self._lock:
+            self.records_.append(record)
+        for hook in self.hooks_:
+            hook(record)
+
+    def reset(self):
+        """ Drop recorded stages """
+        with self._lock:
+            self.records_ = []
+
+    def close(self):
+        """ Stop tracemalloc if it was started by this profiler """
+        if self._started_tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._started_tracing = False
+
+    def to_frame(self):
+        """ Recorded stages as a pd.DataFrame, one row per record """
+        return pd.DataFrame(self.records_, columns=['stage', 'wall_time', 'cpu_time', 'peak_memory', 'items'])
+
+    def summary(self):
+        """Recorded stages aggregated by name
+
+        Returns
+        -------
+        summary: pd.DataFrame
+            calls, total and mean wall time, total cpu time, maximum peak memory
+            and total items of each stage, in order of first completion
+        """
+        frame = self.to_frame()
+        summary = frame.groupby('stage', sort=False).agg(calls=('wall_time', 'size'),
+                                                        wall_time=('wall_time', 'sum'),
+                                                        mean_wall_time=('wall_time', 'mean'),
+                                                        cpu_time=('cpu_time', 'sum'),
+                                                        peak_memory=('peak_memory', 'max'),
+                                                        items=('items', 'sum'))
+        return summary
+
+    def to_json(self, path=None):
+        """Export recorded stages to JSON
+
+        Parameters
+        ----------
+        path: str or PATH, default=None
+            file to write, the JSON text is returned if None
+        """
+        text = json.dumps({'records': self.records_}, indent=1)
+        if path is None:
+            return text
+        with open(str(path), 'w') as f:
+            f.write(text)
@@ -0,0 +1,197 @@
+import numpy as np
+
+# Streaming Ingestion
+#
+# Raw samples arrive from the DAQ as interleaved sensor values
+# (Sensor_1, ..., Sensor_n, Sensor_1, ...) in chunks of any length. Each lathe
+# has a preallocated RingBuffer and a measurement is emitted, as a view of the
+# buffer, every time a window of samples completes.
+#
+# The buffer is mirrored: sample k is stored at k % capacity and at
+# k % capacity + capacity, so the last 'window' samples are always contiguous
+# and windows are returned without copying. Samples are copied in blocks,
+# there is no Python work per sample.
+#
+# A window view is overwritten once capacity - window more samples have been
+# written. Consumers keeping a measurement longer than that (e.g. queuing it in
+# a MicroBatchScheduler) must copy it.
+#
+# Example
+#   ingestor = StreamIngestor(n_sensors=6, window=750, step=250,
+#                             on_window=lambda lathe, X: print(lathe, model.predict_one(X)))
+#   ingestor.push('lathe_1', daq_chunk)
+
+
+class RingBuffer(object):
+    """Preallocated sample buffer of one lathe, emitting sliding windows
+
+    Parameters
+    ----------
+    n_sensors: int
+        number of values in each sample
+    window: int, default=750
+        samples in a measurement (n_measures_ of the model)
+    step: int, default=None
+        samples between the starts of consecutive windows, 'window' if None
+        (non-overlapping windows), smaller values give overlapping windows
+    capacity: int, default=None
+        samples kept in the buffer, 2*window if None, at least window
+    dtype: numpy dtype, default=np.float64
+
+    Attributes
+    ----------
+    buffer_: np.array, shape (2*capacity, n_sensors)
+        mirrored sample storage
+    count_: int
+        samples written since creation or .reset
+    next_end_: int
+        value of 'count_' at which the next window completes
+    """
+    def __init__(self, n_sensors, window=750, step=None, capacity=None, dtype=np.float64):
+        if step is None:
+            step = window
+        if capacity is None:
+            capacity = 2*window
+        if window < 1 or step < 1:
+            raise ValueError('window and step must be positive')
+        if capacity < window:
+            raise ValueError('capacity must be at least window')
+        self.n_sensors_ = n_sensors
+        self.window_ = window
+        self.step_ = step
+        self.capacity_ = capacity
+        self.buffer_ = np.zeros((2*capacity, n_sensors), dtype=dtype)
+        self.reset()
+
+    def reset(self):
+        """ Forget written samples, the next window starts with the next sample """
+        self.count_ = 0
+        self.next_end_ = self.window_
+
+    def latest(self):
+        """ View of the last 'window' samples, None if fewer samples were written """
+        if self.count_ < self.window_:
+            return None
+        start = (self.count_ - self.window_) % self.capacity_
+        return self.buffer_[start:start+self.window_]
+
+    def write(self, samples, on_window=None):
+        """Append samples
+
+        Parameters
+        ----------
+        samples: np.array, shape (n_samples, n_sensors)
+        on_window: callable, default=None
+            on_window(measurement) called for each completed window, measurement
+            is a view of the buffer with shape (window, n_sensors)
+
+        Returns
+        -------
+        n_windows: int
+            number of windows completed
+        """
+        samples = np.asarray(samples)
+        if samples.ndim != 2 or samples.shape[1] != self.n_sensors_:
+            raise ValueError('samples must have shape (n_samples, {})'.format(self.n_sensors_))
+
+        n_windows = 0
+        i, n = 0, samples.shape[0]
+        while i < n:
+            position = self.count_ % self.capacity_
+            # stop at the next window end, so the window is emitted before being overwritten
+            take = min(n - i, self.next_end_ - self.count_, self.capacity_ - position)
+            block = samples[i:i+take]
+            self.buffer_[position:position+take] = block
+            self.buffer_[position+self.capacity_:position+self.capacity_+take] = block
+            i += take
+            self.count_ += take
+
+            if self.count_ == self.next_end_:
+                self.next_end_ += self.step_
+                n_windows += 1
+                if on_window is not None:
+                    on_window(self.latest())
+        return n_windows
+
+
+class StreamIngestor(object):
+    """Ring buffers of many lathes fed with raw interleaved samples
+
+    Parameters
+    ----------
+    n_sensors: int
+        number of interleaved sensor values in each sample
+    window, step, capacity, dtype:
+        see RingBuffer, shared by every lathe
+    on_window: callable, default=None
+        on_window(lathe, measurement) called for each completed window,
+        measurement is a np.array view with shape (window, n_sensors)
+
+    Attributes
+    ----------
+    buffers_: dict
+        keys = lathe identifiers, values = RingBuffer
+    """
+    def __init__(self, n_sensors, window=750, step=None, capacity=None, dtype=np.float64, on_window=None):
+        self.n_sensors_ = n_sensors
+        self.window_ = window
+        self.step_ = step
+        self.capacity_ = capacity
+        self.dtype_ = dtype
+        self.on_window_ = on_window
+        self.buffers_ = {}
+        # values of an incomplete sample at the end of the last chunk of each lathe
+        self._partial = {}
+
+    def buffer(self, lathe):
+        """ RingBuffer of a lathe, allocated on its first chunk """
+        if lathe not in self.buffers_:
+            self.buffers_[lathe] = RingBuffer(self.n_sensors_, self.window_, self.step_, self.capacity_, self.dtype_)
+            self._partial[lathe] = (np.empty(self.n_sensors_, dtype=self.dtype_), 0)
+        return self.buffers_[lathe]
+
+    def push(self, lathe, values):
+        """Append raw samples of a lathe
+
+        Parameters
+        ----------
+        lathe: hashable
+            lathe identifier
+        values: np.array, shape (n_values,) or (n_samples, n_sensors)
+            interleaved sensor values, a chunk may end in the middle of a sample
+
+        Returns
+        -------
+        n_windows: int
+            number of windows completed for this lathe
+        """
+        ring = self.buffer(lathe)
+        on_window = None if self.on_window_ is None else (lambda measurement: self.on_window_(lathe, measurement))
+
+        values = np.asarray(values)
+        if values.ndim == 2:
+            if self._partial[lathe][1]:
+                raise ValueError('2-D chunk after an incomplete sample, push the remaining values first')
+            return ring.write(values, on_window)
+
+        n_windows = 0
+        partial, filled = self._partial[lathe]
+        if filled:
+            take = min(self.n_sensors_ - filled, values.shape[0])
+            partial[filled:filled+take] = values[:take]
+            values, filled = values[take:], filled + take
+            if filled < self.n_sensors_:
+                self._partial[lathe] = (partial, filled)
+                return 0
+            n_windows += ring.write(partial[None], on_window)
+
+        complete = values.shape[0] - values.shape[0] % self.n_sensors_
+        n_windows += ring.write(values[:complete].reshape(-1, self.n_sensors_), on_window)
+        rest = values.shape[0] - complete
+        partial[:rest] = values[complete:]
+        self._partial[lathe] = (partial, rest)
+        return n_windows
+
+    def latest(self, lathe):
+        """ See RingBuffer.latest """
+        return self.buffer(lathe).latest()